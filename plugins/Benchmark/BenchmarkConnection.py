@@ -0,0 +1,90 @@
+import os
+import time
+import socket
+import contextlib
+
+import gevent
+
+from Plugin import PluginManager
+from Config import config
+
+
+@PluginManager.registerTo("Actions")
+class ActionsPlugin:
+    def getBenchmarkTests(self, online=False):
+        tests = super().getBenchmarkTests(online)
+        tests.extend([
+            {"func": self.testSendRawfile, "kwargs": {"mode": "sendfile"}, "num": 10, "time_standard": 0.15},
+            {"func": self.testSendRawfile, "kwargs": {"mode": "buffered"}, "num": 10, "time_standard": 0.25},
+            {"func": self.testSendRawfile, "kwargs": {"mode": "tls"}, "num": 10, "time_standard": 0.6},
+        ])
+        return tests
+
+    @contextlib.contextmanager
+    def getTestConnection(self, crypt=None):
+        from Connection import ConnectionServer, Connection
+        from Crypt import CryptConnection
+
+        # Loopback socket pair
+        sock_listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock_listen.bind(("127.0.0.1", 0))
+        sock_listen.listen(1)
+        sock_out = socket.create_connection(sock_listen.getsockname())
+        sock_in, addr = sock_listen.accept()
+        sock_listen.close()
+
+        if crypt:
+            CryptConnection.manager.loadCerts()
+            thread_wrap = gevent.spawn(CryptConnection.manager.wrapSocket, sock_in, crypt, server=True)
+            sock_out = CryptConnection.manager.wrapSocket(sock_out, crypt)
+            sock_in = thread_wrap.get()
+
+        server = ConnectionServer("127.0.0.1", 0)
+        connection = Connection(server, "127.0.0.1", addr[1], sock=sock_out)
+        connection.sock_wrapped = bool(crypt)
+        try:
+            yield connection, sock_in
+        finally:
+            sock_in.close()
+            sock_out.close()
+
+    def testSendRawfile(self, num_run=1, mode="sendfile"):
+        """
+        Test file transmit throughput over loopback
+        """
+        file_size = 1024 * 1024 * 10
+        yield "x 10MB "
+        file_path = "%s/benchmark_sendfile.data" % config.data_dir
+        with open(file_path, "wb") as file:
+            file.write(os.urandom(1024 * 1024) * 10)
+
+        use_sendfile_before = config.use_sendfile
+        config.use_sendfile = (mode == "sendfile")
+
+        def receiver(sock):
+            buff = memoryview(bytearray(256 * 1024))
+            bytes_recv = 0
+            while bytes_recv < file_size:
+                buff_len = sock.recv_into(buff)
+                if not buff_len:
+                    break
+                bytes_recv += buff_len
+            return bytes_recv
+
+        time_taken = 0.0
+        try:
+            with self.getTestConnection(crypt="tls-rsa" if mode == "tls" else None) as (connection, sock_in):
+                for i in range(num_run):
+                    s = time.time()
+                    thread_receiver = gevent.spawn(receiver, sock_in)
+                    with open(file_path, "rb") as file:
+                        connection.sendRawfile(file, read_bytes=file_size)
+                    bytes_recv = thread_receiver.get()
+                    time_taken += time.time() - s
+                    assert bytes_recv == file_size, "Invalid received size: %s != %s" % (bytes_recv, file_size)
+                    yield "."
+        finally:
+            config.use_sendfile = use_sendfile_before
+            os.unlink(file_path)
+
+        yield "(%.0fMB/s)" % (file_size * num_run / 1024 / 1024 / max(time_taken, 0.001))
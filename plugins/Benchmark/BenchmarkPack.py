@@ -181,3 +181,43 @@ class ActionsPlugin:
                     pass
             yield "."
         assert data == data_unpacked, "%s != %s" % (data_unpacked, data)
+
+    def testUnpackMsgpackStreamHandoff(self, num_run=1, fallback=False):
+        """
+        Test message loop style decoding with file stream handoff to the socket
+        """
+        yield "x 100 x (5KB message + 32KB stream) "
+        stream_data = b"Stream" * 5461 + b"..."
+        message = {"cmd": "response", "to": 1, "body": "hello" * 1024, "stream_bytes": len(stream_data)}
+        data_packed = (Msgpack.pack(message) + stream_data) * 100
+        buff_size = 64 * 1024
+
+        for i in range(num_run):
+            unpacker = Msgpack.getUnpacker(decode=False, fallback=fallback)
+            unpacker_bytes = 0
+            stream_bytes_left = 0
+            num_streams = 0
+            for pos in range(0, len(data_packed), buff_size):
+                buff = memoryview(data_packed)[pos:pos + buff_size]
+                if stream_bytes_left:  # Data consumed by the stream reader
+                    skip = min(stream_bytes_left, len(buff))
+                    stream_bytes_left -= skip
+                    buff = buff[skip:]
+                unpacker.feed(buff)
+                unpacker_bytes += len(buff)
+                while True:
+                    try:
+                        message_unpacked = next(unpacker)
+                    except StopIteration:
+                        break
+                    num_streams += 1
+                    # Same handoff as Connection.handleStream: find the stream start from the unpacker position
+                    unprocessed_bytes_num = unpacker_bytes - unpacker.tell()
+                    unpacker_stream_bytes = min(unprocessed_bytes_num, message_unpacked["stream_bytes"])
+                    stream_bytes_left = message_unpacked["stream_bytes"] - unpacker_stream_bytes
+                    buff_left = buff[len(buff) - unprocessed_bytes_num + unpacker_stream_bytes:]
+                    unpacker = Msgpack.getUnpacker(decode=False, fallback=fallback)
+                    unpacker.feed(buff_left)
+                    unpacker_bytes = len(buff_left)
+            assert num_streams == 100, "Invalid number of streams: %s" % num_streams
+            yield "."
@@ -111,6 +111,8 @@ class ActionsPlugin:
             {"func": self.testPackMsgpack, "num": 100, "time_standard": 0.35},
             {"func": self.testUnpackMsgpackStreaming, "kwargs": {"fallback": False}, "num": 100, "time_standard": 0.35},
             {"func": self.testUnpackMsgpackStreaming, "kwargs": {"fallback": True}, "num": 10, "time_standard": 0.5},
+            {"func": self.testUnpackMsgpackStreamHandoff, "kwargs": {"fallback": False}, "num": 100, "time_standard": 0.1},
+            {"func": self.testUnpackMsgpackStreamHandoff, "kwargs": {"fallback": True}, "num": 10, "time_standard": 0.05},
 
             {"func": self.testPackZip, "num": 5, "time_standard": 0.065},
             {"func": self.testPackArchive, "kwargs": {"archive_type": "gz"}, "num": 5, "time_standard": 0.08},
@@ -1,3 +1,4 @@
 from . import BenchmarkPlugin
 from . import BenchmarkDb
 from . import BenchmarkPack
+from . import BenchmarkConnection
@@ -729,7 +729,7 @@ class PeerPlugin(object):
             self.time_piecefields_updated = None
             return self.time_piecefields_updated
         else:
-            return super(PeerPlugin, self).__getattr__(key)
+            raise AttributeError("%r object has no attribute %r" % (type(self).__name__, key))
 
     @util.Noparallel(ignore_args=True)
     def updatePiecefields(self, force=False):
@@ -11,6 +11,7 @@ from File import FileServer
 from File import FileRequest
 from Worker import WorkerManager
 from Peer import Peer
+from Peer import PeerHashfield
 from Bigfile import BigfilePiecefield, BigfilePiecefieldPacked
 from Test import Spy
 from util import Msgpack
@@ -324,7 +325,7 @@ class TestBigfile:
         # Add fake peers with optional files downloaded
         for i in range(5):
             fake_peer = site_temp.addPeer("127.0.1.%s" % i, 1544)
-            fake_peer.hashfield = site.content_manager.hashfield
+            fake_peer.hashfield = PeerHashfield(site.content_manager.hashfield)
             fake_peer.has_hashfield = True
 
         with Spy.Spy(WorkerManager, "addWorker") as requests:
@@ -351,7 +352,7 @@ class TestBigfile:
             peer.updateHashfield = mock.MagicMock(return_value=False)
             peer.updatePiecefields = mock.MagicMock(return_value=False)
             peer.findHashIds = mock.MagicMock(return_value={"nope": []})
-            peer.hashfield = site.content_manager.hashfield
+            peer.hashfield = PeerHashfield(site.content_manager.hashfield)
             peer.has_hashfield = True
             peer.key = "Peer:%s" % i
             site_temp.peers["Peer:%s" % i] = peer
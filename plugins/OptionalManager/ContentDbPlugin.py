@@ -1,6 +1,5 @@
 import time
 import collections
-import itertools
 import re
 
 import gevent
@@ -232,34 +231,25 @@ class ContentDbPlugin(object):
             if not has_updated_hashfield and site.content_manager.hashfield.time_changed < self.time_peer_numbers_updated:
                 continue
 
-            hashfield_peers = itertools.chain.from_iterable(
-                peer.hashfield.storage
-                for peer in site.peers.values()
-                if peer.has_hashfield
-            )
-            peer_nums = collections.Counter(
-                itertools.chain(
-                    hashfield_peers,
-                    site.content_manager.hashfield
-                )
-            )
-
             site_id = self.site_ids[site.address]
             if not site_id:
                 continue
 
+            hashfield_index = site.hashfield_index
+            my_hashfield = site.content_manager.hashfield
             res = self.execute("SELECT file_id, hash_id, peer FROM file_optional WHERE ?", {"site_id": site_id})
             updates = {}
             for row in res:
-                peer_num = peer_nums.get(row["hash_id"], 0)
+                hash_id = row["hash_id"]
+                peer_num = hashfield_index.getNumPeers(hash_id) + (hash_id in my_hashfield)
                 if peer_num != row["peer"]:
                     updates[row["file_id"]] = peer_num
+                num_file += 1
 
             for file_id, peer_num in updates.items():
                 self.execute("UPDATE file_optional SET peer = ? WHERE file_id = ?", (peer_num, file_id))
 
             num_updated += len(updates)
-            num_file += len(peer_nums)
             num_site += 1
 
         self.time_peer_numbers_updated = time.time()
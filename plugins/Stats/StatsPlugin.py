@@ -47,6 +47,12 @@ class UiRequestPlugin(object):
         yield "Network: %s | " % main.file_server.supported_ip_types
         yield "Opened: %s | " % main.file_server.port_opened
         yield "Crypt: %s, TLSv1.3: %s | " % (CryptConnection.manager.crypt_supported, CryptConnection.ssl.HAS_TLSv1_3)
+        yield "TLS resumed: out %s/%s, in %s/%s | " % (
+            CryptConnection.manager.num_client_resumed,
+            CryptConnection.manager.num_client_resumed + CryptConnection.manager.num_client_full,
+            CryptConnection.manager.num_server_resumed,
+            CryptConnection.manager.num_server_resumed + CryptConnection.manager.num_server_full
+        )
         yield "In: %.2fMB, Out: %.2fMB  | " % (
             float(main.file_server.bytes_recv) / 1024 / 1024,
             float(main.file_server.bytes_sent) / 1024 / 1024
@@ -78,7 +84,7 @@ class UiRequestPlugin(object):
             main.file_server.num_incoming, main.file_server.num_outgoing
         )
         yield "<table class='connections'><tr> <th>id</th> <th>type</th> <th>ip</th> <th>open</th> <th>crypt</th> <th>ping</th>"
-        yield "<th>buff</th> <th>bad</th> <th>idle</th> <th>open</th> <th>delay</th> <th>cpu</th> <th>out</th> <th>in</th> <th>last sent</th>"
+        yield "<th>buff</th> <th>bad</th> <th>idle</th> <th>open</th> <th>delay</th> <th>cpu</th> <th>out</th> <th>in</th> <th>part</th> <th>last sent</th>"
         yield "<th>wait</th> <th>version</th> <th>time</th> <th>sites</th> </tr>"
         for connection in main.file_server.connections:
             if "cipher" in dir(connection.sock):
@@ -106,6 +112,9 @@ class UiRequestPlugin(object):
                 ("%.3f", connection.cpu_time),
                 ("%.0fk", connection.bytes_sent / 1024),
                 ("%.0fk", connection.bytes_recv / 1024),
+                ("<span title='Speed: %.0fkB/s, stalled: %s'>%.0fk</span>", (
+                    connection.transfer.speed / 1024, connection.transfer.num_stalled, connection.transfer.read_bytes / 1024
+                )),
                 ("<span title='Recv: %s'>%s</span>", (connection.last_cmd_recv, connection.last_cmd_sent)),
                 ("%s", list(connection.waiting_requests.keys())),
                 ("%s r%s", (connection.handshake.get("version"), connection.handshake.get("rev", "?"))),
@@ -162,7 +171,11 @@ class UiRequestPlugin(object):
             )
 
     def renderSites(self):
-        yield "<br><br><b>Sites</b>:"
+        from Content.ContentDbDict import content_cache
+        cache_stats = content_cache.getStats()
+        yield "<br><br><b>Sites</b>: (content.json cache: %s files, %.0fk/%.0fk, evicted: %s)" % (
+            cache_stats["num"], cache_stats["size"] / 1024, cache_stats["max_size"] / 1024, cache_stats["evicted"]
+        )
         yield "<table>"
         yield "<tr><th>address</th> <th>connected</th> <th title='connected/good/total'>peers</th> <th>content.json</th> <th>out</th> <th>in</th>  </tr>"
         for site in list(self.server.sites.values()):
@@ -177,9 +190,13 @@ class UiRequestPlugin(object):
                     len(site.getConnectablePeers(100)),
                     len(site.peers)
                 )),
-                ("%s (loaded: %s)", (
+                ("<span title='Cache hits: %s, misses: %s, evicted: %s'>%s (loaded: %s, %.0fk)</span>", (
+                    site.content_manager.contents.num_hits,
+                    site.content_manager.contents.num_loaded,
+                    site.content_manager.contents.num_evicted,
                     len(site.content_manager.contents),
-                    len([key for key, val in dict(site.content_manager.contents).items() if val])
+                    len([key for key, val in dict(site.content_manager.contents).items() if val]),
+                    site.content_manager.contents.cached_size / 1024
                 )),
                 ("%.0fk", site.settings.get("bytes_sent", 0) / 1024),
                 ("%.0fk", site.settings.get("bytes_recv", 0) / 1024),
@@ -227,22 +244,50 @@ class UiRequestPlugin(object):
 
     def renderRequests(self):
         import main
-        yield "<div style='float: left'>"
-        yield "<br><br><b>Sent commands</b>:<br>"
-        yield "<table>"
-        for stat_key, stat in sorted(main.file_server.stat_sent.items(), key=lambda i: i[1]["bytes"], reverse=True):
-            yield "<tr><td>%s</td><td style='white-space: nowrap'>x %s =</td><td>%.0fkB</td></tr>" % (stat_key, stat["num"], stat["bytes"] / 1024)
-        yield "</table>"
-        yield "</div>"
-
-        yield "<div style='float: left; margin-left: 20%; max-width: 50%'>"
-        yield "<br><br><b>Received commands</b>:<br>"
-        yield "<table>"
-        for stat_key, stat in sorted(main.file_server.stat_recv.items(), key=lambda i: i[1]["bytes"], reverse=True):
-            yield "<tr><td>%s</td><td style='white-space: nowrap'>x %s =</td><td>%.0fkB</td></tr>" % (stat_key, stat["num"], stat["bytes"] / 1024)
+        stats = main.file_server.stats
+        yield "<br><br><b>Commands</b> (<a href='StatsProtocol'>json</a>):<br>"
+        yield "<table><tr> <th>cmd</th> <th>sent</th> <th>out</th> <th>recv</th> <th>in</th> <th>errors</th>"
+        yield "<th>avg</th> <th>p50</th> <th>p90</th> <th>p99</th> <th>max</th> <th>queued</th> </tr>"
+        commands = sorted(
+            stats.commands.values(),
+            key=lambda stat: stat.bytes_sent + stat.bytes_recv + stat.bytes_response_sent + stat.bytes_response_recv,
+            reverse=True
+        )
+        for stat in commands:
+            if stat.num_latency:
+                latency_avg = stat.latency_sum / stat.num_latency
+            else:
+                latency_avg = None
+            if stat.num_queued:
+                queue_time_avg = stat.queue_time_sum / stat.num_queued
+            else:
+                queue_time_avg = None
+            yield self.formatTableRow([
+                ("%s", html.escape(stat.cmd)),
+                ("%s + %s", (stat.num_sent, stat.num_response_sent)),
+                ("%.0fkB", (stat.bytes_sent + stat.bytes_response_sent) / 1024),
+                ("%s + %s", (stat.num_recv, stat.num_response_recv)),
+                ("%.0fkB", (stat.bytes_recv + stat.bytes_response_recv) / 1024),
+                ("%s", stat.num_errors),
+                ("%.3fs", latency_avg),
+                ("%.3fs", stat.getLatencyPercentile(50, stats.latency_bucket_limits)),
+                ("%.3fs", stat.getLatencyPercentile(90, stats.latency_bucket_limits)),
+                ("%.3fs", stat.getLatencyPercentile(99, stats.latency_bucket_limits)),
+                ("%.3fs", stat.latency_max if stat.num_latency else None),
+                ("<span title='Max: %.3fs'>%.3fs</span>", (stat.queue_time_max, queue_time_avg) if stat.num_queued else None)
+            ])
         yield "</table>"
-        yield "</div>"
-        yield "<div style='clear: both'></div>"
+        scheduler = main.file_server.request_scheduler
+        yield "Request scheduler: running: %s, waiting: %s, rejected: %s<br>" % (
+            scheduler.num_running, len(scheduler.queue), scheduler.num_rejected
+        )
+        from Site.Site import Site
+        pooled_stats = Site.pooledNeedFile.pooled.getStats()
+        yield "Pooled file downloads: in flight: %s, queued: %s, started: %s, wait avg: %.3fs, max: %.3fs<br>" % (
+            pooled_stats["in_flight"], pooled_stats["queued"], pooled_stats["started"], pooled_stats["wait_avg"], pooled_stats["wait_max"]
+        )
+        if stats.errors:
+            yield "Connection errors: %s<br>" % html.escape(", ".join("%s: %s" % item for item in sorted(stats.errors.items())))
 
     def renderMemory(self):
         import gc
@@ -401,6 +446,19 @@ class UiRequestPlugin(object):
         gc.collect()  # Implicit grabage collection
         yield "Done in %.1f" % (time.time() - s)
 
+    # /StatsProtocol entry point
+    @helper.encodeResponse
+    def actionStatsProtocol(self):
+        import main
+
+        self.sendHeader(content_type="application/json")
+
+        if "Multiuser" in PluginManager.plugin_manager.plugin_names and not config.multiuser_local:
+            yield json.dumps({"error": "This function is disabled on this proxy"})
+            return
+
+        yield json.dumps(main.file_server.stats.getStats(), indent=1)
+
     @helper.encodeResponse
     def actionDumpobj(self):
 
@@ -175,6 +175,7 @@ class Actions:
         import time
         from Site.Site import Site
         from Site import SiteManager
+        from Content.ContentVerifier import ContentVerifier
         SiteManager.site_manager.load()
 
         s = time.time()
@@ -182,24 +183,21 @@ class Actions:
         site = Site(address)
         bad_files = []
 
-        for content_inner_path in site.content_manager.contents:
-            s = time.time()
+        # Signatures checked in parallel, results in order
+        verifier = ContentVerifier(site.content_manager)
+        verify_jobs = [
+            (content_inner_path, site.storage.getPath(content_inner_path))
+            for content_inner_path in site.content_manager.contents
+        ]
+        for content_inner_path, file_correct, error in verifier.verifyFiles(verify_jobs, ignore_same=False):
             logging.info("Verifing %s signature..." % content_inner_path)
-            error = None
-            try:
-                file_correct = site.content_manager.verifyFile(
-                    content_inner_path, site.storage.open(content_inner_path, "rb"), ignore_same=False
-                )
-            except Exception as err:
-                file_correct = False
-                error = err
-
             if file_correct is True:
                 logging.info("[OK] %s (Done in %.3fs)" % (content_inner_path, time.time() - s))
             else:
                 logging.error("[ERROR] %s: invalid file: %s!" % (content_inner_path, error))
                 input("Continue?")
                 bad_files += content_inner_path
+            s = time.time()
 
         logging.info("Verifying site files...")
         bad_files += site.storage.verifyFiles()["bad_files"]
@@ -54,8 +54,10 @@ class Config:
         self.keys_api_change_allowed = set([
             "tor", "fileserver_port", "language", "tor_use_bridges", "trackers_proxy", "trackers",
             "trackers_file", "open_browser", "log_level", "fileserver_ip_type", "ip_external", "offline",
-            "threads_fs_read", "threads_fs_write", "threads_crypt", "threads_db"
+            "threads_fs_read", "threads_fs_write", "threads_crypt", "threads_db",
+            "upload_limit", "download_limit", "site_upload_limit", "peer_upload_limit"
         ])
+        self.keys_bandwidth_limit = set(["upload_limit", "download_limit", "site_upload_limit", "peer_upload_limit"])  # kB/sec, 0: unlimited
         self.keys_restart_need = set([
             "tor", "fileserver_port", "fileserver_ip_type", "threads_fs_read", "threads_fs_write", "threads_crypt", "threads_db"
         ])
@@ -407,6 +409,11 @@ class Config:
         self.parser.add_argument('--connected-limit', help='Max connected peer per site', default=8, type=int, metavar='connected_limit')
         self.parser.add_argument('--global-connected-limit', help='Max connections', default=512, type=int, metavar='global_connected_limit')
         self.parser.add_argument('--workers', help='Download workers per site', default=5, type=int, metavar='workers')
+        self.parser.add_argument('--upload-limit', help='Max upload speed of the file server in kB/sec (0: unlimited)', default=0, type=int, metavar='limit')
+        self.parser.add_argument('--download-limit', help='Max download speed of file transfers in kB/sec (0: unlimited)', default=0, type=int, metavar='limit')
+        self.parser.add_argument('--site-upload-limit', help='Max upload speed of one site in kB/sec (0: unlimited)', default=0, type=int, metavar='limit')
+        self.parser.add_argument('--peer-upload-limit', help='Max upload speed to one peer in kB/sec (0: unlimited)', default=0, type=int, metavar='limit')
+        self.parser.add_argument('--download-window', help='Max number of file part requests in flight to a peer (1: disable pipelining)', default=8, type=int, metavar='limit')
 
         self.parser.add_argument('--fileserver-ip', help='FileServer bind address', default="*", metavar='ip')
         self.parser.add_argument('--fileserver-port', help='FileServer bind port (0: randomize)', default=0, type=int, metavar='port')
@@ -440,15 +447,27 @@ class Config:
         self.parser.add_argument('--max-files-opened', help='Change maximum opened files allowed by OS to this value on startup',
                                  default=2048, type=int, metavar='limit')
         self.parser.add_argument('--stack-size', help='Change thread stack size', default=None, type=int, metavar='thread_stack_size')
+        self.parser.add_argument('--use-sendfile', help='Use kernel sendfile to serve files on unencrypted connections',
+                                 type='bool', choices=[True, False], default=True)
         self.parser.add_argument('--use-tempfiles', help='Use temporary files when downloading (experimental)',
                                  type='bool', choices=[True, False], default=False)
         self.parser.add_argument('--stream-downloads', help='Stream download directly to files (experimental)',
                                  type='bool', choices=[True, False], default=False)
+        self.parser.add_argument('--download-snapshot', help='Bootstrap the first download of sites from a peer snapshot of all files',
+                                 type='bool', choices=[True, False], default=True)
         self.parser.add_argument('--msgpack-purepython', help='Use less memory, but a bit more CPU power',
                                  type='bool', choices=[True, False], default=False)
         self.parser.add_argument('--fix-float-decimals', help='Fix content.json modification date float precision on verification',
                                  type='bool', choices=[True, False], default=fix_float_decimals)
         self.parser.add_argument('--db-mode', choices=["speed", "security"], default="speed")
+        self.parser.add_argument('--sign-cache-size', help='Number of verified content.json signatures remembered in content.db (0 to disable)',
+                                 default=100000, type=int, metavar='limit')
+        self.parser.add_argument('--content-json-cache', help='Keep a binary copy of the parsed content.json files to load them faster',
+                                 type='bool', choices=[True, False], default=True)
+        self.parser.add_argument('--content-cache-size', help='Max size of the parsed content.json files kept in memory (MB)',
+                                 default=16, type=int, metavar='size')
+        self.parser.add_argument('--content-cache-size-site', help='Max size of the parsed content.json files kept in memory per site (MB)',
+                                 default=4, type=int, metavar='size')
 
         self.parser.add_argument('--threads-fs-read', help='Number of threads for file read operations', default=1, type=int)
         self.parser.add_argument('--threads-fs-write', help='Number of threads for file write operations', default=1, type=int)
@@ -0,0 +1,115 @@
+import time
+
+import gevent
+
+from Config import config
+
+
+# Rate limit using theoretical arrival time: waiters are served in the order they consumed,
+# so connections sending chunks in a loop share the bandwidth evenly
+class TokenBucket(object):
+    __slots__ = ("rate", "burst", "time_available")
+
+    def __init__(self, rate=0, burst_time=0.5):
+        self.rate = 0
+        self.burst = 0
+        self.time_available = 0.0
+        self.setRate(rate, burst_time)
+
+    # rate: Bytes/sec, 0 for unlimited
+    def setRate(self, rate, burst_time=0.5):
+        self.rate = rate
+        self.burst = rate * burst_time  # Bytes allowed without waiting after an idle period
+
+    # Return: Seconds to wait before the bytes are allowed to pass
+    def consume(self, num_bytes):
+        if not self.rate:
+            return 0.0
+        now = time.time()
+        time_available = max(self.time_available, now)
+        self.time_available = time_available + num_bytes / self.rate
+        return max(0.0, self.time_available - now - self.burst / self.rate)
+
+
+# Global, per-site and per-peer bandwidth budgets of the file server
+class BandwidthLimiter(object):
+    def __init__(self):
+        self.upload = TokenBucket()
+        self.download = TokenBucket()
+        self.site_upload = {}  # Site address -> TokenBucket
+        self.peer_upload = {}  # Peer ip -> TokenBucket
+        self.time_wait = 0.0  # Total time spent waiting for the limits
+        self.rate_sample = (time.time(), 0, 0)  # Time, bytes sent, bytes received for the current rate
+        self.rate_sent = 0.0
+        self.rate_recv = 0.0
+        self.updateLimits()
+
+    def updateLimits(self):
+        self.upload.setRate(config.upload_limit * 1024)
+        self.download.setRate(config.download_limit * 1024)
+        for bucket in self.site_upload.values():
+            bucket.setRate(config.site_upload_limit * 1024)
+        for bucket in self.peer_upload.values():
+            bucket.setRate(config.peer_upload_limit * 1024)
+
+    # Return: Number of bytes to transfer at once to keep the transfer smooth under the limits
+    def getChunkSize(self, max_size, upload=True):
+        if upload:
+            rates = [self.upload.rate, config.site_upload_limit * 1024, config.peer_upload_limit * 1024]
+        else:
+            rates = [self.download.rate]
+        rates = [rate for rate in rates if rate]
+        if not rates:
+            return max_size
+        return int(min(max(min(rates) / 4, 4 * 1024), max_size))  # About 250ms of transfer
+
+    def getBucket(self, buckets, key, limit):
+        bucket = buckets.get(key)
+        if not bucket:
+            bucket = TokenBucket(limit * 1024)
+            buckets[key] = bucket
+        return bucket
+
+    def wait(self, wait):
+        if wait > 0:
+            self.time_wait += wait
+            gevent.sleep(wait)
+
+    # Charge the bytes sent to the global, peer and site upload budget
+    def waitUpload(self, connection, num_bytes, site_address=None):
+        wait = self.upload.consume(num_bytes)
+        if config.peer_upload_limit:
+            bucket = self.getBucket(self.peer_upload, connection.ip, config.peer_upload_limit)
+            wait = max(wait, bucket.consume(num_bytes))
+        if site_address and config.site_upload_limit:
+            bucket = self.getBucket(self.site_upload, site_address, config.site_upload_limit)
+            wait = max(wait, bucket.consume(num_bytes))
+        self.wait(wait)
+
+    def waitDownload(self, connection, num_bytes):
+        self.wait(self.download.consume(num_bytes))
+
+    def removePeer(self, ip):
+        self.peer_upload.pop(ip, None)
+
+    # Return: Current upload and download speed in bytes/sec
+    def getRates(self, bytes_sent, bytes_recv):
+        time_sample, bytes_sent_sample, bytes_recv_sample = self.rate_sample
+        time_taken = time.time() - time_sample
+        if time_taken >= 1:
+            self.rate_sent = (bytes_sent - bytes_sent_sample) / time_taken
+            self.rate_recv = (bytes_recv - bytes_recv_sample) / time_taken
+            self.rate_sample = (time.time(), bytes_sent, bytes_recv)
+        return self.rate_sent, self.rate_recv
+
+    def getInfo(self, bytes_sent, bytes_recv):
+        rate_sent, rate_recv = self.getRates(bytes_sent, bytes_recv)
+        return {
+            "upload_rate": rate_sent,
+            "download_rate": rate_recv,
+            "upload_limit": config.upload_limit * 1024,
+            "download_limit": config.download_limit * 1024,
+            "site_upload_limit": config.site_upload_limit * 1024,
+            "peer_upload_limit": config.peer_upload_limit * 1024,
+            "time_wait": self.time_wait
+        }
@@ -1,5 +1,8 @@
+import os
+import io
 import socket
 import time
+import contextlib
 
 import gevent
 try:
@@ -12,6 +15,7 @@ from Debug import Debug
 from util import Msgpack
 from Crypt import CryptConnection
 from util import helper
+from .TransferEstimator import TransferEstimator
 
 
 class Connection(object):
@@ -19,9 +23,15 @@ class Connection(object):
         "sock", "sock_wrapped", "ip", "port", "cert_pin", "target_onion", "id", "protocol", "type", "server", "unpacker", "unpacker_bytes", "req_id", "ip_type",
         "handshake", "crypt", "connected", "event_connected", "closed", "start_time", "handshake_time", "last_recv_time", "is_private_ip", "is_tracker_connection",
         "last_message_time", "last_send_time", "last_sent_time", "incomplete_buff_recv", "bytes_recv", "bytes_sent", "cpu_time", "send_lock",
-        "last_ping_delay", "last_req_time", "last_cmd_sent", "last_cmd_recv", "bad_actions", "sites", "name", "waiting_requests", "waiting_streams"
+        "last_ping_delay", "last_req_time", "last_cmd_sent", "last_cmd_recv", "bad_actions", "sites", "name", "waiting_requests", "waiting_streams",
+        "stream_buff", "send_buff", "transfer", "timer_check",
+        "send_queue", "send_queue_bytes", "send_queue_waiting", "sched_vtime", "stream_lock", "send_stream_owner",
+        "send_stream_site"
     )
 
+    flush_cmds = ("ping", "handshake")  # Latency sensitive commands sent without coalescing
+    send_queue_max_bytes = 64 * 1024  # Flush queued messages immediately above this size
+
     def __init__(self, server, ip, port, sock=None, target_onion=None, is_tracker_connection=False):
         self.sock = sock
         self.cert_pin = None
@@ -72,12 +82,23 @@ class Connection(object):
         self.sites = 0
         self.cpu_time = 0.0
         self.send_lock = RLock()
+        self.stream_lock = RLock()  # Held while a message is followed by its streamed or raw file data
+        self.send_stream_owner = None  # Greenlet writing a stream, the others queue their messages meanwhile
+        self.send_stream_site = None  # Site charged for the bandwidth of the current stream
 
         self.name = None
         self.updateName()
 
         self.waiting_requests = {}  # Waiting sent requests
         self.waiting_streams = {}  # Waiting response file streams
+        self.stream_buff = None  # Reusable receive buffer for file streams, allocated on first stream
+        self.send_buff = None  # Reusable file read buffer for encrypted connections, allocated on first file send
+        self.transfer = TransferEstimator()  # File part size selection based on measured speed
+        self.timer_check = None  # Next scheduled cleanup check in the server's timer heap
+        self.send_queue = []  # Packed messages waiting to be written in one batch
+        self.send_queue_bytes = 0
+        self.send_queue_waiting = False  # A greenlet is going to flush the queue at the end of the loop tick
+        self.sched_vtime = 0.0  # Virtual time of the connection in the server's request scheduler
 
     def setIp(self, ip):
         self.ip = ip
@@ -106,6 +127,31 @@ class Connection(object):
     def getValidSites(self):
         return [key for key, val in self.server.tor_manager.site_onions.items() if val == self.target_onion]
 
+    # Return: True if the remote side advertised the protocol extension in its handshake
+    def hasFeature(self, feature):
+        features = self.handshake.get("features") if self.handshake else None
+        return type(features) is list and feature in features
+
+    # Return: Key of the peer in the TLS session cache, None if the connection goes through Tor or a proxy
+    # (a resumed session would tell the peer that our connections are from the same client)
+    def getSessionKey(self):
+        if self.ip_type == "onion" or config.tor == "always":
+            return None
+        if self.is_tracker_connection and config.trackers_proxy != "disable":
+            return None
+        return "%s:%s" % (self.ip, self.port)
+
+    # Slow networks get longer timeouts
+    def getTimeoutMultiplier(self):
+        if self.ip.endswith(".onion") or config.tor == "always":
+            return 2
+        else:
+            return 1
+
+    # Return: Time of the last data received or sent on the connection
+    def getLastActivity(self):
+        return max(self.last_recv_time, self.start_time, self.last_message_time, self.last_send_time)
+
     def badAction(self, weight=1):
         self.bad_actions += weight
         if self.bad_actions > 40:
@@ -151,13 +197,13 @@ class Connection(object):
         # Implicit SSL
         should_encrypt = not self.ip_type == "onion" and self.ip not in self.server.broken_ssl_ips and self.ip not in config.ip_local
         if self.cert_pin:
-            self.sock = CryptConnection.manager.wrapSocket(self.sock, "tls-rsa", cert_pin=self.cert_pin)
+            self.sock = CryptConnection.manager.wrapSocket(self.sock, "tls-rsa", cert_pin=self.cert_pin, session_key=self.getSessionKey())
             self.sock.do_handshake()
             self.crypt = "tls-rsa"
             self.sock_wrapped = True
         elif should_encrypt and "tls-rsa" in CryptConnection.manager.crypt_supported:
             try:
-                self.sock = CryptConnection.manager.wrapSocket(self.sock, "tls-rsa")
+                self.sock = CryptConnection.manager.wrapSocket(self.sock, "tls-rsa", session_key=self.getSessionKey())
                 self.sock.do_handshake()
                 self.crypt = "tls-rsa"
                 self.sock_wrapped = True
@@ -200,10 +246,12 @@ class Connection(object):
         self.messageLoop()
 
     def getMsgpackUnpacker(self):
+        # The pure-python unpacker is only used when explicitly requested (--msgpack-purepython)
+        fallback = config.msgpack_purepython
         if self.handshake and self.handshake.get("use_bin_type"):
-            return Msgpack.getUnpacker(fallback=True, decode=False)
+            return Msgpack.getUnpacker(fallback=fallback, decode=False)
         else:  # Backward compatibility for <0.7.0
-            return Msgpack.getUnpacker(fallback=True, decode=True)
+            return Msgpack.getUnpacker(fallback=fallback, decode=True)
 
     # Message loop for connection
     def messageLoop(self):
@@ -250,16 +298,18 @@ class Connection(object):
 
                     # Stats
                     self.incomplete_buff_recv = 0
-                    stat_key = message.get("cmd", "unknown")
-                    if stat_key == "response" and "to" in message:
-                        cmd_sent = self.waiting_requests.get(message["to"], {"cmd": "unknown"})["cmd"]
-                        stat_key = "response: %s" % cmd_sent
-                    if stat_key == "update":
-                        stat_key = "update: %s" % message["params"]["site"]
-                    self.server.stat_recv[stat_key]["bytes"] += req_len
-                    self.server.stat_recv[stat_key]["num"] += 1
                     if "stream_bytes" in message:
-                        self.server.stat_recv[stat_key]["bytes"] += message["stream_bytes"]
+                        req_len += message["stream_bytes"]
+                    cmd = message.get("cmd", "unknown")
+                    if cmd == "response" and "to" in message:
+                        request = self.waiting_requests.get(message["to"])
+                        stat = self.server.stats.get(request["cmd"] if request else "unknown")
+                        stat.num_response_recv += 1
+                        stat.bytes_response_recv += req_len
+                    else:
+                        stat = self.server.stats.get(cmd)
+                        stat.num_recv += 1
+                        stat.bytes_recv += req_len
                     req_len = 0
 
                     # Handle message
@@ -277,14 +327,13 @@ class Connection(object):
         except Exception as err:
             if not self.closed:
                 self.log("Socket error: %s" % Debug.formatException(err))
-                self.server.stat_recv["error: %s" % err]["bytes"] += req_len
-                self.server.stat_recv["error: %s" % err]["num"] += 1
+                self.server.stats.onError(err)
         self.close("MessageLoop ended (closed: %s)" % self.closed)  # MessageLoop ended, close connection
 
     def getUnpackerUnprocessedBytesNum(self):
-        if "tell" in dir(self.unpacker):
+        if hasattr(self.unpacker, "tell"):
             bytes_num = self.unpacker_bytes - self.unpacker.tell()
-        else:
+        else:  # Old pure-python unpacker without tell()
             bytes_num = self.unpacker._fb_buf_n - self.unpacker._fb_buf_o
         return bytes_num
 
@@ -294,11 +343,12 @@ class Connection(object):
         file = self.waiting_streams[message["to"]]
 
         unprocessed_bytes_num = self.getUnpackerUnprocessedBytesNum()
+        buff_view = memoryview(buff)
 
         if unprocessed_bytes_num:  # Found stream bytes in unpacker
             unpacker_stream_bytes = min(unprocessed_bytes_num, stream_bytes_left)
             buff_stream_start = len(buff) - unprocessed_bytes_num
-            file.write(buff[buff_stream_start:buff_stream_start + unpacker_stream_bytes])
+            file.write(buff_view[buff_stream_start:buff_stream_start + unpacker_stream_bytes])
             stream_bytes_left -= unpacker_stream_bytes
         else:
             unpacker_stream_bytes = 0
@@ -309,22 +359,27 @@ class Connection(object):
                 (message["to"], message["stream_bytes"], unpacker_stream_bytes, len(buff), unprocessed_bytes_num)
             )
 
+        if stream_bytes_left > 0 and not self.stream_buff:
+            self.stream_buff = memoryview(bytearray(64 * 1024))
+        stream_buff = self.stream_buff
+        bandwidth = self.server.bandwidth
+
         try:
             while 1:
                 if stream_bytes_left <= 0:
                     break
-                stream_buff = self.sock.recv(min(64 * 1024, stream_bytes_left))
-                if not stream_buff:
+                buff_len = self.sock.recv_into(stream_buff, bandwidth.getChunkSize(min(len(stream_buff), stream_bytes_left), upload=False))
+                if not buff_len:
                     break
-                buff_len = len(stream_buff)
                 stream_bytes_left -= buff_len
-                file.write(stream_buff)
+                file.write(stream_buff[:buff_len])
 
                 # Statistics
                 self.last_recv_time = time.time()
                 self.incomplete_buff_recv += 1
                 self.bytes_recv += buff_len
                 self.server.bytes_recv += buff_len
+                bandwidth.waitDownload(self, buff_len)
         except Exception as err:
             self.log("Stream read error: %s" % Debug.formatException(err))
 
@@ -337,7 +392,7 @@ class Connection(object):
         del self.waiting_requests[message["to"]]
 
         if unpacker_stream_bytes:
-            return buff[buff_stream_start + unpacker_stream_bytes:]
+            return bytes(buff_view[buff_stream_start + unpacker_stream_bytes:])
         else:
             return b""
 
@@ -372,7 +427,8 @@ class Connection(object):
             "rev": config.user_agent_rev,
             "crypt_supported": crypt_supported,
             "crypt": self.crypt,
-            "time": int(time.time())
+            "time": int(time.time()),
+            "features": list(self.server.features)
         }
         if self.target_onion:
             handshake["onion"] = self.target_onion
@@ -443,6 +499,8 @@ class Connection(object):
         cmd = message["cmd"]
 
         self.last_message_time = time.time()
+        if not self.is_private_ip:  # Message from local IPs does not means internet connection
+            self.server.last_message_time = self.last_message_time
         self.last_cmd_recv = cmd
         if cmd == "response":  # New style response
             if message["to"] in self.waiting_requests:
@@ -461,9 +519,11 @@ class Connection(object):
                     self.crypt = message["crypt"]
                     server = (self.type == "in")
                     self.log("Crypt out connection using: %s (server side: %s, ping: %.3fs)..." % (self.crypt, server, ping))
-                    self.sock = CryptConnection.manager.wrapSocket(self.sock, self.crypt, server, cert_pin=self.cert_pin)
+                    self.sock = CryptConnection.manager.wrapSocket(self.sock, self.crypt, server, cert_pin=self.cert_pin, session_key=self.getSessionKey())
                     self.sock.do_handshake()
                     self.sock_wrapped = True
+                elif self.sock_wrapped and self.type == "out":
+                    CryptConnection.manager.saveSession(self.getSessionKey(), self.sock)  # TLS 1.3 ticket received by now
 
                 if not self.sock_wrapped and self.cert_pin:
                     self.close("Crypt connection error: Socket not encrypted, but certificate pin present")
@@ -503,7 +563,9 @@ class Connection(object):
             self.close("Crypt connection error: Socket not encrypted, but certificate pin present")
 
     # Send data to connection
-    def send(self, message, streaming=False):
+    # flush: Write it without waiting for other messages to coalesce
+    # site_address: Charge the site's upload limit while the message is written
+    def send(self, message, streaming=False, flush=False, site_address=None):
         self.last_send_time = time.time()
         if config.debug_socket:
             self.log("Send: %s, to: %s, streaming: %s, site: %s, inner_path: %s, req_id: %s" % (
@@ -521,53 +583,182 @@ class Connection(object):
             self.event_connected.get()
 
         try:
-            stat_key = message.get("cmd", "unknown")
-            if stat_key == "response":
-                stat_key = "response: %s" % self.last_cmd_recv
+            cmd = message.get("cmd", "unknown")
+            if cmd == "response":
+                stat = self.server.stats.get(self.last_cmd_recv)
+                if self.last_cmd_recv in self.flush_cmds:
+                    flush = True
             else:
+                stat = self.server.stats.get(cmd)
                 self.server.num_sent += 1
+                if cmd in self.flush_cmds:
+                    flush = True
 
-            self.server.stat_sent[stat_key]["num"] += 1
             if streaming:
-                with self.send_lock:
-                    bytes_sent = Msgpack.stream(message, self.sock.sendall)
-                self.bytes_sent += bytes_sent
-                self.server.bytes_sent += bytes_sent
-                self.server.stat_sent[stat_key]["bytes"] += bytes_sent
+                with self.streamLock(site_address):
+                    bytes_sent = Msgpack.stream(message, self.sock.sendall, file_writer=self.sendFileData)
+                self.countSent(stat, cmd == "response", bytes_sent)
                 message = None
+            elif site_address:
+                data = Msgpack.pack(message)
+                self.countSent(stat, cmd == "response", len(data))
+                message = None
+                with self.streamLock(site_address):
+                    self.sendData(data)
             else:
                 data = Msgpack.pack(message)
-                self.bytes_sent += len(data)
-                self.server.bytes_sent += len(data)
-                self.server.stat_sent[stat_key]["bytes"] += len(data)
+                self.countSent(stat, cmd == "response", len(data))
                 message = None
-                with self.send_lock:
-                    self.sock.sendall(data)
+                self.sendQueued(data, flush)
         except Exception as err:
-            self.close("Send error: %s (cmd: %s)" % (err, stat_key))
+            self.close("Send error: %s (cmd: %s)" % (err, cmd))
             return False
         self.last_sent_time = time.time()
         return True
 
+    # Write the stream of the current greenlet without other messages getting between its parts
+    @contextlib.contextmanager
+    def streamLock(self, site_address=None):
+        with self.stream_lock:
+            with self.send_lock:
+                self.flushSendQueue()  # Keep the message order
+                owner_before, site_before = self.send_stream_owner, self.send_stream_site
+                self.send_stream_owner = gevent.getcurrent()
+                self.send_stream_site = site_address or site_before
+            try:
+                yield
+            finally:
+                self.send_stream_owner, self.send_stream_site = owner_before, site_before
+                if not owner_before:
+                    self.flushSendQueue()  # Messages queued during the stream
+
+    def isStreamingByOther(self):
+        return self.send_stream_owner is not None and self.send_stream_owner is not gevent.getcurrent()
+
+    # Queue the packed message and write it together with the others queued in the same loop tick
+    def sendQueued(self, data, flush=False):
+        self.send_queue.append(data)
+        self.send_queue_bytes += len(data)
+        if self.isStreamingByOther():
+            return True  # Going to be sent by the streaming greenlet when it's done
+        if flush or self.send_queue_bytes >= self.send_queue_max_bytes:
+            return self.flushSendQueue()
+        if self.send_queue_waiting:
+            return True  # Going to be sent by the waiting greenlet
+        self.send_queue_waiting = True
+        try:
+            gevent.sleep(0)  # Let the other ready greenlets queue their messages
+        finally:
+            self.send_queue_waiting = False
+        return self.flushSendQueue()
+
+    def flushSendQueue(self):
+        with self.send_lock:
+            if not self.send_queue:
+                return True  # Already sent by other greenlet
+            if self.isStreamingByOther():
+                return True  # Sent after the stream
+            if len(self.send_queue) == 1:
+                data = self.send_queue[0]
+            else:
+                data = b"".join(self.send_queue)  # One syscall and one TLS record for the batch
+            self.send_queue = []
+            self.send_queue_bytes = 0
+            self.sock.sendall(data)
+        return True
+
     # Stream file to connection without msgpacking
-    def sendRawfile(self, file, read_bytes):
-        buff = 64 * 1024
+    # message: Sent right before the file data, eg. the response with the stream_bytes
+    def sendRawfile(self, file, read_bytes, message=None, site_address=None):
+        with self.streamLock(site_address):
+            if message:
+                data = Msgpack.pack(message)
+                is_response = message.get("cmd") == "response"
+                stat = self.server.stats.get(self.last_cmd_recv if is_response else message.get("cmd"))
+                self.countSent(stat, is_response, len(data))
+                self.sock.sendall(data)
+            bytes_sent = self.sendFileData(file, read_bytes)
+        self.countSent(self.server.stats.get("raw_file"), False, bytes_sent)
+        return True
+
+    def countSent(self, stat, is_response, bytes_sent):
+        self.bytes_sent += bytes_sent
+        self.server.bytes_sent += bytes_sent
+        if is_response:
+            stat.num_response_sent += 1
+            stat.bytes_response_sent += bytes_sent
+        else:
+            stat.num_sent += 1
+            stat.bytes_sent += bytes_sent
+
+    # Send max read_bytes of file content from its current position, only called within streamLock
+    # Return: Number of bytes sent
+    def sendFileData(self, file, read_bytes):
+        if self.sock_wrapped or not config.use_sendfile or not hasattr(os, "sendfile"):
+            return self.sendFileDataBuffered(file, read_bytes)
+        try:
+            file_fileno = file.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return self.sendFileDataBuffered(file, read_bytes)
+
+        # Unencrypted connection: let the kernel copy the file to the socket
+        sock_fileno = self.sock.fileno()
+        pos = file.tell()
+        bytes_left = min(read_bytes, os.fstat(file_fileno).st_size - pos)
+        bytes_sent = 0
+        bandwidth = self.server.bandwidth
+        while bytes_left > 0:
+            try:
+                num = os.sendfile(sock_fileno, file_fileno, pos + bytes_sent, bandwidth.getChunkSize(bytes_left))
+            except BlockingIOError:
+                gevent.socket.wait_write(sock_fileno, timeout=self.sock.gettimeout())
+                continue
+            except OSError as err:
+                if bytes_sent:
+                    raise
+                # Sendfile not supported for this file or socket
+                if config.debug_socket:
+                    self.log("Sendfile error, falling back to buffered send: %s" % err)
+                return self.sendFileDataBuffered(file, read_bytes)
+            if not num:  # End of file
+                break
+            bytes_sent += num
+            bytes_left -= num
+            self.last_send_time = time.time()
+            bandwidth.waitUpload(self, num, self.send_stream_site)
+        file.seek(pos + bytes_sent)
+        return bytes_sent
+
+    def sendFileDataBuffered(self, file, read_bytes):
+        if not self.send_buff:
+            self.send_buff = memoryview(bytearray(256 * 1024))
+        buff = self.send_buff
         bytes_left = read_bytes
         bytes_sent = 0
-        while True:
+        bandwidth = self.server.bandwidth
+        while bytes_left > 0:
             self.last_send_time = time.time()
-            data = file.read(min(bytes_left, buff))
-            bytes_sent += len(data)
-            with self.send_lock:
-                self.sock.sendall(data)
-            bytes_left -= buff
-            if bytes_left <= 0:
+            buff_len = file.readinto(buff[:bandwidth.getChunkSize(min(bytes_left, len(buff)))])
+            if not buff_len:
                 break
-        self.bytes_sent += bytes_sent
-        self.server.bytes_sent += bytes_sent
-        self.server.stat_sent["raw_file"]["num"] += 1
-        self.server.stat_sent["raw_file"]["bytes"] += bytes_sent
-        return True
+            self.sock.sendall(buff[:buff_len])
+            bytes_sent += buff_len
+            bytes_left -= buff_len
+            bandwidth.waitUpload(self, buff_len, self.send_stream_site)
+        return bytes_sent
+
+    # Write the data in chunks charged to the upload limits
+    def sendData(self, data):
+        data = memoryview(data)
+        bandwidth = self.server.bandwidth
+        pos = 0
+        while pos < len(data):
+            self.last_send_time = time.time()
+            chunk_size = bandwidth.getChunkSize(len(data) - pos)
+            self.sock.sendall(data[pos:pos + chunk_size])
+            pos += chunk_size
+            bandwidth.waitUpload(self, chunk_size, self.send_stream_site)
+        return pos
 
     # Create and send a request to peer
     def request(self, cmd, params={}, stream_to=None):
@@ -584,10 +775,33 @@ class Connection(object):
         self.waiting_requests[self.req_id] = {"evt": event, "cmd": cmd}
         if stream_to:
             self.waiting_streams[self.req_id] = stream_to
+        s = time.time()
         self.send(data)  # Send request
-        res = event.get()  # Wait until event solves
+        res = self.waitResponse(event)
+
+        stat = self.server.stats.get(cmd)
+        if not res or "error" in res:
+            stat.num_errors += 1
+        else:
+            self.server.stats.onLatency(stat, time.time() - s)
         return res
 
+    # Wait for the response until no data received or sent for the request timeout
+    def waitResponse(self, event):
+        timeout = 10 * self.getTimeoutMultiplier()
+        while not self.closed:
+            wait = self.getLastActivity() + timeout - time.time()
+            if wait <= 0:
+                break
+            try:
+                return event.get(timeout=wait)
+            except gevent.Timeout:
+                pass  # Keep waiting if the connection had activity meanwhile
+        if event.ready():
+            return event.get()
+        self.close("Command %s timeout: %.3fs" % (self.last_cmd_sent, time.time() - self.last_send_time))
+        return False
+
     def ping(self):
         s = time.time()
         response = None
@@ -632,4 +846,8 @@ class Connection(object):
         # Little cleanup
         self.sock = None
         self.unpacker = None
+        self.stream_buff = None
+        self.send_buff = None
+        self.send_queue = []
+        self.send_queue_bytes = 0
         self.event_connected = None
@@ -2,7 +2,6 @@ import logging
 import time
 import sys
 import socket
-from collections import defaultdict
 
 import gevent
 import msgpack
@@ -11,8 +10,11 @@ from gevent.pool import Pool
 
 import util
 from util import helper
+from util.TimerHeap import TimerHeap
 from Debug import Debug
 from .Connection import Connection
+from .ProtocolStats import ProtocolStats
+from .BandwidthLimiter import BandwidthLimiter
 from Config import config
 from Crypt import CryptConnection
 from Crypt import CryptHash
@@ -21,6 +23,8 @@ from Site import SiteManager
 
 
 class ConnectionServer(object):
+    features = ()  # Protocol extensions supported by the request handler, advertised in the handshake
+
     def __init__(self, ip=None, port=None, request_handler=None):
         if not ip:
             if config.fileserver_ip_type == "ipv6":
@@ -42,15 +46,18 @@ class ConnectionServer(object):
         self.broken_ssl_ips = {}  # Peerids of broken ssl connections
         self.ips = {}  # Connection by ip
         self.has_internet = True  # Internet outage detection
+        self.last_message_time = 0  # Last message from a non-local ip
+        self.timers = TimerHeap("ConnServer timers")  # Per-connection cleanup checks
 
         self.stream_server = None
         self.stream_server_proxy = None
         self.running = False
         self.stopping = False
         self.thread_checker = None
+        self.check_connections = False
 
-        self.stat_recv = defaultdict(lambda: defaultdict(int))
-        self.stat_sent = defaultdict(lambda: defaultdict(int))
+        self.stats = ProtocolStats()  # Per-command counters and latencies
+        self.bandwidth = BandwidthLimiter()  # Upload and download speed limits
         self.bytes_recv = 0
         self.bytes_sent = 0
         self.num_recv = 0
@@ -81,6 +88,7 @@ class ConnectionServer(object):
         if self.stopping:
             return False
         self.running = True
+        self.check_connections = check_connections
         if check_connections:
             self.thread_checker = gevent.spawn(self.checkConnections)
         CryptConnection.manager.loadCerts()
@@ -118,8 +126,10 @@ class ConnectionServer(object):
         self.log.debug("Stopping %s" % self.stream_server)
         self.stopping = True
         self.running = False
+        self.check_connections = False
         if self.thread_checker:
             gevent.kill(self.thread_checker)
+        self.timers.stop()
         if self.stream_server:
             self.stream_server.stop()
 
@@ -154,7 +164,7 @@ class ConnectionServer(object):
             self.ip_incoming[ip] = 1
 
         connection = Connection(self, ip, port, sock)
-        self.connections.append(connection)
+        self.addConnection(connection)
         if ip not in config.ip_local:
             self.ips[ip] = connection
         connection.handleIncomingConnection(sock)
@@ -213,7 +223,7 @@ class ConnectionServer(object):
                     connection = Connection(self, ip, port, is_tracker_connection=is_tracker_connection)
                 self.num_outgoing += 1
                 self.ips[key] = connection
-                self.connections.append(connection)
+                self.addConnection(connection)
                 connection.log("Connecting... (site: %s)" % site)
                 succ = connection.connect()
                 if not succ:
@@ -231,6 +241,12 @@ class ConnectionServer(object):
         else:
             return None
 
+    def addConnection(self, connection):
+        self.connections.append(connection)
+        if self.check_connections:
+            # First check at the connect timeout
+            self.scheduleConnectionCheck(connection, connection.start_time + 10 * connection.getTimeoutMultiplier())
+
     def removeConnection(self, connection):
         # Delete if same as in registry
         if self.ips.get(connection.ip) == connection:
@@ -246,72 +262,109 @@ class ConnectionServer(object):
         if connection in self.connections:
             self.connections.remove(connection)
 
+        if connection.ip not in self.ips:
+            self.bandwidth.removePeer(connection.ip)
+
+        self.timers.cancel(connection.timer_check)
+        connection.timer_check = None
+
+    def scheduleConnectionCheck(self, connection, check_time):
+        self.timers.cancel(connection.timer_check)
+        connection.timer_check = self.timers.schedule(check_time, self.checkConnection, connection)
+
+    # Return: Time when the next cleanup rule could apply to the connection
+    def getConnectionCheckTime(self, connection):
+        last_activity = max(connection.last_recv_time, connection.start_time, connection.last_message_time)
+        idle = time.time() - last_activity
+        timeout = 10 * connection.getTimeoutMultiplier()
+        if connection.waiting_requests:
+            # Command timeout needs idle receive and no request sent meanwhile
+            return max(last_activity, connection.last_send_time) + timeout
+        for idle_limit in (timeout, 20, 30, 5 * 60, 20 * 60, 60 * 60):
+            if idle < idle_limit:
+                return last_activity + idle_limit
+        return time.time() + 60  # Waiting for a ping or a request in progress
+
+    # Apply the cleanup rules on the connection, then schedule the next check
+    def checkConnection(self, connection):
+        if connection.closed or not self.check_connections:
+            return False
+
+        timeout_multipler = connection.getTimeoutMultiplier()
+        idle = time.time() - max(connection.last_recv_time, connection.start_time, connection.last_message_time)
+
+        if connection.unpacker and idle > 30:
+            # Delete the unpacker if not needed
+            del connection.unpacker
+            connection.unpacker = None
+
+        elif connection.last_cmd_sent == "announce" and idle > 20:  # Bootstrapper connection close after 20 sec
+            connection.close("[Cleanup] Tracker connection, idle: %.3fs" % idle)
+
+        if idle > 60 * 60:
+            # Wake up after 1h
+            connection.close("[Cleanup] After wakeup, idle: %.3fs" % idle)
+
+        elif idle > 20 * 60 and connection.last_send_time < time.time() - 10:
+            # Idle more than 20 min and we have not sent request in last 10 sec
+            connection.timer_check = None
+            gevent.spawn(self.pingConnection, connection)
+            return True  # Next check scheduled after the ping
+
+        elif idle > 10 * timeout_multipler and connection.incomplete_buff_recv > 0:
+            # Incomplete data with more than 10 sec idle
+            connection.close("[Cleanup] Connection buff stalled")
+
+        elif idle > 10 * timeout_multipler and connection.protocol == "?":  # No connection after 10 sec
+            connection.close(
+                "[Cleanup] Connect timeout: %.3fs" % idle
+            )
+
+        elif idle > 10 * timeout_multipler and connection.waiting_requests and time.time() - connection.last_send_time > 10 * timeout_multipler:
+            # Sent command and no response in 10 sec
+            connection.close(
+                "[Cleanup] Command %s timeout: %.3fs" % (connection.last_cmd_sent, time.time() - connection.last_send_time)
+            )
+
+        elif idle < 60 and connection.bad_actions > 40:
+            connection.close(
+                "[Cleanup] Too many bad actions: %s" % connection.bad_actions
+            )
+
+        elif idle > 5 * 60 and connection.sites == 0:
+            connection.close(
+                "[Cleanup] No site for connection"
+            )
+
+        if not connection.closed:
+            self.scheduleConnectionCheck(connection, self.getConnectionCheckTime(connection))
+        return True
+
+    def pingConnection(self, connection):
+        if not connection.ping():
+            connection.close("[Cleanup] Ping timeout")
+        elif not connection.closed and self.check_connections:
+            self.scheduleConnectionCheck(connection, self.getConnectionCheckTime(connection))
+
+    # Server-wide housekeeping, per-connection rules are checked by their own timers
     def checkConnections(self):
         run_i = 0
         time.sleep(15)
         while self.running:
             run_i += 1
             self.ip_incoming = {}  # Reset connected ips counter
-            last_message_time = 0
             s = time.time()
-            for connection in self.connections[:]:  # Make a copy
-                if connection.ip.endswith(".onion") or config.tor == "always":
-                    timeout_multipler = 2
-                else:
-                    timeout_multipler = 1
-
-                idle = time.time() - max(connection.last_recv_time, connection.start_time, connection.last_message_time)
-                if connection.last_message_time > last_message_time and not connection.is_private_ip:
-                    # Message from local IPs does not means internet connection
-                    last_message_time = connection.last_message_time
-
-                if connection.unpacker and idle > 30:
-                    # Delete the unpacker if not needed
-                    del connection.unpacker
-                    connection.unpacker = None
-
-                elif connection.last_cmd_sent == "announce" and idle > 20:  # Bootstrapper connection close after 20 sec
-                    connection.close("[Cleanup] Tracker connection, idle: %.3fs" % idle)
-
-                if idle > 60 * 60:
-                    # Wake up after 1h
-                    connection.close("[Cleanup] After wakeup, idle: %.3fs" % idle)
-
-                elif idle > 20 * 60 and connection.last_send_time < time.time() - 10:
-                    # Idle more than 20 min and we have not sent request in last 10 sec
-                    if not connection.ping():
-                        connection.close("[Cleanup] Ping timeout")
-
-                elif idle > 10 * timeout_multipler and connection.incomplete_buff_recv > 0:
-                    # Incomplete data with more than 10 sec idle
-                    connection.close("[Cleanup] Connection buff stalled")
-
-                elif idle > 10 * timeout_multipler and connection.protocol == "?":  # No connection after 10 sec
-                    connection.close(
-                        "[Cleanup] Connect timeout: %.3fs" % idle
-                    )
-
-                elif idle > 10 * timeout_multipler and connection.waiting_requests and time.time() - connection.last_send_time > 10 * timeout_multipler:
-                    # Sent command and no response in 10 sec
-                    connection.close(
-                        "[Cleanup] Command %s timeout: %.3fs" % (connection.last_cmd_sent, time.time() - connection.last_send_time)
-                    )
-
-                elif idle < 60 and connection.bad_actions > 40:
-                    connection.close(
-                        "[Cleanup] Too many bad actions: %s" % connection.bad_actions
-                    )
-
-                elif idle > 5 * 60 and connection.sites == 0:
-                    connection.close(
-                        "[Cleanup] No site for connection"
-                    )
-
-                elif run_i % 90 == 0:
-                    # Reset bad action counter every 30 min
+
+            if run_i % 90 == 0:
+                # Reset bad action counter every 30 min
+                for connection in self.connections:
                     connection.bad_actions = 0
 
             # Internet outage detection
+            if self.connections:
+                last_message_time = self.last_message_time
+            else:
+                last_message_time = 0
             if time.time() - last_message_time > max(60, 60 * 10 / max(1, float(len(self.connections)) / 50)):
                 # Offline: Last message more than 60-600sec depending on connection number
                 if self.has_internet and last_message_time:
@@ -0,0 +1,116 @@
+import bisect
+import sys
+import time
+
+
+class CommandStats(object):
+    __slots__ = (
+        "cmd", "num_recv", "bytes_recv", "num_sent", "bytes_sent", "num_response_recv", "bytes_response_recv",
+        "num_response_sent", "bytes_response_sent", "num_errors", "num_latency", "latency_sum", "latency_max", "latency_buckets",
+        "num_queued", "queue_time_sum", "queue_time_max"
+    )
+
+    def __init__(self, cmd, num_buckets):
+        self.cmd = cmd
+        self.num_recv = 0  # Requests received
+        self.bytes_recv = 0
+        self.num_sent = 0  # Requests sent
+        self.bytes_sent = 0
+        self.num_response_recv = 0  # Responses received for our requests
+        self.bytes_response_recv = 0
+        self.num_response_sent = 0  # Responses sent for peer's requests
+        self.bytes_response_sent = 0
+        self.num_errors = 0  # Failed or timed out requests
+        self.num_latency = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.latency_buckets = [0] * num_buckets
+        self.num_queued = 0  # Received requests passed the request scheduler
+        self.queue_time_sum = 0.0
+        self.queue_time_max = 0.0
+
+    def getLatencyPercentile(self, percent, bucket_limits):
+        if not self.num_latency:
+            return None
+        num_target = self.num_latency * percent / 100
+        num_total = 0
+        for limit, num in zip(bucket_limits, self.latency_buckets):
+            num_total += num
+            if num_total >= num_target:
+                return min(limit, self.latency_max)
+        return self.latency_max
+
+
+# Per-command protocol counters with request latency histograms
+class ProtocolStats(object):
+    latency_bucket_limits = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf"))
+    max_commands = 100  # Commands are peer controlled, limit the number of tracked ones
+
+    def __init__(self):
+        self.commands = {}  # Command name -> CommandStats
+        self.errors = {}  # Connection error type -> Count
+        self.time_started = time.time()
+
+    # Return: Stats object of the command
+    def get(self, cmd):
+        stat = self.commands.get(cmd)
+        if stat:
+            return stat
+        if type(cmd) is not str:
+            cmd = "invalid"
+        elif len(self.commands) >= self.max_commands:
+            cmd = "other"
+        if cmd not in self.commands:
+            cmd = sys.intern(cmd)
+            self.commands[cmd] = CommandStats(cmd, len(self.latency_bucket_limits))
+        return self.commands[cmd]
+
+    def onLatency(self, stat, latency):
+        stat.num_latency += 1
+        stat.latency_sum += latency
+        if latency > stat.latency_max:
+            stat.latency_max = latency
+        stat.latency_buckets[bisect.bisect_left(self.latency_bucket_limits, latency)] += 1
+
+    def onQueued(self, stat, queue_time):
+        stat.num_queued += 1
+        stat.queue_time_sum += queue_time
+        if queue_time > stat.queue_time_max:
+            stat.queue_time_max = queue_time
+
+    def onError(self, err):
+        error_type = type(err).__name__
+        self.errors[error_type] = self.errors.get(error_type, 0) + 1
+
+    # Return: Json serializable summary of the counters
+    def getStats(self):
+        commands = {}
+        for cmd, stat in self.commands.items():
+            back = {
+                "num_recv": stat.num_recv, "bytes_recv": stat.bytes_recv,
+                "num_sent": stat.num_sent, "bytes_sent": stat.bytes_sent,
+                "num_response_recv": stat.num_response_recv, "bytes_response_recv": stat.bytes_response_recv,
+                "num_response_sent": stat.num_response_sent, "bytes_response_sent": stat.bytes_response_sent,
+                "num_errors": stat.num_errors
+            }
+            if stat.num_queued:
+                back["queue_time"] = {
+                    "num": stat.num_queued,
+                    "avg": stat.queue_time_sum / stat.num_queued,
+                    "max": stat.queue_time_max
+                }
+            if stat.num_latency:
+                back["latency"] = {
+                    "num": stat.num_latency,
+                    "avg": stat.latency_sum / stat.num_latency,
+                    "max": stat.latency_max,
+                    "p50": stat.getLatencyPercentile(50, self.latency_bucket_limits),
+                    "p90": stat.getLatencyPercentile(90, self.latency_bucket_limits),
+                    "p99": stat.getLatencyPercentile(99, self.latency_bucket_limits),
+                    "buckets": [
+                        [limit if limit != float("inf") else None, num]
+                        for limit, num in zip(self.latency_bucket_limits, stat.latency_buckets)
+                    ]
+                }
+            commands[cmd] = back
+        return {"time_started": self.time_started, "commands": commands, "errors": dict(self.errors)}
@@ -0,0 +1,62 @@
+import time
+
+
+# Pick file part sizes for a connection from its measured throughput and latency
+class TransferEstimator(object):
+    __slots__ = ("read_bytes", "speed", "num_samples", "num_stalled", "time_last_sample")
+
+    min_read_bytes = 64 * 1024
+    max_read_bytes = 4 * 1024 * 1024
+    default_read_bytes = 512 * 1024
+    part_time = 2.0  # Target transfer time of one part, keeps requests well within the 10 sec request timeout
+    speed_weight = 0.3  # Weight of a new sample in the moving average
+
+    def __init__(self):
+        self.read_bytes = self.default_read_bytes
+        self.speed = 0.0  # Moving average of download speed in bytes/sec
+        self.num_samples = 0
+        self.num_stalled = 0  # Successive failed or timed out transfers
+        self.time_last_sample = 0
+
+    # Start from the statistics of an earlier connection to the same peer
+    def seed(self, download_bytes, download_time):
+        if self.num_samples or download_time < 1 or not download_bytes:
+            return False
+        self.speed = download_bytes / download_time
+        self.num_samples = 1
+        self.adjust()
+        return True
+
+    # Return: Number of bytes to request in one part
+    def getReadBytes(self, file_size=None):
+        if not self.num_samples and file_size and file_size > 5 * 1024 * 1024:
+            return 1024 * 1024  # No measurement yet, use larger parts for large files
+        return self.read_bytes
+
+    def onTransfer(self, bytes_recv, time_taken, ping=None):
+        if bytes_recv < 16 * 1024:  # Too small to measure the speed
+            return
+        time_taken = max(time_taken, 0.001)
+        speed = bytes_recv / time_taken
+        if self.num_samples:
+            self.speed = self.speed * (1 - self.speed_weight) + speed * self.speed_weight
+        else:
+            self.speed = speed
+        self.num_samples += 1
+        self.num_stalled = 0
+        self.time_last_sample = time.time()
+        self.adjust(ping)
+
+    def onStall(self):
+        self.num_stalled += 1
+        self.read_bytes = max(self.min_read_bytes, int(self.read_bytes / 2))
+
+    def adjust(self, ping=None):
+        # Size of the part transferred in part_time, plus the bytes in flight during one round trip
+        target = self.speed * self.part_time
+        if ping:
+            target += self.speed * ping
+        # Change at most 2x per sample to avoid oscillation
+        target = min(max(target, self.read_bytes / 2), self.read_bytes * 2)
+        target = min(max(target, self.min_read_bytes), self.max_read_bytes)
+        self.read_bytes = int(target / (16 * 1024)) * 16 * 1024
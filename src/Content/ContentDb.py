@@ -1,9 +1,13 @@
 import os
+import json
+import time
+import hashlib
 
 from Db.Db import Db, DbTableError
 from Config import config
 from Plugin import PluginManager
 from Debug import Debug
+from util import helper
 
 
 @PluginManager.acceptPlugins
@@ -36,6 +40,7 @@ class ContentDb(Db):
                 pass
         self.site_ids = {}
         self.sites = {}
+        self.num_sign_cache = None
 
     def getSchema(self):
         schema = {}
@@ -79,6 +84,32 @@ class ContentDb(Db):
             "schema_changed": 1
         }
 
+        schema["tables"]["file_info"] = {
+            "cols": [
+                ["site_id", "INTEGER REFERENCES site (site_id) ON DELETE CASCADE"],
+                ["inner_path", "TEXT NOT NULL"],
+                ["content_inner_path", "TEXT NOT NULL"],
+                ["optional", "INTEGER NOT NULL"],
+                ["node", "TEXT NOT NULL"]
+            ],
+            "indexes": [
+                "CREATE UNIQUE INDEX file_info_key ON file_info (site_id, inner_path)",
+                "CREATE INDEX file_info_content ON file_info (site_id, content_inner_path)"
+            ],
+            "schema_changed": 1
+        }
+
+        schema["tables"]["sign_cache"] = {
+            "cols": [
+                ["sign_hash", "BLOB PRIMARY KEY NOT NULL"],
+                ["time_added", "INTEGER NOT NULL"]
+            ],
+            "indexes": [
+                "CREATE INDEX sign_cache_time_added ON sign_cache (time_added)"
+            ],
+            "schema_changed": 1
+        }
+
         return schema
 
     def initSite(self, site):
@@ -109,9 +140,49 @@ class ContentDb(Db):
             "site_id": self.site_ids.get(site.address, 0),
             "inner_path": inner_path
         })
+        self.setFileInfo(site, inner_path, content)
 
     def deleteContent(self, site, inner_path):
         self.execute("DELETE FROM content WHERE ?", {"site_id": self.site_ids.get(site.address, 0), "inner_path": inner_path})
+        self.execute("DELETE FROM file_info WHERE ?", {"site_id": self.site_ids.get(site.address, 0), "content_inner_path": inner_path})
+
+    # Index the files of the content.json by their path relative to the site
+    def setFileInfo(self, site, content_inner_path, content):
+        site_id = self.site_ids.get(site.address, 0)
+        content_inner_dir = helper.getDirname(content_inner_path)
+        rows = []
+        # Files listed in both get the non-optional node, same as ContentManager.getFileInfo
+        for optional, files_key in ((1, "files_optional"), (0, "files")):
+            for relative_path, node in content.get(files_key, {}).items():
+                rows.append((site_id, content_inner_dir + relative_path, content_inner_path, optional, json.dumps(node)))
+
+        self.execute("DELETE FROM file_info WHERE ?", {"site_id": site_id, "content_inner_path": content_inner_path})
+        if rows:
+            self.getCursor().executemany(
+                "INSERT OR REPLACE INTO file_info (site_id, inner_path, content_inner_path, optional, node) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+
+    # Index the content.json loaded from the disk if it's not indexed yet (eg. content.db created by an older version)
+    def needFileInfo(self, site, content_inner_path, content):
+        if not content.get("files") and not content.get("files_optional"):
+            return False
+        res = self.execute(
+            "SELECT 1 FROM file_info WHERE site_id = :site_id AND content_inner_path = :content_inner_path LIMIT 1",
+            {"site_id": self.site_ids.get(site.address, 0), "content_inner_path": content_inner_path}
+        )
+        if res.fetchone():
+            return False
+        self.setFileInfo(site, content_inner_path, content)
+        return True
+
+    # Return: Row of the content.json that lists the file or None
+    def getFileInfo(self, site, inner_path):
+        res = self.execute(
+            "SELECT content_inner_path, optional, node FROM file_info WHERE site_id = :site_id AND inner_path = :inner_path",
+            {"site_id": self.site_ids.get(site.address, 0), "inner_path": inner_path}
+        )
+        return res.fetchone()
 
     def loadDbDict(self, site):
         res = self.execute(
@@ -148,6 +219,36 @@ class ContentDb(Db):
         res = self.execute("SELECT inner_path, modified FROM content WHERE ?", params)
         return {row["inner_path"]: row["modified"] for row in res}
 
+    # Key of a verified signature: the signer address, the digest of the signed data and the signature
+    def getSignHash(self, data, address, sign):
+        data_hash = hashlib.sha256(data.encode("utf8")).hexdigest()
+        return hashlib.sha256(("%s:%s:%s" % (address, data_hash, sign)).encode("utf8")).digest()
+
+    def isSignVerified(self, sign_hash):
+        res = self.execute("SELECT 1 FROM sign_cache WHERE sign_hash = :sign_hash", {"sign_hash": sign_hash})
+        return bool(res.fetchone())
+
+    def setSignVerified(self, sign_hash):
+        if self.num_sign_cache is None:
+            self.num_sign_cache = self.execute("SELECT COUNT(*) AS num FROM sign_cache").fetchone()["num"]
+        res = self.execute(
+            "INSERT OR IGNORE INTO sign_cache (sign_hash, time_added) VALUES (:sign_hash, :time_added)",
+            {"sign_hash": sign_hash, "time_added": int(time.time())}
+        )
+        self.num_sign_cache += res.rowcount
+        if self.num_sign_cache > config.sign_cache_size:
+            self.cleanupSignCache()
+
+    # Drop the oldest tenth of the entries
+    def cleanupSignCache(self):
+        num_delete = self.num_sign_cache - int(config.sign_cache_size * 0.9)
+        res = self.execute(
+            "DELETE FROM sign_cache WHERE sign_hash IN (SELECT sign_hash FROM sign_cache ORDER BY time_added LIMIT :limit)",
+            {"limit": num_delete}
+        )
+        self.num_sign_cache -= res.rowcount
+        self.log.debug("Removed %s entries from signature cache (left: %s)" % (res.rowcount, self.num_sign_cache))
+
 content_dbs = {}
 
 
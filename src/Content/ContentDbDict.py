@@ -1,20 +1,63 @@
 import time
 import os
+import collections
 
 from . import ContentDb
 from Debug import Debug
 from Config import config
 
 
+# Parsed content.json files of every site in least recently used order, bounded by the size of the files
+class ContentCache(object):
+    def __init__(self):
+        self.items = collections.OrderedDict()  # (id(contents), inner_path): (contents, size)
+        self.size = 0
+        self.num_evicted = 0
+
+    def getMaxSize(self):
+        return config.content_cache_size * 1024 * 1024
+
+    def add(self, contents, key, size):
+        item_key = (id(contents), key)
+        old_item = self.items.pop(item_key, None)
+        if old_item:
+            self.size -= old_item[1]
+        self.items[item_key] = (contents, size)
+        self.size += size
+
+    def touch(self, contents, key):
+        self.items.move_to_end((id(contents), key))
+
+    def remove(self, contents, key):
+        item = self.items.pop((id(contents), key), None)
+        if item:
+            self.size -= item[1]
+
+    def checkLimit(self):
+        max_size = self.getMaxSize()
+        while self.size > max_size and len(self.items) > 1:
+            (contents_id, key), (contents, size) = next(iter(self.items.items()))
+            contents.evict(key)
+
+    def getStats(self):
+        return {"size": self.size, "max_size": self.getMaxSize(), "num": len(self.items), "evicted": self.num_evicted}
+
+
+content_cache = ContentCache()
+
+
 class ContentDbDict(dict):
     def __init__(self, site, *args, **kwargs):
         s = time.time()
         self.site = site
-        self.cached_keys = []
+        self.cached_keys = collections.OrderedDict()  # Loaded keys in least recently used order: file size
+        self.cached_size = 0
         self.log = self.site.log
         self.db = ContentDb.getContentDb()
         self.db_id = self.db.needSite(site)
-        self.num_loaded = 0
+        self.num_loaded = 0  # Cache misses
+        self.num_hits = 0
+        self.num_evicted = 0
         super(ContentDbDict, self).__init__(self.db.loadDbDict(site))  # Load keys from database
         self.log.debug("ContentDb init: %.3fs, found files: %s, sites: %s" % (time.time() - s, len(self), len(self.db.site_ids)))
 
@@ -27,13 +70,15 @@ class ContentDbDict(dict):
                 else:
                     self.log.debug("Loaded json: %s (latest: %s)" % (self.num_loaded, key))
             content = self.site.storage.loadJson(key)
+            size = self.getItemSize(key)
             dict.__setitem__(self, key, content)
+            self.db.needFileInfo(self.site, key, content)
         except IOError:
             if dict.get(self, key):
                 self.__delitem__(key)  # File not exists anymore
             raise KeyError(key)
 
-        self.addCachedKey(key)
+        self.addCachedKey(key, size)
         self.checkLimit()
 
         return content
@@ -41,19 +86,57 @@ class ContentDbDict(dict):
     def getItemSize(self, key):
         return self.site.storage.getSize(key)
 
-    # Only keep last 10 accessed json in memory
+    # Keep the recently used json files in memory up to the per site and the global size limit
     def checkLimit(self):
-        if len(self.cached_keys) > 10:
-            key_deleted = self.cached_keys.pop(0)
-            dict.__setitem__(self, key_deleted, False)
-
-    def addCachedKey(self, key):
-        if key not in self.cached_keys and key != "content.json" and len(key) > 40:  # Always keep keys smaller than 40 char
-            self.cached_keys.append(key)
+        max_size = config.content_cache_size_site * 1024 * 1024
+        while self.cached_size > max_size and len(self.cached_keys) > 1:
+            self.evict(next(iter(self.cached_keys)))
+        content_cache.checkLimit()
+
+    def addCachedKey(self, key, size):
+        if key == "content.json":
+            return  # Always keep the root content.json
+        old_size = self.cached_keys.pop(key, None)
+        if old_size is not None:
+            self.cached_size -= old_size
+        self.cached_keys[key] = size
+        self.cached_size += size
+        content_cache.add(self, key, size)
+
+    def removeCachedKey(self, key):
+        size = self.cached_keys.pop(key, None)
+        if size is not None:
+            self.cached_size -= size
+            content_cache.remove(self, key)
+
+    # Drop the parsed json from memory, it will be loaded again from the disk on next access
+    def unload(self, key):
+        self.removeCachedKey(key)
+        if dict.get(self, key):
+            dict.__setitem__(self, key, False)
+
+    def evict(self, key):
+        self.unload(key)
+        self.num_evicted += 1
+        content_cache.num_evicted += 1
+
+    def clearCache(self):
+        for key in list(self.cached_keys):
+            self.unload(key)
+
+    def getCacheStats(self):
+        return {
+            "size": self.cached_size, "num": len(self.cached_keys),
+            "hits": self.num_hits, "misses": self.num_loaded, "evicted": self.num_evicted
+        }
 
     def __getitem__(self, key):
         val = dict.get(self, key)
         if val:  # Already loaded
+            self.num_hits += 1
+            if key in self.cached_keys:
+                self.cached_keys.move_to_end(key)
+                content_cache.touch(self, key)
             return val
         elif val is None:  # Unknown key
             raise KeyError(key)
@@ -61,19 +144,16 @@ class ContentDbDict(dict):
             return self.loadItem(key)
 
     def __setitem__(self, key, val):
-        self.addCachedKey(key)
-        self.checkLimit()
         size = self.getItemSize(key)
         self.db.setContent(self.site, key, val, size)
         dict.__setitem__(self, key, val)
+        self.addCachedKey(key, size)
+        self.checkLimit()
 
     def __delitem__(self, key):
         self.db.deleteContent(self.site, key)
         dict.__delitem__(self, key)
-        try:
-            self.cached_keys.remove(key)
-        except ValueError:
-            pass
+        self.removeCachedKey(key)
 
     def iteritems(self):
         for key in dict.keys(self):
@@ -17,6 +17,7 @@ from Config import config
 from util import helper
 from util import Diff
 from util import SafeRe
+from util.DownloadFile import DownloadFile, HashedFile
 from Peer import PeerHashfield
 from .ContentDbDict import ContentDbDict
 from Plugin import PluginManager
@@ -71,6 +72,7 @@ class ContentManager:
         elif self.contents.get("content.json") and self.site.settings["size_optional"] > 0:
             self.site.storage.updateBadFiles()  # No hashfield cache created yet
         self.has_optional_files = bool(self.hashfield)
+        self.hashfield.enableChangelog()  # Peers only get the changes from now
 
         self.contents.db.initSite(self.site)
 
@@ -420,6 +422,10 @@ class ContentManager:
     # Find the file info line from self.contents
     # Return: { "sha512": "c29d73d...21f518", "size": 41 , "content_inner_path": "content.json"}
     def getFileInfo(self, inner_path, new_file=False):
+        back = self.getFileInfoIndexed(inner_path)
+        if back:
+            return back
+
         dirs = inner_path.split("/")  # Parent dirs of content.json
         inner_path_parts = []  # Filename relative to content.json
         while dirs:
@@ -470,6 +476,34 @@ class ContentManager:
         # Not found
         return False
 
+    # Find the file using the file_info index of content.db without loading the parent content.json files
+    # Return: The file info or None if the index can't tell
+    def getFileInfoIndexed(self, inner_path):
+        # Only when the closest content.json is not in memory: walking the loaded ones is faster than a query
+        dirs = inner_path.split("/")[:-1]
+        closest_inner_path = None
+        while True:
+            content_inner_path = "/".join(dirs + ["content.json"])
+            if content_inner_path in self.contents:
+                closest_inner_path = content_inner_path
+                break
+            if not dirs:
+                break
+            dirs.pop()
+        if not closest_inner_path or dict.get(self.contents, closest_inner_path):
+            return None
+
+        row = self.contents.db.getFileInfo(self.site, inner_path)
+        if not row or row["content_inner_path"] != closest_inner_path:
+            return None  # Listed by a content.json further away: let the walk decide
+
+        relative_path = inner_path[len(helper.getDirname(closest_inner_path)):]
+        back = json.loads(row["node"])
+        back["content_inner_path"] = closest_inner_path
+        back["optional"] = bool(row["optional"])
+        back["relative_path"] = relative_path
+        return back
+
     def getRules(self, inner_path, content=None):
         """Get rules for the file
 
@@ -854,9 +888,37 @@ class ContentManager:
     def getSignsRequired(self, inner_path, content=None):
         return 1  # Todo: Multisig
 
+    # Return: The signed data of content.json without the sign and signs keys
+    def getSignContent(self, content):
+        sign_content = json.dumps(content, sort_keys=True)  # Dump the json to string to remove whitepsace
+
+        # Fix float representation error on Android
+        modified = content["modified"]
+        if config.fix_float_decimals and type(modified) is float and not str(modified).endswith(".0"):
+            modified_fixed = "{:.6f}".format(modified).strip("0.")
+            sign_content = sign_content.replace(
+                '"modified": %s' % repr(modified),
+                '"modified": %s' % modified_fixed
+            )
+        return sign_content
+
+    # Verify the sign using the cache of already verified signatures
+    # Return: True or False
+    def verifySign(self, data, address, sign):
+        if not config.sign_cache_size:
+            return CryptBitcoin.verify(data, address, sign)
+        db = self.contents.db
+        sign_hash = db.getSignHash(data, address, sign)
+        if db.isSignVerified(sign_hash):
+            return True
+        valid = CryptBitcoin.verify(data, address, sign)
+        if valid:
+            db.setSignVerified(sign_hash)
+        return valid
+
     def verifyCertSign(self, user_address, user_auth_type, user_name, issuer_address, sign):
         cert_subject = f'{user_address}#{user_auth_type}/{user_name}'
-        return CryptBitcoin.verify(cert_subject, issuer_address, sign)
+        return self.verifySign(cert_subject, issuer_address, sign)
 
     def verifyCert(self, inner_path, content):
         rules = self.getRules(inner_path, content)
@@ -1012,16 +1074,7 @@ class ContentManager:
                 if "signs" in new_content:
                     del(new_content["signs"])  # The file signed without the signs
 
-                sign_content = json.dumps(new_content, sort_keys=True)  # Dump the json to string to remove whitepsace
-
-                # Fix float representation error on Android
-                modified = new_content["modified"]
-                if config.fix_float_decimals and type(modified) is float and not str(modified).endswith(".0"):
-                    modified_fixed = "{:.6f}".format(modified).strip("0.")
-                    sign_content = sign_content.replace(
-                        '"modified": %s' % repr(modified),
-                        '"modified": %s' % modified_fixed
-                    )
+                sign_content = self.getSignContent(new_content)
 
                 if signs:  # New style signing
                     valid_signers = self.getValidSigners(inner_path, new_content)
@@ -1029,7 +1082,7 @@ class ContentManager:
 
                     if inner_path == "content.json" and len(valid_signers) > 1:  # Check signers_sign on root content.json
                         signers_data = "%s:%s" % (signs_required, ",".join(valid_signers))
-                        if not CryptBitcoin.verify(signers_data, self.site.address, new_content["signers_sign"]):
+                        if not self.verifySign(signers_data, self.site.address, new_content["signers_sign"]):
                             raise VerifyError("Invalid signers_sign!")
 
                     if inner_path != "content.json" and not self.verifyCert(inner_path, new_content):  # Check if cert valid
@@ -1038,7 +1091,7 @@ class ContentManager:
                     valid_signs = 0
                     for address in valid_signers:
                         if address in signs:
-                            valid_signs += CryptBitcoin.verify(sign_content, address, signs[address])
+                            valid_signs += self.verifySign(sign_content, address, signs[address])
                         if valid_signs >= signs_required:
                             break  # Break if we has enough signs
                     if valid_signs < signs_required:
@@ -1057,7 +1110,11 @@ class ContentManager:
         else:  # Check using sha512 hash
             file_info = self.getFileInfo(inner_path)
             if file_info:
-                if CryptHash.sha512sum(file) != file_info.get("sha512", ""):
+                if isinstance(file, (DownloadFile, HashedFile)):  # Hashed while downloaded or in the verify thread pool
+                    sha512 = file.getSha512()
+                else:
+                    sha512 = CryptHash.sha512sum(file)
+                if sha512 != file_info.get("sha512", ""):
                     raise VerifyError("Invalid hash")
 
                 if file_info.get("size", 0) != file.tell():
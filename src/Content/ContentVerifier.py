@@ -0,0 +1,104 @@
+import json
+import collections
+from pathlib import Path
+
+import gevent.event
+
+from Config import config
+from Crypt import Crypt
+from Crypt import CryptHash
+from Crypt import CryptBitcoin
+from util import ThreadPool
+from util.DownloadFile import HashedFile
+
+
+# Verify files in bulk: the sha512 sums and the content.json signature recoveries run in parallel in the crypt
+# thread pool (hashlib and the secp256k1 libs release the GIL), then the results are checked in the original
+# order by ContentManager.verifyFile on the caller's thread
+class ContentVerifier(object):
+    def __init__(self, content_manager, max_parallel=None):
+        self.content_manager = content_manager
+        self.log = content_manager.log
+        if max_parallel is None:
+            max_parallel = max(config.threads_crypt, 1) * 4
+        self.max_parallel = max_parallel  # Files read ahead of the one currently checked
+
+    def __repr__(self):
+        return "<ContentVerifier %s>" % self.content_manager.site.address_short
+
+    def spawn(self, func, *args):
+        if Crypt.thread_pool_crypt.pool is None or not ThreadPool.isMainThread():
+            res = gevent.event.AsyncResult()
+            res.set(func(*args))
+            return res
+        return Crypt.thread_pool_crypt.spawn(func, *args)
+
+    # Hash the file or recover the signers of the content.json, runs in the thread pool
+    # Return: (file or content dict, verified sign hashes, error)
+    def prepareFile(self, inner_path, file):
+        try:
+            if isinstance(file, (str, Path)):
+                file = open(file, "rb")
+                file_opened = True
+            else:
+                file_opened = False
+
+            try:
+                if not inner_path.endswith("content.json"):
+                    return HashedFile(CryptHash.sha512sum(file), file.tell()), [], None
+
+                content = json.load(file)
+            finally:
+                if file_opened:
+                    file.close()
+
+            sign_hashes = []
+            signs = content.get("signs")
+            if config.sign_cache_size and type(signs) is dict and "modified" in content:
+                db = self.content_manager.contents.db
+                sign_content = self.content_manager.getSignContent(
+                    {key: val for key, val in content.items() if key not in ("sign", "signs")}
+                )
+                for address, sign in signs.items():
+                    if CryptBitcoin.verify(sign_content, address, sign):
+                        sign_hashes.append(db.getSignHash(sign_content, address, sign))
+            return content, sign_hashes, None
+        except Exception as err:
+            return None, [], err
+
+    # Return: (valid, error) as ContentManager.verifyFile would
+    def checkFile(self, inner_path, file, sign_hashes, error, ignore_same=True):
+        if error:
+            self.log.debug("%s: verify prepare error: %s" % (inner_path, error))
+            return False, error
+
+        # Signers recovered in the thread pool, verifyFile finds them in the sign cache
+        db = self.content_manager.contents.db
+        for sign_hash in sign_hashes:
+            db.setSignVerified(sign_hash)
+
+        try:
+            return self.content_manager.verifyFile(inner_path, file, ignore_same=ignore_same), None
+        except Exception as err:
+            return False, err
+
+    # Verify (inner_path, file object or path) jobs
+    # Return: Generator of (inner_path, valid, error) in the order of the jobs
+    def verifyFiles(self, jobs, ignore_same=True):
+        jobs = iter(jobs)
+        threads = collections.deque()
+        while True:
+            while len(threads) < self.max_parallel:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                inner_path, file = job
+                threads.append((inner_path, self.spawn(self.prepareFile, inner_path, file)))
+
+            if not threads:
+                break
+
+            inner_path, thread = threads.popleft()
+            file, sign_hashes, error = thread.get()
+            valid, error = self.checkFile(inner_path, file, sign_hashes, error, ignore_same=ignore_same)
+            yield inner_path, valid, error
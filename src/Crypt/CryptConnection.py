@@ -4,6 +4,7 @@ import os
 import ssl
 import hashlib
 import random
+import collections
 
 from Config import config
 from util import helper
@@ -26,6 +27,13 @@ class CryptConnectionManager:
         self.context_client = None
         self.context_server = None
 
+        self.sessions = collections.OrderedDict()  # Peer "ip:port" -> (TLS session, server hostname) for resumption
+        self.sessions_limit = 1000
+        self.num_client_full = 0  # Handshakes made with full key exchange
+        self.num_client_resumed = 0  # Handshakes resumed from cached session
+        self.num_server_full = 0
+        self.num_server_resumed = 0
+
         self.openssl_conf_template = "src/lib/openssl/openssl.cnf"
         self.openssl_conf = config.private_dir / "openssl.cnf"
 
@@ -70,6 +78,8 @@ class CryptConnectionManager:
 
         self.context_server = ssl.SSLContext(protocol)
         self.context_server.load_cert_chain(self.cert_pem, self.key_pem)
+        # Session tickets are encrypted with a random key of the context, so they are valid until restart
+        self.context_server.options &= ~ssl.OP_NO_TICKET
 
         for ctx in (self.context_client, self.context_server):
             ctx.set_ciphers(ciphers)
@@ -89,13 +99,30 @@ class CryptConnectionManager:
         return False
 
     # Wrap socket for crypt
+    # session_key: Peer "ip:port" to resume the previous TLS session with
     # Return: wrapped socket
-    def wrapSocket(self, sock, crypt, server=False, cert_pin=None):
+    def wrapSocket(self, sock, crypt, server=False, cert_pin=None, session_key=None):
         if crypt == "tls-rsa":
             if server:
                 sock_wrapped = self.context_server.wrap_socket(sock, server_side=True)
+                if sock_wrapped.session_reused:
+                    self.num_server_resumed += 1
+                else:
+                    self.num_server_full += 1
             else:
-                sock_wrapped = self.context_client.wrap_socket(sock, server_hostname=random.choice(self.fakedomains))
+                session, server_hostname = self.sessions.get(session_key, (None, None))
+                if not server_hostname:
+                    server_hostname = random.choice(self.fakedomains)
+                try:
+                    sock_wrapped = self.context_client.wrap_socket(sock, server_hostname=server_hostname, session=session)
+                except ssl.SSLError:
+                    self.sessions.pop(session_key, None)
+                    raise
+                if sock_wrapped.session_reused:
+                    self.num_client_resumed += 1
+                else:
+                    self.num_client_full += 1
+                self.saveSession(session_key, sock_wrapped)
             if cert_pin:
                 cert_hash = hashlib.sha256(sock_wrapped.getpeercert(True)).hexdigest()
                 if cert_hash != cert_pin:
@@ -104,6 +131,20 @@ class CryptConnectionManager:
         else:
             return sock
 
+    # Keep the session of the connection for later resumption
+    # With TLS 1.3 the ticket arrives after the handshake, so also call it after the first message received
+    def saveSession(self, session_key, sock):
+        if not session_key:
+            return False
+        session = sock.session
+        if not session or (sock.version() == "TLSv1.3" and not session.has_ticket):
+            return False
+        self.sessions[session_key] = (session, sock.server_hostname)
+        self.sessions.move_to_end(session_key)
+        if len(self.sessions) > self.sessions_limit:
+            self.sessions.popitem(last=False)
+        return True
+
     def removeCerts(self):
         if config.keep_ssl_cert:
             return False
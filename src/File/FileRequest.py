@@ -15,8 +15,13 @@ from util import Msgpack
 from util import helper
 from Plugin import PluginManager
 from contextlib import closing
+from .RequestScheduler import RequestSchedulerBusy
+from Peer import PeerHashfield
+from Site import SiteSnapshot
 
 FILE_BUFF = 1024 * 512
+GET_FILES_MAX_FILES = 100  # Max number of files in one getFiles request
+GET_FILES_MAX_BYTES = 1024 * 512  # Max total size of the files sent in one getFiles response
 
 
 class RequestError(Exception):
@@ -37,15 +42,17 @@ class FileRequest(object):
         self.log = server.log
         self.responded = False  # Responded to the request
 
-    def send(self, msg, streaming=False):
+    def send(self, msg, streaming=False, site_address=None):
         if not self.connection.closed:
-            self.connection.send(msg, streaming)
+            self.connection.send(msg, streaming, site_address=site_address)
 
-    def sendRawfile(self, file, read_bytes):
+    def sendRawfile(self, file, read_bytes, msg=None, site_address=None):
         if not self.connection.closed:
-            self.connection.sendRawfile(file, read_bytes)
+            self.connection.sendRawfile(file, read_bytes, message=msg, site_address=site_address)
 
-    def response(self, msg, streaming=False):
+    # rawfile: (file, read_bytes) sent right after the response, nothing else gets between them
+    # site_address: Site charged for the upload bandwidth while sending
+    def response(self, msg, streaming=False, rawfile=None, site_address=None):
         if self.responded:
             if config.verbose:
                 self.log.debug("Req id %s already responded" % self.req_id)
@@ -55,7 +62,11 @@ class FileRequest(object):
         msg["cmd"] = "response"
         msg["to"] = self.req_id
         self.responded = True
-        self.send(msg, streaming=streaming)
+        if rawfile:
+            file, read_bytes = rawfile
+            self.sendRawfile(file, read_bytes, msg=msg, site_address=site_address)
+        else:
+            self.send(msg, streaming=streaming, site_address=site_address)
 
     # Route file requests
     def route(self, cmd, req_id, params):
@@ -79,25 +90,30 @@ class FileRequest(object):
         else:
             func_name = "action" + cmd[0].upper() + cmd[1:]
             func = getattr(self, func_name, None)
-            if cmd not in ["getFile", "streamFile"]:  # Skip IO bound functions
-                if self.connection.cpu_time > 0.5:
-                    self.log.debug(
-                        "Delay %s %s, cpu_time used by connection: %.3fs" %
-                        (self.connection.ip, cmd, self.connection.cpu_time)
-                    )
-                    time.sleep(self.connection.cpu_time)
-                    if self.connection.cpu_time > 5:
-                        self.connection.close("Cpu time: %.3fs" % self.connection.cpu_time)
-                s = time.time()
-            if func:
-                func(params)
-            else:
+            if not func:
                 self.actionUnknown(cmd, params)
+                return
 
-            if cmd not in ["getFile", "streamFile"]:
-                taken = time.time() - s
-                taken_sent = self.connection.last_sent_time - self.connection.last_send_time
-                self.connection.cpu_time += taken - taken_sent
+            # Requests of peers using more cpu and bandwidth than others wait in the scheduler
+            try:
+                self.server.request_scheduler.run(self.connection, cmd, self.runAction, cmd, func, params)
+            except RequestSchedulerBusy as err:
+                self.log.debug("Reject %s %s: %s" % (self.connection.ip, cmd, err))
+                self.response({"error": "Busy, try again later", "retry_after": round(err.retry_after, 1)})
+
+    def runAction(self, cmd, func, params):
+        if cmd in ["getFile", "streamFile", "getFiles", "getSnapshot"]:  # Skip IO bound functions
+            return func(params)
+
+        if self.connection.cpu_time > 5:
+            self.connection.close("Cpu time: %.3fs" % self.connection.cpu_time)
+        s = time.time()
+        try:
+            return func(params)
+        finally:
+            taken = time.time() - s
+            taken_sent = self.connection.last_sent_time - self.connection.last_send_time
+            self.connection.cpu_time += taken - taken_sent
 
     # Update a site file request
     def actionUpdate(self, params):
@@ -246,15 +262,14 @@ class FileRequest(object):
                         "location": min(file.tell() + read_bytes, file_size),
                         "stream_bytes": min(read_bytes, file_size - params["location"])
                     }
-                    self.response(back)
-                    self.sendRawfile(file, read_bytes=read_bytes)
+                    self.response(back, rawfile=(file, read_bytes), site_address=site.address)
                 else:
                     back = {
                         "body": file,
                         "size": file_size,
                         "location": min(file.tell() + file.read_bytes, file_size)
                     }
-                    self.response(back, streaming=True)
+                    self.response(back, streaming=True, site_address=site.address)
 
                 bytes_sent = min(read_bytes, file_size - params["location"])  # Number of bytes we going to send
                 site.settings["bytes_sent"] = site.settings.get("bytes_sent", 0) + bytes_sent
@@ -287,6 +302,84 @@ class FileRequest(object):
     def actionStreamFile(self, params):
         return self.handleGetFile(params, streaming=True)
 
+    # Send multiple small files in one response, errors reported per file
+    def actionGetFiles(self, params):
+        site = self.sites.get(params["site"])
+        if not site or not site.isServing():  # Site unknown or not serving
+            self.response({"error": "Unknown site"})
+            self.connection.badAction(5)
+            return False
+
+        inner_paths = params.get("inner_paths")
+        if type(inner_paths) is not list or len(inner_paths) > GET_FILES_MAX_FILES:
+            self.response({"error": "Invalid inner_paths"})
+            self.connection.badAction(5)
+            return False
+        file_sizes = params.get("file_sizes") or []
+
+        files = []
+        bytes_left = GET_FILES_MAX_BYTES
+        for i, inner_path in enumerate(inner_paths):
+            try:
+                if bytes_left <= 0:
+                    raise RequestError("Batch size limit")
+                with site.storage.open(inner_path) as file:
+                    body = file.read(bytes_left + 1)
+                if len(body) > bytes_left:
+                    raise RequestError("Batch size limit")
+                if i < len(file_sizes) and file_sizes[i] and file_sizes[i] != len(body):
+                    raise RequestError("File size does not match: %sB != %sB" % (file_sizes[i], len(body)))
+                files.append({"inner_path": inner_path, "body": body})
+                bytes_left -= len(body)
+            except RequestError as err:
+                files.append({"inner_path": inner_path, "error": "File read error: %s" % err})
+            except Exception as err:
+                if config.verbose:
+                    self.log.debug("GetFiles %s read error: %s" % (inner_path, Debug.formatException(err)))
+                files.append({"inner_path": inner_path, "error": "File read error"})
+
+        bytes_sent = GET_FILES_MAX_BYTES - bytes_left
+        self.response({"files": files}, site_address=site.address)
+        site.settings["bytes_sent"] = site.settings.get("bytes_sent", 0) + bytes_sent
+
+        # Add peer to site if not added before
+        connected_peer = site.addPeer(self.connection.ip, self.connection.port, source="request")
+        if connected_peer:  # Just added
+            connected_peer.connect(self.connection)  # Assign current connection to peer
+
+        return {"bytes_sent": bytes_sent, "num_files": len(files)}
+
+    # Stream every content.json and file of the site in one compressed snapshot
+    def actionGetSnapshot(self, params):
+        site = self.sites.get(params["site"])
+        if not site or not site.isServing():  # Site unknown or not serving
+            self.response({"error": "Unknown site"})
+            self.connection.badAction(5)
+            return False
+
+        try:
+            snapshot = SiteSnapshot.getSnapshot(site)
+        except Exception as err:
+            self.log.error("GetSnapshot %s pack error: %s" % (site.address_short, Debug.formatException(err)))
+            self.response({"error": "Snapshot not available"})
+            return False
+
+        with snapshot.open() as file:
+            self.response({
+                "size": snapshot.size,
+                "num_files": snapshot.num_files,
+                "modified": snapshot.key[0],
+                "stream_bytes": snapshot.size
+            }, rawfile=(file, snapshot.size), site_address=site.address)
+        site.settings["bytes_sent"] = site.settings.get("bytes_sent", 0) + snapshot.size
+
+        # Add peer to site if not added before
+        connected_peer = site.addPeer(self.connection.ip, self.connection.port, source="request")
+        if connected_peer:  # Just added
+            connected_peer.connect(self.connection)  # Assign current connection to peer
+
+        return {"bytes_sent": snapshot.size, "num_files": snapshot.num_files}
+
     # Peer exchange request
     def actionPex(self, params):
         site = self.sites.get(params["site"])
@@ -366,9 +459,41 @@ class FileRequest(object):
         if not peer.connection:  # Just added
             peer.connect(self.connection)  # Assign current connection to peer
 
+        hashfield = site.content_manager.hashfield
         peer.time_my_hashfield_sent = time.time()  # Don't send again if not changed
+        peer.my_hashfield_version_sent = (hashfield.epoch, hashfield.version)
 
-        self.response({"hashfield_raw": site.content_manager.hashfield.tobytes()})
+        self.response({"hashfield_raw": hashfield.tobytes()})
+
+    # Send only the hashfield changes since the version the peer has, the full hashfield if not possible
+    def actionGetHashfieldDelta(self, params):
+        site = self.sites.get(params["site"])
+        if not site or not site.isServing():  # Site unknown or not serving
+            self.response({"error": "Unknown site"})
+            self.connection.badAction(5)
+            return False
+
+        # Add peer to site if not added before
+        peer = site.addPeer(self.connection.ip, self.connection.port, return_peer=True, source="request")
+        if not peer.connection:  # Just added
+            peer.connect(self.connection)  # Assign current connection to peer
+
+        hashfield = site.content_manager.hashfield
+        peer.time_my_hashfield_sent = time.time()  # Don't send again if not changed
+        peer.my_hashfield_version_sent = (hashfield.epoch, hashfield.version)
+
+        back = {"epoch": hashfield.epoch, "version": hashfield.version}
+        if params.get("epoch") is not None and params.get("epoch") == hashfield.epoch:
+            changes = hashfield.getChanges(params.get("since"))
+        else:
+            changes = None
+        if changes:
+            hash_ids_added, hash_ids_removed = changes
+            back["hashfield_added"] = PeerHashfield.packHashIds(hash_ids_added)
+            back["hashfield_removed"] = PeerHashfield.packHashIds(hash_ids_removed)
+        else:
+            back["hashfield_raw"] = hashfield.tobytes()
+        self.response(back)
 
     def findHashIds(self, site, hash_ids, limit=100):
         back = collections.defaultdict(lambda: collections.defaultdict(list))
@@ -389,24 +514,27 @@ class FileRequest(object):
             self.connection.badAction(5)
             return False
 
-        event_key = "%s_findHashIds_%s_%s" % (self.connection.ip, params["site"], len(params["hash_ids"]))
+        # Hashfields are bitmaps of 16bit hash ids, ignore anything else
+        hash_ids = [hash_id for hash_id in params["hash_ids"] if type(hash_id) is int and 0 <= hash_id <= 0xFFFF]
+
+        event_key = "%s_findHashIds_%s_%s" % (self.connection.ip, params["site"], len(hash_ids))
         if self.connection.cpu_time > 0.5 or not RateLimit.isAllowed(event_key, 60 * 5):
             time.sleep(0.1)
-            back = self.findHashIds(site, params["hash_ids"], limit=10)
+            back = self.findHashIds(site, hash_ids, limit=10)
         else:
-            back = self.findHashIds(site, params["hash_ids"])
+            back = self.findHashIds(site, hash_ids)
         RateLimit.called(event_key)
 
         my_hashes = []
-        my_hashfield_set = set(site.content_manager.hashfield)
-        for hash_id in params["hash_ids"]:
-            if hash_id in my_hashfield_set:
+        my_hashfield = site.content_manager.hashfield
+        for hash_id in hash_ids:
+            if hash_id in my_hashfield:
                 my_hashes.append(hash_id)
 
         if config.verbose:
             self.log.debug(
                 "Found: %s for %s hashids in %.3fs" %
-                ({key: len(val) for key, val in back.items()}, len(params["hash_ids"]), time.time() - s)
+                ({key: len(val) for key, val in back.items()}, len(hash_ids), time.time() - s)
             )
         self.response({"peers": back["ipv4"], "peers_onion": back["onion"], "peers_ipv6": back["ipv6"], "my": my_hashes})
 
@@ -421,7 +549,20 @@ class FileRequest(object):
         peer = site.addPeer(self.connection.ip, self.connection.port, return_peer=True, connection=self.connection, source="request")
         if not peer.connection:
             peer.connect(self.connection)
-        peer.hashfield.replaceFromBytes(params["hashfield_raw"])
+
+        hashfield = peer.hashfield
+        if "hashfield_raw" in params:
+            hashfield.replaceFromBytes(params["hashfield_raw"])
+        elif params.get("epoch") is not None and (params.get("epoch"), params.get("since")) == (hashfield.epoch, hashfield.version):
+            hashfield.applyChanges(
+                PeerHashfield.unpackHashIds(params["hashfield_added"]),
+                PeerHashfield.unpackHashIds(params["hashfield_removed"])
+            )
+        else:  # Changes are based on a version we don't have, ask for the full hashfield
+            self.response({"resync": True})
+            return False
+        hashfield.epoch = params.get("epoch")
+        hashfield.version = params.get("version", 0)
         self.response({"ok": "Updated"})
 
     # Send a simple Pong! answer
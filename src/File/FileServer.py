@@ -12,6 +12,7 @@ import util
 from util import helper
 from Config import config
 from .FileRequest import FileRequest
+from .RequestScheduler import RequestScheduler
 from Peer import PeerPortchecker
 from Site import SiteManager
 from Connection import ConnectionServer
@@ -21,6 +22,7 @@ from Debug import Debug
 
 @PluginManager.acceptPlugins
 class FileServer(ConnectionServer):
+    features = ("hashfield_delta", "get_files", "site_snapshot")
 
     def __init__(self, ip=config.fileserver_ip, port=config.fileserver_port, ip_type=config.fileserver_ip_type):
         self.site_manager = SiteManager.site_manager
@@ -68,6 +70,7 @@ class FileServer(ConnectionServer):
 
         self.sites = self.site_manager.sites
         self.last_request = time.time()
+        self.request_scheduler = RequestScheduler(self)  # Fair sharing of request handling between peers
         self.files_parsing = {}
         self.ui_server = None
 
@@ -0,0 +1,107 @@
+import time
+import heapq
+import itertools
+
+import gevent.event
+
+
+class RequestSchedulerBusy(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__("Over budget, retry after %.1fs" % retry_after)
+
+
+# Start-time fair queue for incoming request handlers
+# Every connection has a virtual time advanced by the cost (cpu time + bytes sent) of its handled requests.
+# When all slots are busy the waiting request with the lowest virtual time runs next,
+# so a peer sending requests in a loop can't delay the requests of other peers.
+# The caller is never blocked: queued requests wait for their slot in their own greenlet.
+class RequestScheduler(object):
+    num_slots = 10  # Max number of cpu bound handlers running at the same time
+    max_lag = 10.0  # Reject requests from peers this much cost ahead of others while there is contention
+    max_queued = 100  # Reject requests when this many are already waiting for a slot
+    io_cost = 1.0 / (10 * 1024 * 1024)  # Cost of a sent byte: 10MB = 1 sec cpu time
+    cmds_exempt = ("ping",)  # Cheap commands that never wait
+    cmds_io = ("getFile", "streamFile", "getFiles", "getSnapshot")  # Wait for the socket, not for a cpu slot
+
+    def __init__(self, server):
+        self.server = server
+        self.num_running = 0
+        self.queue = []  # Heap of [start tag, counter, event]
+        self.counter = itertools.count()
+        self.vtime = 0.0  # Start tag of the last started request
+        self.num_rejected = 0
+
+    def getWeight(self, connection):
+        if connection.ip in self.server.whitelist:
+            return 10.0
+        else:
+            return 1.0
+
+    def getCost(self, connection, cpu_time_before, bytes_sent_before):
+        return (connection.cpu_time - cpu_time_before) + (connection.bytes_sent - bytes_sent_before) * self.io_cost
+
+    # Run the request handler now if a slot is free, otherwise in a new greenlet when it gets its turn
+    # Return: Value returned by the handler or the greenlet of the queued handler
+    def run(self, connection, cmd, func, *args, **kwargs):
+        if cmd in self.cmds_exempt:
+            return func(*args, **kwargs)
+
+        start_tag = max(connection.sched_vtime, self.vtime)
+        lag = start_tag - self.vtime
+        if self.queue and lag > self.max_lag:
+            self.num_rejected += 1
+            raise RequestSchedulerBusy(lag - self.max_lag)
+
+        stat = self.server.stats.get(cmd)
+        if cmd in self.cmds_io:
+            self.server.stats.onQueued(stat, 0.0)
+            return self.runAccounted(connection, start_tag, func, args, kwargs, slot=False)
+
+        if self.num_running < self.num_slots:
+            self.num_running += 1
+            self.server.stats.onQueued(stat, 0.0)
+            return self.runAccounted(connection, start_tag, func, args, kwargs)
+
+        if len(self.queue) >= self.max_queued:
+            self.num_rejected += 1
+            raise RequestSchedulerBusy(1.0)
+
+        entry = [start_tag, next(self.counter), gevent.event.Event()]
+        heapq.heappush(self.queue, entry)
+        return gevent.spawn(self.runQueued, entry, connection, stat, func, args, kwargs)
+
+    def runQueued(self, entry, connection, stat, func, args, kwargs):
+        s = time.time()
+        event = entry[2]
+        try:
+            event.wait()  # Slot handed over by release()
+        except BaseException:  # Killed while waiting
+            if event.is_set():
+                self.release()
+            else:
+                entry[2] = None  # Skipped by release()
+            raise
+        self.server.stats.onQueued(stat, time.time() - s)
+        start_tag = max(connection.sched_vtime, self.vtime)
+        return self.runAccounted(connection, start_tag, func, args, kwargs)
+
+    def runAccounted(self, connection, start_tag, func, args, kwargs, slot=True):
+        self.vtime = max(self.vtime, start_tag)
+        cpu_time_before = connection.cpu_time
+        bytes_sent_before = connection.bytes_sent
+        try:
+            return func(*args, **kwargs)
+        finally:
+            cost = self.getCost(connection, cpu_time_before, bytes_sent_before)
+            connection.sched_vtime = max(connection.sched_vtime, start_tag + cost / self.getWeight(connection))
+            if slot:
+                self.release()
+
+    def release(self):
+        while self.queue:
+            start_tag, _, event = heapq.heappop(self.queue)
+            if event is not None:
+                event.set()  # Keep the slot for the next request
+                return
+        self.num_running -= 1
@@ -11,19 +11,40 @@ from Debug import Debug
 from Config import config
 from util import helper
 from .PeerHashfield import PeerHashfield
+from .PeerPerformance import PeerPerformance
 from Plugin import PluginManager
 
 if config.use_tempfiles:
     import tempfile
 
 
+# Write a pipelined file part response to its position in the download buffer
+class FilePartWriter(object):
+    __slots__ = ("file", "pos")
+
+    def __init__(self, file, pos):
+        self.file = file
+        self.pos = pos
+
+    def write(self, data):
+        if not self.file:  # Part abandoned
+            return
+        self.file.seek(self.pos)
+        self.file.write(data)
+        self.pos += len(data)
+
+    def tell(self):
+        return self.pos
+
+
 # Communicate remote peers
 @PluginManager.acceptPlugins
 class Peer(object):
     __slots__ = (
         "ip", "port", "site", "key", "connection", "connection_server", "time_found", "time_response", "time_hashfield",
-        "time_added", "has_hashfield", "is_tracker_connection", "time_my_hashfield_sent", "last_ping", "reputation",
-        "last_content_json_update", "hashfield", "connection_error", "hash_failed", "download_bytes", "download_time"
+        "time_added", "has_hashfield", "is_tracker_connection", "time_my_hashfield_sent", "my_hashfield_version_sent", "last_ping", "reputation",
+        "last_content_json_update", "_hashfield", "connection_error", "hash_failed", "download_bytes", "download_time",
+        "performance"
     )
 
     def __init__(self, ip, port, site=None, connection_server=None):
@@ -37,6 +58,7 @@ class Peer(object):
         self.has_hashfield = False  # Lazy hashfield object not created yet
         self.time_hashfield = None  # Last time peer's hashfiled downloaded
         self.time_my_hashfield_sent = None  # Last time my hashfield sent to peer
+        self.my_hashfield_version_sent = None  # Epoch and version of my hashfield the peer has
         self.time_found = time.time()  # Time of last found in the torrent tracker
         self.time_response = None  # Time of last successful response from peer
         self.time_added = time.time()
@@ -49,14 +71,25 @@ class Peer(object):
         self.hash_failed = 0  # Number of bad files from peer
         self.download_bytes = 0  # Bytes downloaded
         self.download_time = 0  # Time spent to download
+        self.performance = PeerPerformance()  # Moving averages of download speed, rtt and errors
 
-    def __getattr__(self, key):
-        if key == "hashfield":
-            self.has_hashfield = True
+    # Lazy hashfield object, registered to the site's hash id -> peers index
+    @property
+    def hashfield(self):
+        if not self.has_hashfield:
             self.hashfield = PeerHashfield()
-            return self.hashfield
-        else:
-            return getattr(self, key)
+        return self._hashfield
+
+    @hashfield.setter
+    def hashfield(self, hashfield):
+        if hashfield.on_change is not None and not (self.has_hashfield and self._hashfield is hashfield):
+            raise ValueError("Hashfield already registered to an other peer")
+        if self.site and self.has_hashfield:
+            self.site.hashfield_index.removePeer(self)
+        self._hashfield = hashfield
+        self.has_hashfield = True
+        if self.site:
+            self.site.hashfield_index.addPeer(self)
 
     def log(self, text):
         if not config.verbose:
@@ -188,8 +221,11 @@ class Peer(object):
         return None  # Failed after 3 attempts
 
     # Get a file content from peer
-    def getFile(self, site, inner_path, file_size=None, pos_from=0, pos_to=None, streaming=False):
-        if file_size and file_size > 5 * 1024 * 1024:
+    def getFile(self, site, inner_path, file_size=None, pos_from=0, pos_to=None, streaming=False, buff=None):
+        transfer = self.getTransferEstimator()
+        if transfer:
+            max_read_size = transfer.getReadBytes(file_size)
+        elif file_size and file_size > 5 * 1024 * 1024:
             max_read_size = 1024 * 1024
         else:
             max_read_size = 512 * 1024
@@ -201,25 +237,26 @@ class Peer(object):
 
         location = pos_from
 
-        if config.use_tempfiles:
-            buff = tempfile.SpooledTemporaryFile(max_size=16 * 1024, mode='w+b')
-        else:
-            buff = io.BytesIO()
+        if buff is None:  # No file-like object from the caller to download to
+            if config.use_tempfiles:
+                buff = tempfile.SpooledTemporaryFile(max_size=16 * 1024, mode='w+b')
+            else:
+                buff = io.BytesIO()
 
         s = time.time()
         while True:  # Read in smaller parts
-            if config.stream_downloads or read_bytes > 256 * 1024 or streaming:
-                res = self.request("streamFile", {"site": site, "inner_path": inner_path, "location": location, "read_bytes": read_bytes, "file_size": file_size}, stream_to=buff)
-                if not res or "location" not in res:  # Error
-                    return False
-            else:
-                self.log("Send: %s" % inner_path)
-                res = self.request("getFile", {"site": site, "inner_path": inner_path, "location": location, "read_bytes": read_bytes, "file_size": file_size})
-                if not res or "location" not in res:  # Error
-                    return False
-                self.log("Recv: %s" % inner_path)
-                buff.write(res["body"])
-                res["body"] = None  # Save memory
+            part_s = time.time()
+            res = self.getFilePart(site, inner_path, location, read_bytes, file_size, buff, streaming)
+            if not res:  # Error
+                if transfer:
+                    transfer.onStall()
+                self.performance.onError()
+                return False
+
+            part_speed = (res["location"] - location) / max(time.time() - part_s, 0.001)
+            if transfer:
+                transfer.onTransfer(res["location"] - location, time.time() - part_s, self.getPing())
+                max_read_size = transfer.getReadBytes(file_size)
 
             if res["location"] == res["size"] or res["location"] == pos_to:  # End of file
                 break
@@ -227,6 +264,32 @@ class Peer(object):
                 location = res["location"]
                 if pos_to:
                     read_bytes = min(max_read_size, pos_to - location)
+                else:
+                    read_bytes = max_read_size
+
+            if transfer and transfer.speed:
+                part_speed = transfer.speed
+            window = self.getDownloadWindow(max_read_size, part_speed)
+            if window > 1:
+                pipeline_s = time.time()
+                pipeline_location = location
+                res_pipelined, location = self.getFilePartsPipelined(
+                    site, inner_path, file_size, location, pos_to or res["size"], pos_from, max_read_size, window, buff, streaming
+                )
+                if res_pipelined:
+                    if transfer:
+                        transfer.onTransfer(location - pipeline_location, time.time() - pipeline_s, self.getPing())
+                    res = res_pipelined
+                    break
+                # Pipeline broken, continue one part at a time from the first missing part
+                if transfer:
+                    transfer.onStall()
+                    max_read_size = transfer.getReadBytes(file_size)
+                buff.seek(location - pos_from)
+                if pos_to:
+                    read_bytes = min(max_read_size, pos_to - location)
+                else:
+                    read_bytes = max_read_size
 
         if pos_to:
             recv = pos_to - pos_from
@@ -235,12 +298,141 @@ class Peer(object):
 
         self.download_bytes += recv
         self.download_time += (time.time() - s)
+        self.performance.onDownload(recv, time.time() - s, self.getPing())
         if self.site:
             self.site.settings["bytes_recv"] = self.site.settings.get("bytes_recv", 0) + recv
         self.log("Downloaded: %s, pos: %s, read_bytes: %s" % (inner_path, buff.tell(), read_bytes))
         buff.seek(0)
         return buff
 
+    # Download multiple small files in one request
+    # Return: {inner_path: buff, ...} of the received files, None on error
+    def getFiles(self, site, inner_paths, file_sizes=None):
+        s = time.time()
+        res = self.request("getFiles", {"site": site, "inner_paths": inner_paths, "file_sizes": file_sizes})
+        if not res or "files" not in res:
+            self.performance.onError()
+            return None
+
+        back = {}
+        recv = 0
+        for file in res["files"]:
+            if file.get("inner_path") not in inner_paths or file.get("body") is None:
+                continue  # File error or not requested
+            back[file["inner_path"]] = io.BytesIO(file["body"])
+            recv += len(file["body"])
+
+        self.download_bytes += recv
+        self.download_time += (time.time() - s)
+        self.performance.onDownload(recv, time.time() - s, self.getPing())
+        if self.site:
+            self.site.settings["bytes_recv"] = self.site.settings.get("bytes_recv", 0) + recv
+        self.log("Downloaded %s/%s files in batch (%s bytes)" % (len(back), len(inner_paths), recv))
+        return back
+
+    # Stream the whole site snapshot to loader
+    # Return: Response or None on error
+    def getSnapshot(self, site, loader):
+        s = time.time()
+        res = self.request("getSnapshot", {"site": site}, stream_to=loader)
+        if not res or "stream_bytes" not in res:
+            self.performance.onError()
+            return None
+
+        recv = res["stream_bytes"]
+        self.download_bytes += recv
+        self.download_time += (time.time() - s)
+        self.performance.onDownload(recv, time.time() - s, self.getPing())
+        if self.site:
+            self.site.settings["bytes_recv"] = self.site.settings.get("bytes_recv", 0) + recv
+        self.log("Downloaded snapshot: %s files (%s bytes)" % (res.get("num_files"), recv))
+        return res
+
+    # Request a part of file and write it to buff
+    # Return: Response or False on error
+    def getFilePart(self, site, inner_path, location, read_bytes, file_size, buff, streaming=False):
+        params = {"site": site, "inner_path": inner_path, "location": location, "read_bytes": read_bytes, "file_size": file_size}
+        if config.stream_downloads or read_bytes > 256 * 1024 or streaming:
+            res = self.request("streamFile", params, stream_to=buff)
+            if not res or "location" not in res:  # Error
+                return False
+        else:
+            self.log("Send: %s" % inner_path)
+            res = self.request("getFile", params)
+            if not res or "location" not in res:  # Error
+                return False
+            self.log("Recv: %s" % inner_path)
+            buff.write(res["body"])
+            res["body"] = None  # Save memory
+        return res
+
+    # Part size selection of the current connection
+    def getTransferEstimator(self):
+        if not self.connection or self.connection.closed:
+            return None
+        transfer = self.connection.transfer
+        transfer.seed(self.download_bytes, self.download_time)
+        return transfer
+
+    def getPing(self):
+        if self.connection:
+            return self.connection.last_ping_delay
+        else:
+            return None
+
+    # Number of file part requests to keep in flight to cover the bandwidth-delay product of the connection
+    def getDownloadWindow(self, read_bytes, speed):
+        if config.download_window <= 1 or not self.connection or not self.connection.last_ping_delay:
+            return 1
+        bandwidth_delay = speed * self.connection.last_ping_delay
+        return max(1, min(config.download_window, int(bandwidth_delay / read_bytes) + 2))
+
+    # Request the parts of file from location to pos_end keeping window number of requests in flight
+    # Return: (Last response or None on error, location of first part not downloaded)
+    def getFilePartsPipelined(self, site, inner_path, file_size, location, pos_end, pos_from, read_size, window, buff, streaming=False):
+        connection = self.connection
+        parts = [(part_from, min(read_size, pos_end - part_from)) for part_from in range(location, pos_end, read_size)]
+        self.log("Pipelined download: %s, parts: %s, window: %s" % (inner_path, len(parts), window))
+
+        def getPart(part_from, part_read_bytes, part_buff):
+            params = {"site": site, "inner_path": inner_path, "location": part_from, "read_bytes": part_read_bytes, "file_size": file_size}
+            if config.stream_downloads or part_read_bytes > 256 * 1024 or streaming:
+                res = connection.request("streamFile", params, stream_to=part_buff)
+            else:
+                res = connection.request("getFile", params)
+                if res and "body" in res:
+                    part_buff.write(res["body"])
+                    res["body"] = None  # Save memory
+            if not res or "location" not in res or res["location"] != part_from + part_read_bytes:
+                self.log("Pipelined download error at %s: %s" % (part_from, res and res.get("error")))
+                return None
+            return res
+
+        part_buffs = [FilePartWriter(buff, part_from - pos_from) for part_from, part_read_bytes in parts]
+        threads = collections.deque()
+        num_started = 0
+        num_done = 0
+        try:
+            while num_done < len(parts):
+                if num_started < len(parts) and len(threads) < window:
+                    part_from, part_read_bytes = parts[num_started]
+                    threads.append(gevent.spawn(getPart, part_from, part_read_bytes, part_buffs[num_started]))
+                    num_started += 1
+                    continue
+                res = threads.popleft().get()
+                if not res:
+                    return None, parts[num_done][0]
+                num_done += 1
+            self.time_response = time.time()
+        finally:
+            # Drop the data of the requests still in flight
+            for part_buff in part_buffs[num_done:]:
+                part_buff.file = None
+            gevent.killall(threads)
+
+        buff.seek(pos_end - pos_from)
+        return res, pos_end
+
     # Send a ping request
     def ping(self):
         response_time = None
@@ -316,13 +508,37 @@ class Peer(object):
             return False
 
         self.time_hashfield = time.time()
+        if self.hasFeature("hashfield_delta"):
+            return self.updateHashfieldDelta()
+
         res = self.request("getHashfield", {"site": self.site.address})
         if not res or "error" in res or "hashfield_raw" not in res:
             return False
         self.hashfield.replaceFromBytes(res["hashfield_raw"])
+        self.hashfield.epoch = None
 
         return self.hashfield
 
+    # Only download the hashfield changes since the last update
+    def updateHashfieldDelta(self):
+        hashfield = self.hashfield
+        res = self.request("getHashfieldDelta", {"site": self.site.address, "epoch": hashfield.epoch, "since": hashfield.version})
+        if not res or "error" in res:
+            return False
+        if "hashfield_raw" in res:
+            hashfield.replaceFromBytes(res["hashfield_raw"])
+        elif "hashfield_added" in res and "hashfield_removed" in res:
+            hashfield.applyChanges(
+                hashfield.unpackHashIds(res["hashfield_added"]),
+                hashfield.unpackHashIds(res["hashfield_removed"])
+            )
+        else:
+            return False
+        hashfield.epoch = res.get("epoch")
+        hashfield.version = res.get("version", 0)
+
+        return hashfield
+
     # Find peers for hashids
     # Return: {hash1: ["ip:port", "ip:port",...],...}
     def findHashIds(self, hash_ids):
@@ -358,16 +574,36 @@ class Peer(object):
     def sendMyHashfield(self):
         if self.connection and self.connection.handshake.get("rev", 0) < 510:
             return False  # Not supported
-        if self.time_my_hashfield_sent and self.site.content_manager.hashfield.time_changed <= self.time_my_hashfield_sent:
+        hashfield = self.site.content_manager.hashfield
+        if self.time_my_hashfield_sent and hashfield.time_changed <= self.time_my_hashfield_sent:
             return False  # Peer already has the latest hashfield
 
-        res = self.request("setHashfield", {"site": self.site.address, "hashfield_raw": self.site.content_manager.hashfield.tobytes()})
+        version = (hashfield.epoch, hashfield.version)
+        params = {"site": self.site.address, "epoch": hashfield.epoch, "version": hashfield.version}
+        changes = None
+        if self.my_hashfield_version_sent and self.my_hashfield_version_sent[0] == hashfield.epoch and self.hasFeature("hashfield_delta"):
+            changes = hashfield.getChanges(self.my_hashfield_version_sent[1])
+        if changes:  # Peer has an earlier version of my hashfield, send the difference
+            hash_ids_added, hash_ids_removed = changes
+            res = self.request("setHashfield", dict(
+                params,
+                since=self.my_hashfield_version_sent[1],
+                hashfield_added=hashfield.packHashIds(hash_ids_added),
+                hashfield_removed=hashfield.packHashIds(hash_ids_removed)
+            ))
+        if not changes or (res and res.get("resync")):
+            res = self.request("setHashfield", dict(params, hashfield_raw=hashfield.tobytes()))
+
         if not res or "error" in res:
             return False
         else:
             self.time_my_hashfield_sent = time.time()
+            self.my_hashfield_version_sent = version
             return True
 
+    def hasFeature(self, feature):
+        return bool(self.connection) and not self.connection.closed and self.connection.hasFeature(feature)
+
     def publish(self, address, inner_path, body, modified, diffs=[]):
         if len(body) > 10 * 1024 and self.connection and self.connection.handshake.get("rev", 0) >= 4095:
             # To save bw we don't push big content.json to peers
@@ -387,6 +623,9 @@ class Peer(object):
         if self.site and self.key in self.site.peers:
             del(self.site.peers[self.key])
 
+        if self.site and self.has_hashfield:
+            self.site.hashfield_index.removePeer(self)
+
         if self.site and self in self.site.peers_recent:
             self.site.peers_recent.remove(self)
 
@@ -1,52 +1,87 @@
 import array
+import collections
+import itertools
+import random
 import time
 
+bit_offsets = [tuple(bit for bit in range(8) if byte & (1 << bit)) for byte in range(256)]  # Byte value -> Set bits
 
+
+# Set of 16bit hash ids stored as a 65536 bit bitmap
+# Wire format (hashfield_raw) is still the array of uint16 hash ids, converted on tobytes/frombytes
 class PeerHashfield(object):
-    __slots__ = ("storage", "time_changed", "append", "remove", "tobytes", "frombytes", "__len__", "__iter__")
-    def __init__(self):
-        self.storage = self.createStorage()
+    __slots__ = ("bitmap", "num", "time_changed", "raw", "on_change", "epoch", "version", "changes")
+    size = 65536 // 8  # Bytes of the bitmap
+    max_changes = 1000  # Length of the change log used for delta sync
+
+    def __init__(self, hash_ids=()):
+        self.bitmap = bytearray(self.size)
+        self.num = 0
         self.time_changed = time.time()
+        self.raw = None  # Cached wire format
+        self.on_change = None  # Called with the added and removed hash ids
+        self.epoch = None  # Random id of the change log, versions are only comparable within the same epoch
+        self.version = 0  # Number of changes in the epoch
+        self.changes = None  # Change log of (hash_id, is_added), only kept if enableChangelog() called
+        for hash_id in hash_ids:
+            self.append(hash_id)
 
-    def createStorage(self):
-        storage = array.array("H")
-        self.append = storage.append
-        self.remove = storage.remove
-        self.tobytes = storage.tobytes
-        self.frombytes = storage.frombytes
-        self.__len__ = storage.__len__
-        self.__iter__ = storage.__iter__
-        return storage
+    def __len__(self):
+        return self.num
 
-    def appendHash(self, hash):
-        hash_id = int(hash[0:4], 16)
-        if hash_id not in self.storage:
-            self.storage.append(hash_id)
-            self.time_changed = time.time()
-            return True
-        else:
+    def __contains__(self, hash_id):
+        return bool(self.bitmap[hash_id >> 3] & (1 << (hash_id & 7)))
+
+    # Yield hash ids in ascending order, skipping empty 64bit words
+    def __iter__(self):
+        if not self.num:
+            return
+        bitmap = self.bitmap
+        for word_pos, word in enumerate(array.array("Q", bytes(bitmap))):
+            if not word:
+                continue
+            for pos in range(word_pos * 8, word_pos * 8 + 8):
+                byte = bitmap[pos]
+                if byte:
+                    for bit in bit_offsets[byte]:
+                        yield pos * 8 + bit
+
+    # Add without updating the change time (compatible with the array based storage)
+    def append(self, hash_id):
+        pos = hash_id >> 3
+        mask = 1 << (hash_id & 7)
+        if self.bitmap[pos] & mask:
             return False
+        self.bitmap[pos] |= mask
+        self.num += 1
+        self.onChanged((hash_id,), ())
+        return True
+
+    def remove(self, hash_id):
+        pos = hash_id >> 3
+        mask = 1 << (hash_id & 7)
+        if not self.bitmap[pos] & mask:
+            raise ValueError("Hash id %s not in hashfield" % hash_id)
+        self.bitmap[pos] &= ~mask
+        self.num -= 1
+        self.onChanged((), (hash_id,))
+
+    def appendHash(self, hash):
+        return self.appendHashId(int(hash[0:4], 16))
 
     def appendHashId(self, hash_id):
-        if hash_id not in self.storage:
-            self.storage.append(hash_id)
+        if self.append(hash_id):
             self.time_changed = time.time()
             return True
         else:
             return False
 
     def removeHash(self, hash):
-        hash_id = int(hash[0:4], 16)
-        if hash_id in self.storage:
-            self.storage.remove(hash_id)
-            self.time_changed = time.time()
-            return True
-        else:
-            return False
+        return self.removeHashId(int(hash[0:4], 16))
 
     def removeHashId(self, hash_id):
-        if hash_id in self.storage:
-            self.storage.remove(hash_id)
+        if hash_id in self:
+            self.remove(hash_id)
             self.time_changed = time.time()
             return True
         else:
@@ -56,20 +91,126 @@ class PeerHashfield(object):
         return int(hash[0:4], 16)
 
     def hasHash(self, hash):
-        return int(hash[0:4], 16) in self.storage
+        return int(hash[0:4], 16) in self
+
+    def tobytes(self):
+        if self.raw is None:
+            self.raw = self.packHashIds(self)
+        return self.raw
+
+    # Add hash ids from wire format
+    def frombytes(self, hashfield_raw):
+        self.loadBytes(hashfield_raw, bytearray(self.bitmap))
 
     def replaceFromBytes(self, hashfield_raw):
-        self.storage = self.createStorage()
-        self.storage.frombytes(hashfield_raw)
+        self.loadBytes(hashfield_raw, bytearray(self.size))
+        self.time_changed = time.time()
+
+    def loadBytes(self, hashfield_raw, bitmap):
+        for hash_id in self.unpackHashIds(hashfield_raw):
+            bitmap[hash_id >> 3] |= 1 << (hash_id & 7)
+
+        bits_before = self.toInt()
+        self.bitmap = bitmap
+        bits = self.toInt()
+        self.num = bin(bits).count("1")
+        if self.on_change or self.changes is not None:
+            self.onChanged(self.fromInt(bits & ~bits_before), self.fromInt(bits_before & ~bits))
+        else:
+            self.raw = None
+
+    def onChanged(self, hash_ids_added, hash_ids_removed):
+        self.raw = None
+        if self.changes is not None:
+            for hash_id in hash_ids_added:
+                self.changes.append((hash_id, True))
+                self.version += 1
+            for hash_id in hash_ids_removed:
+                self.changes.append((hash_id, False))
+                self.version += 1
+        if self.on_change:
+            self.on_change(hash_ids_added, hash_ids_removed)
+
+    # Keep log of the changes to allow sending only the difference to peers
+    def enableChangelog(self):
+        self.epoch = random.getrandbits(32)
+        self.version = 0
+        self.changes = collections.deque(maxlen=self.max_changes)
+
+    # Return: Hash ids added and removed since the version or None if it's no longer in the change log
+    def getChanges(self, since):
+        if self.changes is None or type(since) is not int:
+            return None
+        num_changes = self.version - since
+        if num_changes < 0 or num_changes > len(self.changes):
+            return None
+        is_added = {}
+        for hash_id, added in itertools.islice(self.changes, len(self.changes) - num_changes, None):
+            is_added[hash_id] = added  # Only the last change of the hash id matters
+        hash_ids_added = [hash_id for hash_id, added in is_added.items() if added]
+        hash_ids_removed = [hash_id for hash_id, added in is_added.items() if not added]
+        return hash_ids_added, hash_ids_removed
+
+    # Apply the changes received from the peer
+    def applyChanges(self, hash_ids_added, hash_ids_removed):
+        for hash_id in hash_ids_added:
+            self.append(hash_id)
+        for hash_id in hash_ids_removed:
+            if hash_id in self:
+                self.remove(hash_id)
         self.time_changed = time.time()
 
+    def toInt(self):
+        return int.from_bytes(self.bitmap, "little")
+
+    @classmethod
+    def fromInt(cls, bits):
+        hashfield = cls()
+        hashfield.bitmap = bytearray(bits.to_bytes(cls.size, "little"))
+        hashfield.num = bin(bits).count("1")
+        return hashfield
+
+    # Return: New hashfield with the hash ids present in both
+    def intersection(self, other):
+        return self.fromInt(self.toInt() & other.toInt())
+
+    def union(self, other):
+        return self.fromInt(self.toInt() | other.toInt())
+
+    def countIntersection(self, other):
+        return bin(self.toInt() & other.toInt()).count("1")
+
+    __and__ = intersection
+    __or__ = union
+
+    @staticmethod
+    def packHashIds(hash_ids):
+        return array.array("H", hash_ids).tobytes()
+
+    @staticmethod
+    def unpackHashIds(hash_ids_raw):
+        hash_ids = array.array("H")
+        hash_ids.frombytes(hash_ids_raw)
+        return hash_ids
+
+
 if __name__ == "__main__":
     field = PeerHashfield()
     s = time.time()
     for i in range(10000):
         field.appendHashId(i)
-    print(time.time()-s)
+    print("Append: %.3fs" % (time.time() - s))
     s = time.time()
     for i in range(10000):
         field.hasHash("AABB")
-    print(time.time()-s)
\ No newline at end of file
+    print("Has: %.3fs" % (time.time() - s))
+    other = PeerHashfield(range(5000, 60000, 3))
+    s = time.time()
+    for i in range(1000):
+        field.countIntersection(other)
+    print("Count intersection: %.3fs" % (time.time() - s))
+    s = time.time()
+    for i in range(100):
+        other.raw = None
+        field.replaceFromBytes(other.tobytes())
+    print("Wire roundtrip: %.3fs" % (time.time() - s))
@@ -0,0 +1,85 @@
+import functools
+import heapq
+
+
+# Hash id -> peers having it in their hashfield
+# Every peer gets a slot number and the peers of a hash id are stored as a bitset of the slots,
+# so the index takes at most 65536 small ints and lookups don't touch the other peers' hashfields.
+# Kept up to date by the on_change callback of the peers' hashfields.
+class PeerHashfieldIndex(object):
+    def __init__(self):
+        self.hash_peers = {}  # Hash id -> Bitset of peer slots
+        self.peer_slots = {}  # Peer -> Slot
+        self.slot_peers = []  # Slot -> Peer
+        self.free_slots = []  # Heap of released slots, lowest reused first
+
+    def __len__(self):
+        return len(self.hash_peers)
+
+    def __contains__(self, peer):
+        return peer in self.peer_slots
+
+    def addPeer(self, peer):
+        if peer in self.peer_slots:
+            self.removePeer(peer)
+        if self.free_slots:
+            slot = heapq.heappop(self.free_slots)
+            self.slot_peers[slot] = peer
+        else:
+            slot = len(self.slot_peers)
+            self.slot_peers.append(peer)
+        self.peer_slots[peer] = slot
+
+        hashfield = peer.hashfield
+        hashfield.on_change = functools.partial(self.onHashfieldChanged, peer)
+        self.onHashfieldChanged(peer, hashfield, ())
+
+    def removePeer(self, peer):
+        if peer not in self.peer_slots:
+            return False
+        hashfield = peer.hashfield
+        hashfield.on_change = None
+        self.onHashfieldChanged(peer, (), hashfield)
+        slot = self.peer_slots.pop(peer)
+        self.slot_peers[slot] = None
+        heapq.heappush(self.free_slots, slot)
+        return True
+
+    def onHashfieldChanged(self, peer, hash_ids_added, hash_ids_removed):
+        slot = self.peer_slots.get(peer)
+        if slot is None:
+            return
+        hash_peers = self.hash_peers
+        mask = 1 << slot
+        for hash_id in hash_ids_added:
+            hash_peers[hash_id] = hash_peers.get(hash_id, 0) | mask
+        for hash_id in hash_ids_removed:
+            bits = hash_peers.get(hash_id, 0) & ~mask
+            if bits:
+                hash_peers[hash_id] = bits
+            else:
+                hash_peers.pop(hash_id, None)
+
+    # Return: Peers having the hash id, in the order they were added to the index
+    def getPeers(self, hash_id, limit=0):
+        bits = self.hash_peers.get(hash_id)
+        back = []
+        while bits:
+            bit = bits & -bits
+            back.append(self.slot_peers[bit.bit_length() - 1])
+            if limit and len(back) >= limit:
+                break
+            bits ^= bit
+        return back
+
+    def getNumPeers(self, hash_id):
+        return bin(self.hash_peers.get(hash_id, 0)).count("1")
+
+    # Return: {hash_id: [peer1, peer2...], ...} for the hash ids with any peer
+    def findPeers(self, hash_ids, limit=0):
+        back = {}
+        for hash_id in hash_ids:
+            peers = self.getPeers(hash_id, limit=limit)
+            if peers:
+                back[hash_id] = peers
+        return back
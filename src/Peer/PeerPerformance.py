@@ -0,0 +1,60 @@
+import time
+
+
+# Download performance model of a peer, updated after every file download from it
+# Moving averages of throughput, round trip time, request errors and bad files received
+class PeerPerformance(object):
+    __slots__ = ("speed", "rtt", "error_rate", "hash_fail_rate", "num_samples", "time_last_sample")
+
+    weight = 0.3  # Weight of a new sample in the moving averages
+    default_speed = 256 * 1024  # Assumed speed of peers not downloaded from yet, keeps new peers worth trying
+    default_rtt = 0.5
+    min_sample_bytes = 16 * 1024  # Smaller downloads are dominated by the round trip time
+
+    def __init__(self):
+        self.speed = 0.0  # Bytes/sec
+        self.rtt = 0.0  # Sec
+        self.error_rate = 0.0  # 0..1 ratio of failed downloads
+        self.hash_fail_rate = 0.0  # 0..1 ratio of files failed verification
+        self.num_samples = 0
+        self.time_last_sample = 0
+
+    def __repr__(self):
+        return "<PeerPerformance speed: %.0fkB/s, rtt: %.3fs, errors: %.2f, hash failed: %.2f>" % (
+            self.speed / 1024, self.rtt, self.error_rate, self.hash_fail_rate
+        )
+
+    def average(self, value, sample):
+        return value * (1 - self.weight) + sample * self.weight
+
+    def onDownload(self, bytes_recv, time_taken, ping=None):
+        time_taken = max(time_taken, 0.001)
+        if bytes_recv >= self.min_sample_bytes:
+            speed = bytes_recv / time_taken
+            self.speed = self.average(self.speed, speed) if self.speed else speed
+        if ping:
+            rtt = ping
+        elif bytes_recv < self.min_sample_bytes:
+            rtt = time_taken
+        else:
+            rtt = None
+        if rtt:
+            self.rtt = self.average(self.rtt, rtt) if self.rtt else rtt
+        self.error_rate = self.average(self.error_rate, 0)
+        self.num_samples += 1
+        self.time_last_sample = time.time()
+
+    def onError(self):
+        self.error_rate = self.average(self.error_rate, 1)
+        self.num_samples += 1
+        self.time_last_sample = time.time()
+
+    def onVerify(self, valid):
+        self.hash_fail_rate = self.average(self.hash_fail_rate, 0 if valid else 1)
+
+    # Return: Expected seconds to successfully download size bytes from the peer, retries included
+    def getTime(self, size=0, ping=None):
+        rtt = self.rtt or ping or self.default_rtt
+        speed = self.speed or self.default_speed
+        time_download = rtt + (size or 0) / speed
+        return time_download / max(0.05, 1 - self.error_rate) / max(0.05, 1 - self.hash_fail_rate)
@@ -1,2 +1,4 @@
 from .Peer import Peer
 from .PeerHashfield import PeerHashfield
+from .PeerHashfieldIndex import PeerHashfieldIndex
+from .PeerPerformance import PeerPerformance
@@ -7,6 +7,7 @@ import random
 import sys
 import hashlib
 import collections
+import heapq
 import base64
 from pathlib import Path
 
@@ -16,9 +17,11 @@ import gevent.pool
 import util
 from Config import config
 from Peer import Peer
+from Peer import PeerHashfieldIndex
 from Worker import WorkerManager
 from Debug import Debug
 from Content import ContentManager
+from Content.ContentVerifier import ContentVerifier
 from .SiteStorage import SiteStorage
 from Crypt import CryptHash
 from util import helper
@@ -27,6 +30,7 @@ from util import GreenletManager
 from Plugin import PluginManager
 from File import FileServer
 from .SiteAnnouncer import SiteAnnouncer
+from . import SiteSnapshot
 from . import SiteManager
 
 
@@ -44,6 +48,7 @@ class Site(object):
 
         self.content = None  # Load content.json
         self.peers = {}  # Key: ip:port, Value: Peer.Peer
+        self.hashfield_index = PeerHashfieldIndex()  # Hash id -> Peers having the optional file
         self.peers_recent = collections.deque(maxlen=150)
         self.peer_blacklist = SiteManager.peer_blacklist  # Ignore this peers (eg. myself)
         self.greenlet_manager = GreenletManager.GreenletManager()  # Running greenlets
@@ -207,42 +212,55 @@ class Site(object):
         # Start download files
         file_threads = []
         if download_files:
-            for file_relative_path in list(self.content_manager.contents[inner_path].get("files", {}).keys()):
-                file_inner_path = content_inner_dir + file_relative_path
+            file_relative_paths = list(self.content_manager.contents[inner_path].get("files", {}).keys())
 
-                # Try to diff first
-                diff_success = False
+            # Try to diff first, the patched files verified in parallel
+            patched_files = {}
+            for file_relative_path in file_relative_paths:
+                file_inner_path = content_inner_dir + file_relative_path
                 diff_actions = diffs.get(file_relative_path)
                 if diff_actions and self.bad_files.get(file_inner_path):
                     try:
                         s = time.time()
                         new_file = Diff.patch(self.storage.open(file_inner_path, "rb"), diff_actions)
                         new_file.seek(0)
-                        time_diff = time.time() - s
+                        patched_files[file_inner_path] = (new_file, time.time() - s)
+                    except Exception as err:
+                        self.log.debug("DownloadContent Failed to patch %s: %s" % (file_inner_path, err))
+
+            diff_success_files = set()
+            if patched_files:
+                s = time.time()
+                verify_jobs = [(file_inner_path, new_file) for file_inner_path, (new_file, time_diff) in patched_files.items()]
+                verify_results = list(ContentVerifier(self.content_manager).verifyFiles(verify_jobs))
+                time_verify = time.time() - s
 
+                for file_inner_path, diff_success, error in verify_results:
+                    if not diff_success:
+                        self.log.debug("DownloadContent Failed to patch %s: %s" % (file_inner_path, error))
+                        continue
+                    new_file, time_diff = patched_files[file_inner_path]
+                    try:
                         s = time.time()
-                        diff_success = self.content_manager.verifyFile(file_inner_path, new_file)
-                        time_verify = time.time() - s
-
-                        if diff_success:
-                            s = time.time()
-                            new_file.seek(0)
-                            self.storage.write(file_inner_path, new_file)
-                            time_write = time.time() - s
-
-                            s = time.time()
-                            self.onFileDone(file_inner_path)
-                            time_on_done = time.time() - s
-
-                            self.log.debug(
-                                "DownloadContent Patched successfully: %s (diff: %.3fs, verify: %.3fs, write: %.3fs, on_done: %.3fs)" %
-                                (file_inner_path, time_diff, time_verify, time_write, time_on_done)
-                            )
+                        new_file.seek(0)
+                        self.storage.write(file_inner_path, new_file)
+                        time_write = time.time() - s
+
+                        s = time.time()
+                        self.onFileDone(file_inner_path)
+                        time_on_done = time.time() - s
+
+                        self.log.debug(
+                            "DownloadContent Patched successfully: %s (diff: %.3fs, verify: %.3fs, write: %.3fs, on_done: %.3fs)" %
+                            (file_inner_path, time_diff, time_verify, time_write, time_on_done)
+                        )
+                        diff_success_files.add(file_inner_path)
                     except Exception as err:
                         self.log.debug("DownloadContent Failed to patch %s: %s" % (file_inner_path, err))
-                        diff_success = False
 
-                if not diff_success:
+            for file_relative_path in file_relative_paths:
+                file_inner_path = content_inner_dir + file_relative_path
+                if file_inner_path not in diff_success_files:
                     # Start download and dont wait for finish, return the event
                     res = self.needFile(file_inner_path, blocking=False, update=self.bad_files.get(file_inner_path), peer=peer)
                     if res is not True and res is not False:  # Need downloading and file is allowed
@@ -353,6 +371,9 @@ class Site(object):
             if not valid:
                 return False  # Cant download content.jsons or size is not fits
 
+        if config.download_snapshot and self.isSnapshotWanted():
+            self.downloadSnapshot()
+
         # Download everything
         valid = self.downloadContent("content.json", check_modifications=blind_includes)
 
@@ -362,6 +383,38 @@ class Site(object):
 
         return valid
 
+    # First download of the site: none of the files of the root content.json present yet
+    def isSnapshotWanted(self):
+        if self.settings.get("own") or not self.isAddedRecently():
+            return False
+        content = self.content_manager.contents.get("content.json")
+        if not content:
+            return True
+        return not any(self.storage.isFile(relative_path) for relative_path in content.get("files", {}))
+
+    # Load every content.json and file a peer has in one compressed stream, verified while received
+    # Files missing from the snapshot or failed to verify are left in bad_files for the normal download
+    # Return: Number of files loaded
+    def downloadSnapshot(self, max_tries=3):
+        if not self.needFile("content.json"):  # Also connects to the peers
+            return 0
+        self.content_manager.loadContent("content.json", load_includes=False)
+
+        peers = [peer for peer in self.getConnectedPeers() if peer.hasFeature("site_snapshot")]
+        peers.sort(key=lambda peer: peer.performance.getTime(ping=peer.getPing()))
+        for peer in peers[0:max_tries]:
+            s = time.time()
+            loader = SiteSnapshot.SiteSnapshotLoader(self)
+            res = peer.getSnapshot(self.address, loader)
+            self.log.debug("Snapshot from %s in %.3fs: %s" % (peer.key, time.time() - s, loader))
+            if res and not loader.error:
+                break
+        else:
+            return 0
+
+        self.saveSettings()
+        return loader.num_loaded
+
     def pooledDownloadContent(self, inner_paths, pool_size=100, only_if_bad=False):
         self.log.debug("New downloadContent pool: len: %s, only if bad: %s" % (len(inner_paths), only_if_bad))
         self.worker_manager.started_task_num += len(inner_paths)
@@ -914,8 +967,9 @@ class Site(object):
             if not allow_private and helper.isPrivateIp(peer.ip):
                 continue
             found.append(peer)
-            if len(found) >= need_num:
-                break  # Found requested number of peers
+
+        if len(found) > need_num:  # Prefer the peers with lower response time and error rate
+            found = heapq.nsmallest(need_num, found, key=lambda peer: peer.performance.getTime(ping=peer.getPing()))
 
         if len(found) < need_num:  # Return not that good peers
             found += [
@@ -1080,8 +1134,10 @@ class Site(object):
         num_workers = self.worker_manager.stopWorkers()
         SiteManager.site_manager.delete(self.address)
         self.content_manager.contents.db.deleteSite(self)
+        self.content_manager.contents.clearCache()
         self.updateWebsocket(deleted=True)
         self.storage.deleteFiles()
+        SiteSnapshot.deleteSnapshot(self)
         self.log.info(
             "Deleted site in %.3fs (greenlets: %s, workers: %s)" %
             (time.time() - s, num_greenlets, num_workers)
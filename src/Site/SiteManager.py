@@ -15,6 +15,7 @@ from util import helper
 from util import RateLimit
 from util import Cached
 from Debug import Debug
+from . import SiteSnapshot
 
 @PluginManager.acceptPlugins
 class SiteManager(object):
@@ -36,6 +37,10 @@ class SiteManager(object):
         address_found = []
         added = 0
         load_s = time.time()
+        if startup:
+            num_deleted = SiteSnapshot.cleanupSnapshots()
+            if num_deleted:
+                self.log.debug("Deleted %s snapshots of the previous run" % num_deleted)
         # Load new adresses
         try:
             json_path = config.private_dir / 'sites.json'
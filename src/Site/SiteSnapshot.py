@@ -0,0 +1,207 @@
+import io
+import os
+import time
+import zlib
+import tempfile
+
+from Config import config
+from Debug import Debug
+from util import Msgpack
+from util import ThreadPool
+from util import helper
+import util
+
+SNAPSHOT_MAX_SIZE = 50 * 1024 * 1024  # Max uncompressed size of the files packed into a snapshot
+SNAPSHOT_MAX_FILE_SIZE = 1024 * 1024  # Bigger files are left for the normal, pipelined download
+
+thread_pool_pack = ThreadPool.ThreadPool(1, name="Snapshot pack")
+
+snapshots = {}  # Site address: Last packed snapshot
+
+
+# Site snapshot: every content.json and its files in one zlib compressed stream of msgpack [inner_path, body] entries
+# Parents come before the content.json files they include, every content.json before its files, so the
+# downloader is able to verify each entry as soon as it arrives
+class SiteSnapshot(object):
+    def __init__(self, key, path, size, num_files):
+        self.key = key
+        self.path = path
+        self.size = size  # Compressed size
+        self.num_files = num_files
+        self.time_packed = time.time()
+
+    def __repr__(self):
+        return "<SiteSnapshot %s (%s files, %sB)>" % (self.path, self.num_files, self.size)
+
+    def open(self):
+        return open(self.path, "rb")
+
+    def delete(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+# Return: [(inner_path, file_path), ...] of the files to pack, content.json files ordered parents first
+def getSnapshotFiles(site, max_size=SNAPSHOT_MAX_SIZE, max_file_size=SNAPSHOT_MAX_FILE_SIZE):
+    files = []
+    size = 0
+    content_inner_paths = sorted(site.content_manager.contents.keys(), key=lambda inner_path: (inner_path.count("/"), inner_path))
+    for content_inner_path in content_inner_paths:
+        content = site.content_manager.contents.get(content_inner_path)
+        if not content or content_inner_path in site.bad_files or not site.storage.isFile(content_inner_path):
+            continue
+        content_size = site.storage.getSize(content_inner_path)
+        if size + content_size > max_size:
+            break
+        files.append((content_inner_path, str(site.storage.getPath(content_inner_path))))
+        size += content_size
+
+        content_inner_dir = helper.getDirname(content_inner_path)
+        for relative_path, file_info in content.get("files", {}).items():
+            file_inner_path = content_inner_dir + relative_path
+            file_size = file_info.get("size", 0)
+            if file_size > max_file_size or file_inner_path in site.bad_files:
+                continue
+            if size + file_size > max_size:
+                continue  # Still try to pack the smaller ones
+            files.append((file_inner_path, str(site.storage.getPath(file_inner_path))))
+            size += file_size
+    return files
+
+
+@thread_pool_pack.wrap
+def packSnapshot(file, files):
+    compressor = zlib.compressobj(6)
+    num_packed = 0
+    for inner_path, file_path in files:
+        try:
+            with open(file_path, "rb") as packed_file:
+                body = packed_file.read()
+        except OSError:
+            continue  # Deleted meanwhile
+        file.write(compressor.compress(Msgpack.pack([inner_path, body])))
+        num_packed += 1
+    file.write(compressor.flush())
+    return num_packed
+
+
+def getSnapshotDir():
+    return config.data_dir / ".cache" / "snapshots"
+
+
+# Delete the snapshot files left behind by a previous run
+# Return: Number of deleted files
+def cleanupSnapshots():
+    in_use = set(snapshot.path for snapshot in snapshots.values())
+    num_deleted = 0
+    for path in getSnapshotDir().glob("snapshot-*"):
+        if str(path) in in_use:
+            continue
+        try:
+            path.unlink()
+            num_deleted += 1
+        except OSError:
+            pass
+    return num_deleted
+
+
+# Return: Snapshot of the site's current state, packed again only if the site changed since the last one
+@util.Noparallel()
+def getSnapshot(site):
+    key = (site.settings.get("modified", 0), len(site.content_manager.contents))
+    snapshot = snapshots.get(site.address)
+    if snapshot and snapshot.key == key and os.path.isfile(snapshot.path):
+        return snapshot
+
+    s = time.time()
+    files = getSnapshotFiles(site)
+    snapshot_dir = getSnapshotDir()
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix="snapshot-%s-" % site.address, dir=snapshot_dir)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            num_files = packSnapshot(file, files)
+    except Exception:
+        os.unlink(path)
+        raise
+
+    if snapshot:
+        snapshot.delete()  # Already opened copies are still readable
+    snapshot = SiteSnapshot(key, path, os.path.getsize(path), num_files)
+    snapshots[site.address] = snapshot
+    site.log.debug("Packed %s in %.3fs" % (snapshot, time.time() - s))
+    return snapshot
+
+
+def deleteSnapshot(site):
+    snapshot = snapshots.pop(site.address, None)
+    if snapshot:
+        snapshot.delete()
+
+
+# File-like object to stream a snapshot to: verifies and stores the entries while the data arrives
+# Invalid entries are skipped and left for the normal download, the stream never gets interrupted
+class SiteSnapshotLoader(object):
+    max_chunk = 1024 * 1024  # Max bytes decompressed at once
+
+    def __init__(self, site):
+        self.site = site
+        self.log = site.log
+        self.decompressor = zlib.decompressobj()
+        self.unpacker = Msgpack.getUnpacker(decode=False)
+        self.bytes_recv = 0
+        self.num_loaded = 0
+        self.num_skipped = 0
+        self.num_failed = 0
+        self.error = None
+
+    def __repr__(self):
+        return "<SiteSnapshotLoader loaded: %s, skipped: %s, failed: %s, recv: %sB, error: %s>" % (
+            self.num_loaded, self.num_skipped, self.num_failed, self.bytes_recv, self.error
+        )
+
+    def tell(self):
+        return self.bytes_recv
+
+    def write(self, data):
+        data_len = len(data)
+        self.bytes_recv += data_len
+        if self.error:
+            return data_len
+        try:
+            data = self.decompressor.decompress(data, self.max_chunk)
+            while True:
+                self.unpacker.feed(data)
+                for inner_path, body in self.unpacker:
+                    self.loadFile(inner_path, body)
+                if not self.decompressor.unconsumed_tail:
+                    break
+                data = self.decompressor.decompress(self.decompressor.unconsumed_tail, self.max_chunk)
+        except Exception as err:
+            self.log.debug("Snapshot load error: %s" % Debug.formatException(err))
+            self.error = err
+        return data_len
+
+    def loadFile(self, inner_path, body):
+        site = self.site
+        if site.storage.isFile(inner_path) and inner_path not in site.bad_files:
+            self.num_skipped += 1  # Already have it
+            return False
+
+        try:
+            valid = site.content_manager.verifyFile(inner_path, io.BytesIO(body), ignore_same=False)
+        except Exception as err:
+            valid = False
+            self.log.debug("Snapshot %s verify error: %s" % (inner_path, err))
+        if not valid:
+            self.num_failed += 1
+            return False
+
+        site.storage.write(inner_path, body)
+        if inner_path.endswith("content.json"):
+            site.content_manager.loadContent(inner_path, load_includes=False)
+        site.onFileDone(inner_path)
+        self.num_loaded += 1
+        return True
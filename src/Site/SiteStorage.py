@@ -4,19 +4,25 @@ import shutil
 import json
 import time
 import errno
+import hashlib
 from collections import defaultdict
 from pathlib import Path
 
 import sqlite3
+import msgpack
 import gevent.event
 
 import util
 from util import SafeRe
 from Db.Db import Db
+from Crypt import CryptHash
+from Content.ContentVerifier import ContentVerifier
 from Debug import Debug
 from Config import config
 from util import helper
+from util import Msgpack
 from util import ThreadPool
+from util.DownloadFile import DownloadFile
 from Plugin import PluginManager
 from Translate import translate as _
 
@@ -34,6 +40,8 @@ class SiteStorage(object):
         self.site = site
         self.directory = config.data_dir / self.site.address  # Site data diretory
         self.allowed_dir = os.path.abspath(self.directory)  # Only serve file within this dir
+        self.json_cache_dir = config.data_dir / ".cache" / self.site.address  # Parsed content.json files in msgpack format
+        self.download_dir = self.json_cache_dir / "download"  # Files being downloaded, left behind only by a crash
         self.log = site.log
         self.db = None  # Db class
         self.db_checked = False  # Checked db tables since startup
@@ -46,6 +54,8 @@ class SiteStorage(object):
             else:
                 raise Exception("Directory not exists: %s" % self.directory)
 
+        shutil.rmtree(self.download_dir, ignore_errors=True)
+
     def getDbFile(self):
         if self.db:
             return self.db.schema["db_file"]
@@ -286,6 +296,18 @@ class SiteStorage(object):
         self.writeThread(inner_path, content)
         self.onUpdated(inner_path)
 
+    # Temporary file in the site's download dir, hashed while written
+    def openDownload(self, inner_path):
+        self.ensureDir(os.path.dirname(inner_path))
+        self.download_dir.mkdir(parents=True, exist_ok=True)
+        file_name = "%s-%s" % (os.path.basename(inner_path), CryptHash.random(8))
+        return DownloadFile(str(self.download_dir / file_name))
+
+    # Move a verified download in place of the file
+    def writeDownload(self, inner_path, download_file):
+        download_file.commit(self.getPath(inner_path))
+        self.onUpdated(inner_path)
+
     # Remove file from filesystem
     def delete(self, inner_path):
         file_path = self.getPath(inner_path)
@@ -309,6 +331,9 @@ class SiteStorage(object):
                 time.sleep(0.1 + retry)
         if rename_err:
             raise rename_err
+        for inner_path in (inner_path_before, inner_path_after):
+            if str(inner_path).endswith("content.json"):
+                self.deleteJsonCache(inner_path)
 
     # List files from a directory
     @thread_pool_fs_read.wrap
@@ -353,6 +378,8 @@ class SiteStorage(object):
         """Site content updated"""
         if not isinstance(inner_path, Path):
             inner_path = Path(inner_path)
+        if inner_path.name.endswith("content.json"):
+            self.deleteJsonCache(inner_path)
         # Update Sql cache
         should_load_to_db = inner_path.name.endswith('.json') or inner_path.name.endswith('.json.gz')
         if inner_path == Path('dbschema.json'):
@@ -373,9 +400,47 @@ class SiteStorage(object):
     # Load and parse json file
     @thread_pool_fs_read.wrap
     def loadJson(self, inner_path):
+        if config.content_json_cache and str(inner_path).endswith("content.json"):
+            return self.loadJsonCached(inner_path)
         with self.open(inner_path, "r", encoding="utf8") as file:
             return json.load(file)
 
+    def getJsonCachePath(self, inner_path):
+        return self.json_cache_dir / ("%s.msgpack" % hashlib.sha1(str(inner_path).encode("utf8")).hexdigest())
+
+    # Load json from its msgpack copy if the file did not change since it was made, parse and cache it otherwise
+    def loadJsonCached(self, inner_path):
+        file_stat = os.stat(self.getPath(inner_path))
+        cache_path = self.getJsonCachePath(inner_path)
+        try:
+            with open(cache_path, "rb") as cache_file:
+                cache = msgpack.unpackb(cache_file.read(), raw=False)
+            if [cache["inner_path"], cache["size"], cache["mtime"]] == [str(inner_path), file_stat.st_size, file_stat.st_mtime_ns]:
+                return cache["data"]
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            self.log.debug("Json cache %s load error: %s" % (inner_path, err))
+
+        with self.open(inner_path, "r", encoding="utf8") as file:
+            data = json.load(file)
+
+        try:
+            cache = {"inner_path": str(inner_path), "size": file_stat.st_size, "mtime": file_stat.st_mtime_ns, "data": data}
+            self.json_cache_dir.mkdir(parents=True, exist_ok=True)
+            with open("%s-tmpnew" % cache_path, "wb") as cache_file:
+                cache_file.write(Msgpack.pack(cache))
+            os.replace("%s-tmpnew" % cache_path, cache_path)
+        except Exception as err:
+            self.log.debug("Json cache %s write error: %s" % (inner_path, err))
+        return data
+
+    def deleteJsonCache(self, inner_path):
+        try:
+            os.unlink(self.getJsonCachePath(inner_path))
+        except OSError:
+            pass
+
     # Write formatted json file
     def writeJson(self, inner_path, data):
         # Write to disk
@@ -433,6 +498,7 @@ class SiteStorage(object):
             self.log.debug("VerifyFile content.json not exists")
             self.site.needFile("content.json", update=True)  # Force update to fix corrupt file
             self.site.content_manager.loadContent()  # Reload content.json
+        verifier = ContentVerifier(self.site.content_manager)
         for content_inner_path, content in list(self.site.content_manager.contents.items()):
             back["num_content"] += 1
             i += 1
@@ -443,6 +509,18 @@ class SiteStorage(object):
                 self.log.debug("[MISSING] %s" % content_inner_path)
                 bad_files.append(content_inner_path)
 
+            # Hash the existing files of the content.json in parallel
+            verify_results = {}
+            if not quick_check:
+                verify_jobs = []
+                for file_relative_path in list(content.get("files", {}).keys()) + list(content.get("files_optional", {}).keys()):
+                    file_inner_path = (helper.getDirname(content_inner_path) + file_relative_path).strip("/")
+                    file_path = self.getPath(file_inner_path)
+                    if os.path.isfile(file_path):
+                        verify_jobs.append((file_inner_path, file_path))
+                for file_inner_path, valid, error in verifier.verifyFiles(verify_jobs):
+                    verify_results[file_inner_path] = (valid, error)
+
             for file_relative_path in list(content.get("files", {}).keys()):
                 back["num_file"] += 1
                 file_inner_path = helper.getDirname(content_inner_path) + file_relative_path  # Relative to site dir
@@ -460,11 +538,7 @@ class SiteStorage(object):
                     if not ok:
                         error = "Invalid size"
                 else:
-                    try:
-                        ok = self.site.content_manager.verifyFile(file_inner_path, open(file_path, "rb"))
-                    except Exception as err:
-                        error = err
-                        ok = False
+                    ok, error = verify_results.get(file_inner_path, (False, "File not found"))
 
                 if not ok:
                     back["num_file_invalid"] += 1
@@ -495,10 +569,7 @@ class SiteStorage(object):
                 if quick_check:
                     ok = os.path.getsize(file_path) == content["files_optional"][file_relative_path]["size"]
                 else:
-                    try:
-                        ok = self.site.content_manager.verifyFile(file_inner_path, open(file_path, "rb"))
-                    except Exception as err:
-                        ok = False
+                    ok, error = verify_results.get(file_inner_path, (False, "File not found"))
 
                 if ok:
                     if not self.site.content_manager.isDownloaded(file_inner_path, hash_id):
@@ -597,6 +668,8 @@ class SiteStorage(object):
                 )
             self.onUpdated(inner_path, False)
 
+        shutil.rmtree(self.json_cache_dir, ignore_errors=True)
+
         self.log.debug("Deleting empty dirs...")
         i = 0
         for root, dirs, files in os.walk(self.directory, topdown=False):
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+from gevent import monkey
+monkey.patch_all()
+import os
+import time
+import sys
+import socket
+sys.path.append(os.path.abspath(".."))  # Imports relative to src dir
+
+import gevent
+
+from gevent.server import StreamServer
+from Config import config
+config.parse()
+from Crypt import CryptConnection
+
+manager = CryptConnection.manager
+manager.loadCerts()
+
+
+# Server
+def handle(sock_raw, addr):
+    try:
+        sock_raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock = manager.wrapSocket(sock_raw, "tls-rsa", server=True)
+        while True:
+            data = sock.recv(1024)
+            if not data or data == b"bye\n":
+                break
+            sock.sendall(data)
+        sock.close()
+    except Exception as err:
+        print(err)
+
+server = StreamServer(("127.0.0.1", 1234), handle)
+server.start()
+
+
+# Client
+def connect(session_key):
+    sock = socket.create_connection(("127.0.0.1", 1234))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock = manager.wrapSocket(sock, "tls-rsa", session_key=session_key)
+    sock.sendall(b"req\n")
+    assert sock.recv(1024) == b"req\n"  # TLS 1.3 session ticket received with the first response
+    manager.saveSession(session_key, sock)
+    sock.sendall(b"bye\n")
+    sock.close()
+
+
+def bench(title, num, session_key):
+    num_full, num_resumed = manager.num_client_full, manager.num_client_resumed
+    s = time.time()
+    for i in range(num):
+        connect(session_key)
+    taken = time.time() - s
+    print("%s: %s connections in %.3fs (%.2fms/connection, full: %s, resumed: %s)" % (
+        title, num, taken, taken / num * 1000,
+        manager.num_client_full - num_full, manager.num_client_resumed - num_resumed
+    ))
+
+num = 500
+bench("Full handshake", num, None)
+bench("Resumed handshake", num, "127.0.0.1:1234")
+print("Server side: full: %s, resumed: %s" % (manager.num_server_full, manager.num_server_resumed))
+
+# Single process, loopback, TLSv1.3, RSA 2048:
+# Full handshake: 500 connections in 1.276s (2.55ms/connection, full: 500, resumed: 0)
+# Resumed handshake: 500 connections in 1.156s (2.31ms/connection, full: 1, resumed: 499)
+# (TLSv1.3 resumption still does ECDHE: it saves the certificate transfer and the server's RSA signature)
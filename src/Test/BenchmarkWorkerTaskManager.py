@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+import os
+import sys
+import time
+import random
+sys.path.append(os.path.abspath(".."))  # Imports relative to src dir
+
+from Worker.WorkerTaskManager import WorkerTaskManager
+from Worker.WorkerTask import WorkerTask
+
+
+# The linear scan used before the per-peer queues
+def getTaskLinear(tasks, peer):
+    for task in tasks:
+        if task["peers"] and peer not in task["peers"]:
+            continue
+        if peer in task["failed"]:
+            continue
+        if task["optional_hash_id"] and task["peers"] is None:
+            continue
+        if task["done"]:
+            continue
+        return task
+
+
+def createTasks(num_tasks, peers, ratio_locked, ratio_optional):
+    random.seed(1234)
+    tasks = WorkerTaskManager()
+    for i in range(num_tasks):
+        rand = random.random()
+        if rand < ratio_locked:  # Update received from some peers
+            task_peers = random.sample(peers, 2)
+            optional_hash_id = None
+        elif rand < ratio_locked + ratio_optional:  # Optional file without known peers
+            task_peers = None
+            optional_hash_id = random.randint(0, 0xFFFF)
+        else:
+            task_peers = None
+            optional_hash_id = None
+        task = WorkerTask(i, None, None, "data/file%s.json" % i, optional_hash_id=optional_hash_id, peers=task_peers, priority=random.randint(0, 20))
+        task.failed = set(peer for peer in peers if random.random() < 0.05)
+        tasks.append(task)
+    return tasks
+
+
+def bench(title, num_tasks, num_peers, num_picks, get_task, ratio_locked=0.3, ratio_optional=0.2):
+    peers = ["peer%s" % i for i in range(num_peers)]
+    tasks = createTasks(num_tasks, peers, ratio_locked, ratio_optional)
+    s = time.time()
+    for i in range(num_picks):
+        peer = peers[i % num_peers]
+        task = get_task(tasks, peer)
+        if not task:
+            continue
+        tasks.updateItem(task, "workers_num", task["workers_num"] + 1)  # Worker started on the task
+        if i % 2:  # Half of the tasks done by the worker, the other half failed
+            task["done"] = True
+            tasks.remove(task)
+        else:
+            tasks.markFailed(task, peer)
+            tasks.updateItem(task, "workers_num", task["workers_num"] - 1)
+    taken = time.time() - s
+    print("%s: %s tasks, %s peers, %s picks in %.3fs (%.1fus/pick)" % (
+        title, num_tasks, num_peers, num_picks, taken, taken / num_picks * 1000000
+    ))
+
+
+for num_tasks in (1000, 10000):
+    print("- Mixed tasks")
+    bench("Linear scan", num_tasks, 20, 2000, getTaskLinear)
+    bench("Peer queues", num_tasks, 20, 2000, WorkerTaskManager.getTask)
+    print("- Mostly peer locked and optional tasks without peers")
+    bench("Linear scan", num_tasks, 20, 2000, getTaskLinear, ratio_locked=0.7, ratio_optional=0.29)
+    bench("Peer queues", num_tasks, 20, 2000, WorkerTaskManager.getTask, ratio_locked=0.7, ratio_optional=0.29)
+
+# Single process, Python 3.11 (picks include the task priority updates):
+# - Mixed tasks
+# Linear scan: 1000 tasks, 20 peers, 2000 picks in 0.234s (117.2us/pick)
+# Peer queues: 1000 tasks, 20 peers, 2000 picks in 0.031s (15.6us/pick)
+# - Mostly peer locked and optional tasks without peers
+# Linear scan: 1000 tasks, 20 peers, 2000 picks in 0.487s (243.4us/pick)
+# Peer queues: 1000 tasks, 20 peers, 2000 picks in 0.032s (16.2us/pick)
+# - Mixed tasks
+# Linear scan: 10000 tasks, 20 peers, 2000 picks in 0.341s (170.5us/pick)
+# Peer queues: 10000 tasks, 20 peers, 2000 picks in 0.076s (37.8us/pick)
+# - Mostly peer locked and optional tasks without peers
+# Linear scan: 10000 tasks, 20 peers, 2000 picks in 0.720s (360.1us/pick)
+# Peer queues: 10000 tasks, 20 peers, 2000 picks in 0.090s (45.2us/pick)
@@ -0,0 +1,65 @@
+import time
+
+import gevent
+import mock
+
+from Config import config
+from Connection.BandwidthLimiter import TokenBucket, BandwidthLimiter
+
+
+class TestBandwidthLimiter:
+    def testTokenBucket(self):
+        bucket = TokenBucket()
+        assert bucket.consume(1024 * 1024) == 0  # Unlimited
+
+        bucket.setRate(100 * 1024)
+        assert bucket.consume(50 * 1024) == 0  # Within the burst
+        assert 0.9 < bucket.consume(100 * 1024) <= 1.0
+        assert 1.9 < bucket.consume(100 * 1024) <= 2.0  # Queued after the previous one
+
+    def testFairShare(self):
+        bucket = TokenBucket(100 * 1024)
+        bytes_sent = {"a": 0, "b": 0}
+
+        def sender(name):
+            while True:
+                gevent.sleep(bucket.consume(10 * 1024))
+                bytes_sent[name] += 10 * 1024
+
+        threads = [gevent.spawn(sender, "a"), gevent.spawn(sender, "b")]
+        time.sleep(0.5)
+        gevent.killall(threads)
+        assert abs(bytes_sent["a"] - bytes_sent["b"]) <= 10 * 1024
+        assert bytes_sent["a"] + bytes_sent["b"] < 120 * 1024  # 0.5 sec burst + 0.5 sec at 100kB/sec
+
+    def testLimits(self):
+        upload_limit = config.upload_limit
+        try:
+            bandwidth = BandwidthLimiter()
+            assert bandwidth.getChunkSize(256 * 1024) == 256 * 1024
+
+            config.upload_limit = 64
+            bandwidth.updateLimits()
+            assert bandwidth.upload.rate == 64 * 1024
+            assert bandwidth.getChunkSize(256 * 1024) == 16 * 1024
+            assert bandwidth.getChunkSize(256 * 1024, upload=False) == 256 * 1024
+            assert bandwidth.getInfo(0, 0)["upload_limit"] == 64 * 1024
+        finally:
+            config.upload_limit = upload_limit
+
+    def testSiteLimit(self):
+        site_upload_limit = config.site_upload_limit
+        try:
+            config.site_upload_limit = 100
+            bandwidth = BandwidthLimiter()
+            connection = mock.MagicMock(ip="127.0.0.1")
+            with mock.patch.object(bandwidth, "wait") as wait:
+                bandwidth.waitUpload(connection, 50 * 1024, "1Site")
+                bandwidth.waitUpload(connection, 100 * 1024, "1Site")
+                assert 0.9 < wait.call_args.args[0] <= 1.0
+                bandwidth.waitUpload(connection, 50 * 1024, "1OtherSite")
+                assert wait.call_args.args[0] == 0  # Separate budget per site
+                bandwidth.waitUpload(connection, 100 * 1024)
+                assert wait.call_args.args[0] == 0  # Not charged to any site
+        finally:
+            config.site_upload_limit = site_upload_limit
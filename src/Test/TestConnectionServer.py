@@ -1,3 +1,4 @@
+import io
 import time
 import socket
 import gevent
@@ -6,8 +7,9 @@ import pytest
 import mock
 
 from Crypt import CryptConnection
-from Connection import ConnectionServer
+from Connection import ConnectionServer, Connection
 from Config import config
+from util import Msgpack
 
 
 @pytest.mark.usefixtures("resetSettings")
@@ -51,6 +53,45 @@ class TestConnection:
         assert len(file_server.connections) == 0
         assert file_server.num_incoming == 2  # One for file_server fixture, one for the test
 
+    def testSslSessionResume(self, file_server):
+        client = ConnectionServer(file_server.ip, 1545)
+        CryptConnection.manager.sessions.clear()
+        num_resumed_before = CryptConnection.manager.num_client_resumed
+
+        with mock.patch('Config.config.ip_local', return_value=[]):  # SSL not used for local ips
+            for i in range(2):
+                connection = client.getConnection(file_server.ip, 1544)
+                assert connection.crypt
+                assert connection.ping()
+                assert connection.sock.session_reused == (i == 1)  # Second connection resumes the first session
+                connection.close("Test ended")
+
+        assert CryptConnection.manager.num_client_resumed == num_resumed_before + 1
+        assert "%s:%s" % (file_server.ip, 1544) in CryptConnection.manager.sessions
+        client.stop()
+
+    def testSslSessionNoResumeOverTor(self, file_server):
+        client = ConnectionServer(file_server.ip, 1545)
+        CryptConnection.manager.sessions.clear()
+        num_resumed_before = CryptConnection.manager.num_client_resumed
+
+        # Same peer ip:port, but different onion identity of ours: must not be linkable by resumed sessions
+        with mock.patch('Config.config.ip_local', return_value=[]), \
+                mock.patch.object(config, "tor", "always"), \
+                mock.patch("util.helper.isPrivateIp", return_value=False):
+            for i in range(2):
+                connection = client.getConnection(file_server.ip, 1544)
+                assert connection.crypt
+                assert connection.getSessionKey() is None
+                assert connection.ping()
+                assert not connection.sock.session_reused
+                connection.close("Test ended")
+
+        assert CryptConnection.manager.num_client_resumed == num_resumed_before
+        assert len(CryptConnection.manager.sessions) == 0
+        assert Connection(client, "%s.onion" % ("a" * 56), 1544).getSessionKey() is None
+        client.stop()
+
     def testRawConnection(self, file_server):
         client = ConnectionServer(file_server.ip, 1545)
         assert file_server != client
@@ -82,6 +123,83 @@ class TestConnection:
         connection.close()
         client.stop()
 
+    def testSendCoalesce(self, file_server, site):
+        file_server.sites[site.address] = site
+        client = ConnectionServer(file_server.ip, 1545)
+        connection = client.getConnection(file_server.ip, 1544)
+
+        flush_original = Connection.flushSendQueue
+        with mock.patch.object(Connection, "flushSendQueue", autospec=True, side_effect=flush_original) as flush:
+            def getNumFlush():  # Server side responses are also counted by the mock
+                return len([call for call in flush.call_args_list if call.args[0] is connection])
+
+            # Messages sent in the same loop tick are written in one batch
+            threads = [gevent.spawn(connection.request, "getHashfield", {"site": site.address}) for i in range(10)]
+            gevent.joinall(threads)
+            assert all("hashfield_raw" in thread.value for thread in threads)
+            assert getNumFlush() == 1
+            assert not connection.send_queue
+
+            # Ping is not delayed
+            assert connection.ping()
+            assert getNumFlush() == 2
+
+        connection.close()
+        client.stop()
+
+    def testSendRawfileOrder(self, file_server):
+        sent = []
+
+        def sendall(data):
+            sent.append(bytes(data))
+            time.sleep(0.001)  # Let the other sender run
+
+        connection = Connection(file_server, "127.0.0.1", 1234, sock=mock.MagicMock())
+        connection.sock.sendall.side_effect = sendall
+        connection.sock_wrapped = True  # No sendfile on the fake socket
+        connection.connected = True
+        connection.last_cmd_recv = "streamFile"
+        raw = b"RAWDATA" * 100000
+        header = {"cmd": "response", "to": 1, "stream_bytes": len(raw)}
+
+        # Message sent by an other greenlet while the response header and the raw data are written
+        sender = gevent.spawn_later(0.001, connection.send, {"cmd": "getFile", "req_id": 2, "params": {}})
+        assert connection.sendRawfile(io.BytesIO(raw), len(raw), message=header)
+        sender.join()
+
+        data = b"".join(sent)
+        header_len = len(Msgpack.pack(header))
+        assert Msgpack.unpack(data[:header_len]) == header
+        assert data[header_len:header_len + len(raw)] == raw
+        assert Msgpack.unpack(data[header_len + len(raw):])["cmd"] == "getFile"
+        assert not connection.send_queue
+
+    def testSendDuringThrottledStream(self, file_server):
+        sent = []
+        connection = Connection(file_server, "127.0.0.1", 1234, sock=mock.MagicMock())
+        connection.sock.sendall.side_effect = lambda data: sent.append(bytes(data))
+        connection.sock_wrapped = True
+        connection.connected = True
+        raw = b"x" * 32 * 1024
+        header = {"cmd": "response", "to": 1, "stream_bytes": len(raw)}
+
+        with mock.patch.object(config, "site_upload_limit", 16):  # 16kB/sec
+            streamer = gevent.spawn(connection.sendRawfile, io.BytesIO(raw), len(raw), message=header, site_address="1Site")
+            time.sleep(0.1)
+            assert not streamer.ready()  # Throttled per chunk
+
+            # Other messages are not blocked by the throttled stream, but written after it
+            s = time.time()
+            assert connection.send({"cmd": "ping", "req_id": 2})
+            assert time.time() - s < 0.1
+            assert connection.send_queue
+            streamer.join()
+
+        data = b"".join(sent)
+        assert data.startswith(Msgpack.pack(header))
+        assert Msgpack.unpack(data[len(Msgpack.pack(header)) + len(raw):])["cmd"] == "ping"
+        assert not connection.send_queue
+
     def testGetConnection(self, file_server):
         client = ConnectionServer(file_server.ip, 1545)
         connection = client.getConnection(file_server.ip, 1544)
@@ -3,10 +3,13 @@ import time
 import io
 
 import pytest
+import mock
 
+from Config import config
 from Crypt import CryptBitcoin
 from Content.ContentManager import VerifyError, SignError
 from util.SafeRe import UnsafePatternError
+from . import Spy
 
 
 @pytest.mark.usefixtures("resetSettings")
@@ -152,6 +155,31 @@ class TestContent:
         assert "sha512" in file_info_optional
         assert file_info_optional["optional"] is True
 
+    def testFileInfoIndex(self, site):
+        contents = site.content_manager.contents
+        user_content_inner_path = "data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/content.json"
+        file_info = site.content_manager.getFileInfo("data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/data.json")
+        file_info_optional = site.content_manager.getFileInfo("data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/peanut-butter-jelly-time.gif")
+
+        # Found in content.db without loading the json files
+        contents.clearCache()
+        with Spy.Spy(contents, "loadItem") as calls:
+            assert site.content_manager.getFileInfo("data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/data.json") == file_info
+            assert site.content_manager.getFileInfo("data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/peanut-butter-jelly-time.gif") == file_info_optional
+        assert not calls
+
+        # Updated with the content.json
+        content = contents[user_content_inner_path]
+        content["files"]["new.json"] = {"sha512": "0" * 64, "size": 2}
+        contents[user_content_inner_path] = content
+        contents.clearCache()
+        assert site.content_manager.getFileInfo("data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/new.json")["size"] == 2
+
+        # Removed with the content.json
+        del contents[user_content_inner_path]
+        assert not contents.db.getFileInfo(site, "data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/data.json")
+        assert site.content_manager.getFileInfo("data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/data.json")["optional"] is None  # User content rules
+
     def testVerify(self, site, crypt_bitcoin_lib):
         inner_path = "data/test_include/content.json"
         data_dict = site.storage.loadJson(inner_path)
@@ -196,6 +224,43 @@ class TestContent:
         data = io.BytesIO(json.dumps(data_dict).encode())
         assert site.content_manager.verifyFile(inner_path, data, ignore_same=False)
 
+    def testVerifySignCache(self, site, crypt_bitcoin_lib):
+        inner_path = "content.json"
+        data_dict = site.storage.loadJson(inner_path)
+        data_dict["modified"] = int(time.time())
+        del data_dict["signs"]
+        data_dict["signs"] = {
+            "1TeSTvb4w2PWE81S2rEELgmX2GCCExQGT": CryptBitcoin.sign(json.dumps(data_dict, sort_keys=True), self.privatekey)
+        }
+        data_json = json.dumps(data_dict).encode("utf8")
+
+        with Spy.Spy(CryptBitcoin, "verify") as calls:
+            assert site.content_manager.verifyFile(inner_path, io.BytesIO(data_json), ignore_same=False)
+            num_verify = len(calls)
+            assert num_verify > 0
+
+            # Already verified signatures are not checked again
+            assert site.content_manager.verifyFile(inner_path, io.BytesIO(data_json), ignore_same=False)
+            assert len(calls) == num_verify
+
+        # Invalid signatures are not cached
+        data_dict["signs"]["1TeSTvb4w2PWE81S2rEELgmX2GCCExQGT"] = CryptBitcoin.sign("invalid", self.privatekey)
+        data = io.BytesIO(json.dumps(data_dict).encode("utf8"))
+        with pytest.raises(VerifyError) as err:
+            site.content_manager.verifyFile(inner_path, data, ignore_same=False)
+        assert "Valid signs: 0/1" in str(err.value)
+        sign_content = json.dumps({key: val for key, val in data_dict.items() if key != "signs"}, sort_keys=True)
+        sign_hash = site.content_manager.contents.db.getSignHash(sign_content, "1TeSTvb4w2PWE81S2rEELgmX2GCCExQGT", data_dict["signs"]["1TeSTvb4w2PWE81S2rEELgmX2GCCExQGT"])
+        assert not site.content_manager.contents.db.isSignVerified(sign_hash)
+
+    def testSignCacheLimit(self, site):
+        db = site.content_manager.contents.db
+        with mock.patch.object(config, "sign_cache_size", 10):
+            for i in range(15):
+                db.setSignVerified(db.getSignHash("data %s" % i, "1TeSTvb4w2PWE81S2rEELgmX2GCCExQGT", "sign"))
+            assert db.num_sign_cache <= 10
+            assert db.execute("SELECT COUNT(*) AS num FROM sign_cache").fetchone()["num"] == db.num_sign_cache
+
     def testVerifyInnerPath(self, site, crypt_bitcoin_lib):
         inner_path = "content.json"
         data_dict = site.storage.loadJson(inner_path)
@@ -0,0 +1,69 @@
+import json
+import logging
+
+import mock
+
+from Config import config
+from Content.ContentDbDict import ContentDbDict, content_cache
+
+
+class FakeStorage(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def loadJson(self, inner_path):
+        with (self.directory / inner_path).open() as file:
+            return json.load(file)
+
+    def getSize(self, inner_path):
+        return (self.directory / inner_path).stat().st_size
+
+
+class FakeSite(object):
+    def __init__(self, address, directory):
+        self.address = address
+        self.log = logging.getLogger("FakeSite:%s" % address)
+        self.storage = FakeStorage(directory)
+        self.bad_files = {}
+
+
+class TestContentDbDict:
+    def testLru(self, tmp_path):
+        site = FakeSite("1TestContentDbDictLru", tmp_path)
+        contents = ContentDbDict(site)
+        contents.db.initSite(site)
+        try:
+            with mock.patch.object(config, "content_cache_size_site", 2.5 / 1024):  # 2.5kB
+                for i in range(4):
+                    inner_path = "data/users/%s/content.json" % i
+                    (tmp_path / ("data/users/%s" % i)).mkdir(parents=True)
+                    (tmp_path / inner_path).write_text(json.dumps({"modified": i, "padding": "x" * 1000}))
+                    contents[inner_path] = {"modified": i, "padding": "x" * 1000}
+
+                # Only the two most recently used fit
+                assert contents.num_evicted == 2
+                assert contents.cached_size <= 2.5 * 1024
+                assert dict.get(contents, "data/users/0/content.json") is False
+                assert dict.get(contents, "data/users/3/content.json")
+
+                # Access moves to the end of the queue
+                assert contents["data/users/2/content.json"]["modified"] == 2
+                assert contents.num_hits == 1
+                assert contents["data/users/0/content.json"]["modified"] == 0  # Loaded again from disk
+                assert contents.num_loaded == 1
+                assert dict.get(contents, "data/users/3/content.json") is False
+                assert dict.get(contents, "data/users/2/content.json")
+
+                del contents["data/users/2/content.json"]
+                assert list(contents.cached_keys) == ["data/users/0/content.json"]
+                assert (id(contents), "data/users/2/content.json") not in content_cache.items
+
+                # Global limit
+                with mock.patch.object(config, "content_cache_size", 1.5 / 1024):
+                    contents["data/users/1/content.json"]
+                    assert list(contents.cached_keys) == ["data/users/1/content.json"]
+        finally:
+            contents.clearCache()
+            contents.db.deleteSite(site)
+        assert not contents.cached_keys
+        assert (id(contents), "data/users/1/content.json") not in content_cache.items
@@ -0,0 +1,48 @@
+import io
+
+import pytest
+import mock
+
+from Config import config
+from Crypt import CryptBitcoin
+from Content.ContentVerifier import ContentVerifier
+from . import Spy
+
+
+@pytest.mark.usefixtures("resetSettings")
+class TestContentVerifier:
+    def testVerifyFiles(self, site):
+        verifier = ContentVerifier(site.content_manager, max_parallel=2)
+        inner_paths = [inner_path for inner_path in site.content_manager.contents["content.json"]["files"]]
+        site.storage.write("index.html", b"modified")
+
+        jobs = [(inner_path, site.storage.getPath(inner_path)) for inner_path in inner_paths]
+        jobs.append(("css/all.css", io.BytesIO(b"modified")))
+        results = list(verifier.verifyFiles(jobs))
+
+        # Results in the order of the jobs
+        assert [inner_path for inner_path, valid, error in results] == inner_paths + ["css/all.css"]
+        valids = {inner_path: valid for inner_path, valid, error in results[:-1]}
+        assert valids.pop("index.html") is False
+        assert all(valids.values())
+        assert results[-1][1] is False
+        assert "Invalid hash" in str(results[-1][2])
+
+    def testVerifyContent(self, site, crypt_bitcoin_lib):
+        verifier = ContentVerifier(site.content_manager)
+        jobs = [("content.json", site.storage.getPath("content.json")), ("data/users/content.json", io.BytesIO(b"{invalid"))]
+        site.content_manager.contents.db.execute("DELETE FROM sign_cache")
+        site.content_manager.contents.db.num_sign_cache = None
+
+        with Spy.Spy(site.content_manager.contents.db, "setSignVerified") as calls:
+            results = list(verifier.verifyFiles(jobs, ignore_same=False))
+        assert results[0] == ("content.json", True, None)
+        assert len(calls) == 1  # Signer recovered in the thread pool
+
+        assert results[1][1] is False
+        assert results[1][2]
+
+        # Without the sign cache the signature is checked only by verifyFile
+        with mock.patch.object(config, "sign_cache_size", 0), Spy.Spy(CryptBitcoin, "verify") as calls:
+            assert list(verifier.verifyFiles(jobs[:1], ignore_same=False)) == [("content.json", True, None)]
+        assert len(calls) == 1
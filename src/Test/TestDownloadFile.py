@@ -0,0 +1,39 @@
+import io
+import os
+
+from Crypt import CryptHash
+from util.DownloadFile import DownloadFile
+
+
+class TestDownloadFile:
+    def testHashInOrder(self, tmp_path):
+        data = os.urandom(200 * 1024)
+        download_file = DownloadFile(str(tmp_path / "file.bin-tmpdownload"))
+        for pos in range(0, len(data), 16 * 1024):
+            download_file.write(data[pos:pos + 16 * 1024])
+        assert download_file.hash_pos == len(data)  # Hashed without reading back
+        assert download_file.getSha512() == CryptHash.sha512sum(io.BytesIO(data))
+        assert download_file.tell() == len(data)
+
+        download_file.commit(str(tmp_path / "file.bin"))
+        assert not os.path.isfile(tmp_path / "file.bin-tmpdownload")
+        assert open(tmp_path / "file.bin", "rb").read() == data
+
+    def testHashOutOfOrder(self, tmp_path):
+        data = os.urandom(100 * 1024)
+        download_file = DownloadFile(str(tmp_path / "file.bin-tmpdownload"))
+        # Pipelined parts arriving in reverse order
+        for pos in reversed(range(0, len(data), 10 * 1024)):
+            download_file.seek(pos)
+            download_file.write(data[pos:pos + 10 * 1024])
+        assert download_file.hash_pos == 10 * 1024
+        assert download_file.getSha512() == CryptHash.sha512sum(io.BytesIO(data))
+
+        # Hashed part overwritten
+        download_file.seek(0)
+        download_file.write(b"x" * 1024)
+        assert download_file.getSha512() == CryptHash.sha512sum(io.BytesIO(b"x" * 1024 + data[1024:]))
+
+        assert download_file.delete()
+        assert not download_file.delete()
+        assert not os.listdir(tmp_path)
@@ -88,6 +88,37 @@ class TestFileRequest:
         connection.close()
         client.stop()
 
+    def testGetFiles(self, file_server, site):
+        file_server.ip_incoming = {}  # Reset flood protection
+        client = ConnectionServer(file_server.ip, 1545)
+        connection = client.getConnection(file_server.ip, 1544)
+        file_server.sites[site.address] = site
+
+        inner_paths = ["content.json", "invalid.file", "index.html", "../users.json"]
+        file_sizes = [0, 0, site.storage.getSize("index.html"), 0]
+        response = connection.request("getFiles", {"site": site.address, "inner_paths": inner_paths, "file_sizes": file_sizes})
+        files = response["files"]
+        assert [file["inner_path"] for file in files] == inner_paths
+        assert b"sign" in files[0]["body"]
+        assert "File read error" in files[1]["error"]
+        assert files[2]["body"] == site.storage.read("index.html")
+        assert "File read error" in files[3]["error"]
+
+        # Invalid size
+        response = connection.request("getFiles", {"site": site.address, "inner_paths": ["index.html"], "file_sizes": [1234]})
+        assert "File size does not match" in response["files"][0]["error"]
+
+        # Too many files
+        response = connection.request("getFiles", {"site": site.address, "inner_paths": ["index.html"] * 1000})
+        assert "Invalid inner_paths" in response["error"]
+
+        # Invalid site
+        response = connection.request("getFiles", {"site": "", "inner_paths": ["content.json"]})
+        assert "Unknown site" in response["error"]
+
+        connection.close()
+        client.stop()
+
     def testPex(self, file_server, site, site_temp):
         file_server.sites[site.address] = site
         client = FileServer(file_server.ip, 1545)
@@ -126,6 +126,63 @@ class TestPeer:
 
         server2.stop()
 
+    def testHashfieldDelta(self, file_server, site, site_temp):
+        server1 = file_server
+        server1.sites[site.address] = site
+        site.connection_server = server1
+
+        server2 = FileServer(file_server.ip, 1545)
+        server2.sites[site_temp.address] = site_temp
+        site_temp.connection_server = server2
+
+        server2_peer1 = site_temp.addPeer(file_server.ip, 1544)
+        server2_peer1.connect()
+        assert server2_peer1.hasFeature("hashfield_delta")
+
+        site.content_manager.hashfield.appendHash("AABB")
+        site.content_manager.hashfield.appendHash("AACC")
+
+        with Spy.Spy(FileRequest, "actionGetHashfieldDelta") as requests:
+            # First update: full hashfield
+            assert server2_peer1.updateHashfield()
+            assert server2_peer1.hashfield.tobytes() == site.content_manager.hashfield.tobytes()
+            assert server2_peer1.hashfield.epoch == site.content_manager.hashfield.epoch
+
+            # Then only the changes
+            site.content_manager.hashfield.removeHash("AABB")
+            site.content_manager.hashfield.appendHash("AADD")
+            with Spy.Spy(FileRequest, "response") as responses:
+                assert server2_peer1.updateHashfield(force=True)
+            assert "hashfield_raw" not in responses[0][1]
+            assert responses[0][1]["hashfield_added"]
+            assert server2_peer1.hashfield.tobytes() == site.content_manager.hashfield.tobytes()
+            assert len(requests) == 2
+
+        # Push the changes of my hashfield
+        server1_peer2 = site.addPeer(file_server.ip, 1545, return_peer=True)
+        site_temp.content_manager.hashfield.appendHash("BBAA")
+        assert server2_peer1.sendMyHashfield()  # Full
+        assert list(server1_peer2.hashfield) == [0xBBAA]
+
+        time.sleep(0.01)  # To make hashfield change date different
+        site_temp.content_manager.hashfield.appendHash("BBCC")
+        with Spy.Spy(FileRequest, "actionSetHashfield") as requests:
+            assert server2_peer1.sendMyHashfield()
+        assert "hashfield_raw" not in requests[0][1]
+        assert list(server1_peer2.hashfield) == [0xBBAA, 0xBBCC]
+
+        # Version mismatch falls back to full hashfield
+        time.sleep(0.01)
+        server1_peer2.hashfield.version += 1
+        site_temp.content_manager.hashfield.appendHash("BBDD")
+        with Spy.Spy(FileRequest, "actionSetHashfield") as requests:
+            assert server2_peer1.sendMyHashfield()
+        assert len(requests) == 2
+        assert "hashfield_raw" in requests[1][1]
+        assert list(server1_peer2.hashfield) == [0xBBAA, 0xBBCC, 0xBBDD]
+
+        server2.stop()
+
     def testFindHash(self, file_server, site, site_temp):
         file_server.sites[site.address] = site
         client = FileServer(file_server.ip, 1545)
@@ -0,0 +1,86 @@
+import array
+
+from Peer import PeerHashfield
+
+
+class TestPeerHashfield:
+    def testAppendRemove(self):
+        hashfield = PeerHashfield()
+        assert not hashfield
+        assert hashfield.appendHashId(0)
+        assert hashfield.appendHashId(65535)
+        assert not hashfield.appendHashId(65535)  # Don't add second time
+        assert hashfield.appendHash("aabbccdd")
+        assert len(hashfield) == 3
+        assert 0 in hashfield and 65535 in hashfield and 0xaabb in hashfield
+        assert 1 not in hashfield
+        assert hashfield.hasHash("aabb0000")
+
+        assert hashfield.removeHashId(0)
+        assert not hashfield.removeHashId(0)
+        assert len(hashfield) == 2
+        assert list(hashfield) == [0xaabb, 65535]
+
+    def testWireFormat(self):
+        hash_ids = [1, 8, 63, 64, 1234, 40000, 65535]
+        hashfield_raw = array.array("H", hash_ids).tobytes()
+
+        hashfield = PeerHashfield()
+        hashfield.replaceFromBytes(hashfield_raw + hashfield_raw)  # Duplicates ignored
+        assert len(hashfield) == len(hash_ids)
+        assert list(hashfield) == hash_ids
+        assert hashfield.tobytes() == hashfield_raw
+
+        # Cached wire format updated on change
+        hashfield.appendHashId(2)
+        assert hashfield.tobytes() == array.array("H", sorted(hash_ids + [2])).tobytes()
+
+    def testSetOperations(self):
+        hashfield_a = PeerHashfield([1, 2, 3, 1000, 65535])
+        hashfield_b = PeerHashfield([2, 3, 4, 65535])
+
+        assert list(hashfield_a.intersection(hashfield_b)) == [2, 3, 65535]
+        assert len(hashfield_a & hashfield_b) == 3
+        assert list(hashfield_a | hashfield_b) == [1, 2, 3, 4, 1000, 65535]
+        assert hashfield_a.countIntersection(hashfield_b) == 3
+        assert hashfield_a.countIntersection(PeerHashfield()) == 0
+
+    def testChangelog(self):
+        hashfield = PeerHashfield([1, 2])
+        assert hashfield.getChanges(0) is None  # No change log
+
+        hashfield.enableChangelog()
+        version = hashfield.version
+        hashfield.appendHashId(3)
+        hashfield.removeHashId(1)
+        hashfield.appendHashId(4)
+        hashfield.removeHashId(4)  # Only the last change counts
+        assert hashfield.getChanges(version) == ([3], [1, 4])
+        assert hashfield.getChanges(hashfield.version) == ([], [])
+        assert hashfield.getChanges(hashfield.version + 1) is None
+
+        # Replace logs the difference
+        version = hashfield.version
+        hashfield.replaceFromBytes(PeerHashfield([2, 5]).tobytes())
+        assert hashfield.getChanges(version) == ([5], [3])
+
+        # Too old version
+        for hash_id in range(1000, 1000 + hashfield.max_changes):
+            hashfield.appendHashId(hash_id)
+        assert hashfield.getChanges(version) is None
+
+    def testApplyChanges(self):
+        hashfield_my = PeerHashfield([1, 2, 3])
+        hashfield_my.enableChangelog()
+        hashfield_peer = PeerHashfield()
+        hashfield_peer.replaceFromBytes(hashfield_my.tobytes())
+        version = hashfield_my.version
+
+        hashfield_my.removeHashId(2)
+        hashfield_my.appendHashId(40000)
+        hash_ids_added, hash_ids_removed = hashfield_my.getChanges(version)
+        hashfield_peer.applyChanges(
+            PeerHashfield.unpackHashIds(PeerHashfield.packHashIds(hash_ids_added)),
+            PeerHashfield.unpackHashIds(PeerHashfield.packHashIds(hash_ids_removed))
+        )
+        assert hashfield_peer.tobytes() == hashfield_my.tobytes()
@@ -0,0 +1,91 @@
+import pytest
+import mock
+
+from Peer import Peer
+from Peer import PeerHashfield
+from Peer import PeerHashfieldIndex
+
+
+class FakePeer(object):
+    def __init__(self, key, hash_ids=()):
+        self.key = key
+        self.hashfield = PeerHashfield(hash_ids)
+
+    def __repr__(self):
+        return "<FakePeer %s>" % self.key
+
+
+class TestPeerHashfieldIndex:
+    def testFind(self):
+        index = PeerHashfieldIndex()
+        peer1 = FakePeer("peer1", [1234])
+        peer2 = FakePeer("peer2", [1234, 1235])
+        peer3 = FakePeer("peer3", [1235, 1236])
+        for peer in (peer1, peer2, peer3):
+            index.addPeer(peer)
+
+        assert index.getPeers(1234) == [peer1, peer2]
+        assert index.getPeers(1236) == [peer3]
+        assert index.getPeers(9999) == []
+        assert index.getNumPeers(1235) == 2
+        assert index.findPeers([1234, 1235, 9999]) == {1234: [peer1, peer2], 1235: [peer2, peer3]}
+        assert index.findPeers([1234, 1235], limit=1) == {1234: [peer1], 1235: [peer2]}
+
+    def testHashfieldChange(self):
+        index = PeerHashfieldIndex()
+        peer1 = FakePeer("peer1", [1234])
+        peer2 = FakePeer("peer2")
+        index.addPeer(peer1)
+        index.addPeer(peer2)
+
+        peer2.hashfield.appendHashId(1234)
+        assert index.getPeers(1234) == [peer1, peer2]
+
+        peer1.hashfield.removeHashId(1234)
+        assert index.getPeers(1234) == [peer2]
+
+        # Replaced by hashfield_raw received from the peer
+        peer2.hashfield.replaceFromBytes(PeerHashfield([1, 2]).tobytes())
+        assert index.getPeers(1234) == []
+        assert index.getPeers(2) == [peer2]
+        assert len(index) == 2
+
+    def testRemovePeer(self):
+        index = PeerHashfieldIndex()
+        peer1 = FakePeer("peer1", [1, 2])
+        peer2 = FakePeer("peer2", [2])
+        index.addPeer(peer1)
+        index.addPeer(peer2)
+
+        assert index.removePeer(peer1)
+        assert not index.removePeer(peer1)
+        assert peer1 not in index
+        assert index.getPeers(1) == []
+        assert index.getPeers(2) == [peer2]
+
+        peer1.hashfield.appendHashId(3)  # Changes of removed peers are not indexed
+        assert index.getPeers(3) == []
+
+        # Slot of the removed peer reused
+        peer3 = FakePeer("peer3", [2])
+        index.addPeer(peer3)
+        assert index.getPeers(2) == [peer3, peer2]
+
+    def testPeerHashfield(self):
+        site = mock.MagicMock()
+        site.hashfield_index = PeerHashfieldIndex()
+        peer1 = Peer("1.1.1.1", 1544, site)
+        peer2 = Peer("2.2.2.2", 1544, site)
+
+        peer1.hashfield.appendHashId(1234)  # Created on first access
+        assert site.hashfield_index.getPeers(1234) == [peer1]
+
+        # One hashfield object can't be indexed for two peers
+        with pytest.raises(ValueError):
+            peer2.hashfield = peer1.hashfield
+        peer2.hashfield = PeerHashfield(peer1.hashfield)
+        peer1.hashfield = peer1.hashfield
+        assert site.hashfield_index.getPeers(1234) == [peer1, peer2]
+
+        with pytest.raises(AttributeError):
+            peer1.not_exists
@@ -0,0 +1,42 @@
+from Peer import PeerPerformance
+
+
+class TestPeerPerformance:
+    def testDownload(self):
+        performance = PeerPerformance()
+        assert performance.getTime(1024 * 1024) == performance.default_rtt + 1024 * 1024 / performance.default_speed
+
+        performance.onDownload(1024 * 1024, 1.0, ping=0.1)
+        assert performance.speed == 1024 * 1024
+        assert performance.rtt == 0.1
+        assert performance.getTime(1024 * 1024) == 1.1
+
+        # Moving average
+        performance.onDownload(1024 * 1024, 0.5, ping=0.1)
+        assert 1024 * 1024 < performance.speed < 2 * 1024 * 1024
+
+        # Small files only update the round trip time
+        speed = performance.speed
+        performance.onDownload(100, 0.3)
+        assert performance.speed == speed
+        assert 0.1 < performance.rtt < 0.3
+
+    def testErrors(self):
+        performance_good = PeerPerformance()
+        performance_bad = PeerPerformance()
+        for performance in (performance_good, performance_bad):
+            performance.onDownload(1024 * 1024, 1.0, ping=0.1)
+
+        performance_bad.onError()
+        assert performance_bad.error_rate > 0
+        assert performance_bad.getTime(1024 * 1024) > performance_good.getTime(1024 * 1024)
+
+        time_before = performance_bad.getTime(1024 * 1024)
+        performance_bad.onVerify(False)
+        assert performance_bad.getTime(1024 * 1024) > time_before
+
+        # Recovers after successful downloads
+        for i in range(20):
+            performance_bad.onDownload(1024 * 1024, 1.0, ping=0.1)
+            performance_bad.onVerify(True)
+        assert performance_bad.getTime(1024 * 1024) < performance_good.getTime(1024 * 1024) * 1.01
@@ -0,0 +1,52 @@
+import time
+
+import gevent
+import gevent.event
+
+from util import Pooled
+
+
+class TestPooled:
+    def testPool(self):
+        evt_done = gevent.event.Event()
+
+        @Pooled(2)
+        def blocker(num):
+            evt_done.wait()
+            return num
+
+        threads = [blocker(i) for i in range(5)]
+        time.sleep(0.01)
+        stats = blocker.pooled.getStats()
+        assert stats["in_flight"] == 2
+        assert stats["queued"] + stats["in_flight"] >= 4  # One may wait for a free slot in the pooler
+
+        evt_done.set()
+        assert [thread.get(timeout=1) for thread in threads] == list(range(5))
+        blocker.pooled.pool.join(timeout=1)
+        stats = blocker.pooled.getStats()
+        assert stats["in_flight"] == 0
+        assert stats["queued"] == 0
+        assert stats["started"] == 5
+        assert stats["wait_max"] >= stats["wait_avg"] > 0
+
+    def testBackpressure(self):
+        evt_done = gevent.event.Event()
+
+        @Pooled(1, max_queue=2)
+        def blocker(num):
+            evt_done.wait()
+            return num
+
+        threads = [blocker(i) for i in range(4)]  # 1 running, 1 waiting for a free slot in the pooler, 2 queued
+        time.sleep(0.01)
+        assert blocker.pooled.queue.full()
+
+        # Caller blocked until there is space in the queue
+        adder = gevent.spawn(blocker, 4)
+        time.sleep(0.01)
+        assert not adder.ready()
+
+        evt_done.set()
+        threads.append(adder.get(timeout=1))
+        assert [thread.get(timeout=1) for thread in threads] == list(range(5))
@@ -0,0 +1,43 @@
+import json
+
+from Connection.ProtocolStats import ProtocolStats
+
+
+class TestProtocolStats:
+    def testCounters(self):
+        stats = ProtocolStats()
+        stat = stats.get("getFile")
+        stat.num_sent += 1
+        stat.bytes_sent += 100
+        assert stats.get("getFile") is stat
+        assert stats.getStats()["commands"]["getFile"]["bytes_sent"] == 100
+
+    def testCommandLimit(self):
+        stats = ProtocolStats()
+        for i in range(stats.max_commands + 10):
+            stats.get("cmd%s" % i).num_recv += 1
+        assert len(stats.commands) == stats.max_commands + 1
+        assert stats.get("other").num_recv == 10
+        assert stats.get(None) is stats.get("invalid")
+
+    def testLatency(self):
+        stats = ProtocolStats()
+        stat = stats.get("ping")
+        assert stat.getLatencyPercentile(50, stats.latency_bucket_limits) is None
+        for i in range(90):
+            stats.onLatency(stat, 0.02)
+        for i in range(10):
+            stats.onLatency(stat, 3.0)
+        assert stat.getLatencyPercentile(50, stats.latency_bucket_limits) == 0.025
+        assert stat.getLatencyPercentile(99, stats.latency_bucket_limits) == 3.0  # Capped at the max value
+        latency = stats.getStats()["commands"]["ping"]["latency"]
+        assert latency["num"] == 100
+        assert latency["max"] == 3.0
+
+    def testJson(self):
+        stats = ProtocolStats()
+        stats.onLatency(stats.get("getFile"), 100)
+        stats.onError(ConnectionResetError())
+        data = json.loads(json.dumps(stats.getStats()))
+        assert data["errors"] == {"ConnectionResetError": 1}
+        assert data["commands"]["getFile"]["latency"]["buckets"][-1] == [None, 1]
@@ -0,0 +1,117 @@
+import time
+
+import gevent
+import pytest
+
+from File.RequestScheduler import RequestScheduler, RequestSchedulerBusy
+from Connection.ProtocolStats import ProtocolStats
+
+
+class FakeServer(object):
+    def __init__(self):
+        self.whitelist = []
+        self.stats = ProtocolStats()
+
+
+class FakeConnection(object):
+    def __init__(self, ip):
+        self.ip = ip
+        self.cpu_time = 0.0
+        self.bytes_sent = 0
+        self.sched_vtime = 0.0
+
+
+class TestRequestScheduler:
+    def testFairOrder(self):
+        scheduler = RequestScheduler(FakeServer())
+        scheduler.num_slots = 1
+        greedy = FakeConnection("1.1.1.1")
+        polite = FakeConnection("2.2.2.2")
+        greedy.sched_vtime = 5.0  # Used a lot of cpu before
+        done = []
+
+        def handler(connection, name):
+            time.sleep(0.01)
+            connection.cpu_time += 0.01
+            done.append(name)
+
+        running = gevent.spawn(scheduler.run, polite, "listModified", handler, polite, "first")
+        gevent.sleep(0)  # Takes the only slot
+
+        # Queued requests don't block the caller
+        s = time.time()
+        threads = [
+            scheduler.run(greedy, "listModified", handler, greedy, "greedy"),
+            scheduler.run(polite, "listModified", handler, polite, "polite")
+        ]
+        assert time.time() - s < 0.01
+        assert done == []
+
+        gevent.joinall([running] + threads)
+        assert done == ["first", "polite", "greedy"]
+        assert scheduler.num_running == 0
+        assert scheduler.server.stats.get("listModified").num_queued == 3
+
+    def testIoBound(self):
+        scheduler = RequestScheduler(FakeServer())
+        scheduler.num_slots = 1
+        connection = FakeConnection("1.1.1.1")
+
+        def send(num_bytes):
+            time.sleep(0.01)
+            connection.bytes_sent += num_bytes
+            return "sent"
+
+        running = gevent.spawn(scheduler.run, connection, "listModified", time.sleep, 0.05)
+        gevent.sleep(0)
+        # File sending doesn't wait for a cpu slot, but its cost is accounted
+        assert scheduler.run(connection, "getFile", send, 10 * 1024 * 1024) == "sent"
+        assert scheduler.num_running == 1
+        assert connection.sched_vtime == pytest.approx(1.0)
+        running.join()
+
+    def testQueueFull(self):
+        scheduler = RequestScheduler(FakeServer())
+        scheduler.num_slots = 1
+        scheduler.max_queued = 2
+        connection = FakeConnection("1.1.1.1")
+
+        running = gevent.spawn(scheduler.run, connection, "listModified", time.sleep, 0.05)
+        gevent.sleep(0)
+        threads = [scheduler.run(connection, "listModified", time.sleep, 0.01) for i in range(2)]
+        with pytest.raises(RequestSchedulerBusy):
+            scheduler.run(connection, "listModified", time.sleep, 0.01)
+        assert scheduler.num_rejected == 1
+        gevent.joinall([running] + threads)
+        assert scheduler.num_running == 0
+
+    def testReject(self):
+        scheduler = RequestScheduler(FakeServer())
+        scheduler.num_slots = 1
+        greedy = FakeConnection("1.1.1.1")
+        polite = FakeConnection("2.2.2.2")
+        greedy.sched_vtime = scheduler.max_lag + 5
+
+        running = gevent.spawn(scheduler.run, polite, "listModified", time.sleep, 0.05)
+        gevent.sleep(0)
+        waiting = scheduler.run(polite, "listModified", time.sleep, 0.05)
+        with pytest.raises(RequestSchedulerBusy) as err:
+            scheduler.run(greedy, "listModified", time.sleep, 0.05)
+        assert err.value.retry_after == pytest.approx(5)
+
+        assert scheduler.run(greedy, "ping", lambda: "pong") == "pong"  # Exempt from scheduling
+        gevent.joinall([running, waiting])
+
+    def testKilledWaiter(self):
+        scheduler = RequestScheduler(FakeServer())
+        scheduler.num_slots = 1
+        connection = FakeConnection("1.1.1.1")
+
+        running = gevent.spawn(scheduler.run, connection, "listModified", time.sleep, 0.05)
+        gevent.sleep(0)
+        waiting = scheduler.run(connection, "listModified", time.sleep, 0.05)
+        gevent.sleep(0)
+        waiting.kill()
+        running.join()
+        assert scheduler.num_running == 0
+        assert scheduler.run(connection, "listModified", lambda: "ok") == "ok"
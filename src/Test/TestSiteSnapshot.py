@@ -0,0 +1,113 @@
+import io
+import os
+
+import pytest
+import mock
+
+from Config import config
+from File import FileRequest
+from File import FileServer
+from Site import SiteSnapshot
+from . import Spy
+
+
+@pytest.mark.usefixtures("resetSettings")
+@pytest.mark.usefixtures("resetTempSettings")
+class TestSiteSnapshot:
+    def testPackLoad(self, site, site_temp):
+        files = SiteSnapshot.getSnapshotFiles(site)
+        inner_paths = [inner_path for inner_path, file_path in files]
+        assert inner_paths[0] == "content.json"
+        assert "index.html" in inner_paths
+        # Parent content.json before the included ones, every content.json before its files
+        assert inner_paths.index("data/users/content.json") < inner_paths.index("data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/content.json")
+        assert inner_paths.index("data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/content.json") < inner_paths.index("data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/data.json")
+
+        snapshot_file = io.BytesIO()
+        assert SiteSnapshot.packSnapshot(snapshot_file, files) == len(files)
+
+        # Load in parts as received from the connection
+        loader = SiteSnapshot.SiteSnapshotLoader(site_temp)
+        data = snapshot_file.getvalue()
+        for pos in range(0, len(data), 1024):
+            loader.write(data[pos:pos + 1024])
+        assert not loader.error
+        assert loader.num_loaded + loader.num_failed == len(files)
+
+        assert "data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/content.json" in site_temp.content_manager.contents
+        for inner_path in ["content.json", "index.html", "data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/data.json"]:
+            assert site_temp.storage.read(inner_path) == site.storage.read(inner_path)
+            assert inner_path not in site_temp.bad_files
+
+        # Already present files skipped
+        num_loaded = loader.num_loaded
+        loader = SiteSnapshot.SiteSnapshotLoader(site_temp)
+        loader.write(data)
+        assert loader.num_skipped == num_loaded
+
+    def testLoadInvalid(self, site, site_temp):
+        files = SiteSnapshot.getSnapshotFiles(site)
+        snapshot_file = io.BytesIO()
+        SiteSnapshot.packSnapshot(snapshot_file, files)
+
+        # Modified file after its content.json
+        site.storage.write("index.html", b"modified")
+        tampered_file = io.BytesIO()
+        SiteSnapshot.packSnapshot(tampered_file, files)
+
+        loader = SiteSnapshot.SiteSnapshotLoader(site_temp)
+        loader.write(tampered_file.getvalue())
+        assert not loader.error
+        assert loader.num_failed >= 1
+        assert site_temp.storage.isFile("content.json")
+        assert not site_temp.storage.isFile("index.html")
+        assert site_temp.bad_files.get("index.html")
+
+        # Corrupted stream
+        loader = SiteSnapshot.SiteSnapshotLoader(site_temp)
+        loader.write(b"invalid" + snapshot_file.getvalue())
+        assert loader.error
+        assert not loader.num_loaded
+
+    def testSnapshotDir(self, site):
+        snapshot = SiteSnapshot.getSnapshot(site)
+        assert os.path.dirname(snapshot.path) == str(config.data_dir / ".cache" / "snapshots")
+
+        # Left behind by a crashed run
+        stale_path = config.data_dir / ".cache" / "snapshots" / ("snapshot-%s-stale" % site.address)
+        stale_path.write_bytes(b"stale")
+        assert SiteSnapshot.cleanupSnapshots() == 1
+        assert not stale_path.exists()
+        assert os.path.isfile(snapshot.path)  # Still in use
+
+        SiteSnapshot.deleteSnapshot(site)
+        assert not os.path.isfile(snapshot.path)
+
+    def testDownload(self, file_server, site, site_temp):
+        # Init source server
+        site.connection_server = file_server
+        file_server.sites[site.address] = site
+
+        # Init client server
+        client = FileServer(file_server.ip, 1545)
+        client.sites = {site_temp.address: site_temp}
+        site_temp.connection_server = client
+        site_temp.announce = mock.MagicMock(return_value=True)  # Don't try to find peers from the net
+
+        site_temp.addPeer(file_server.ip, 1544)
+
+        assert site_temp.isSnapshotWanted()
+        with mock.patch.object(config, "download_snapshot", True), Spy.Spy(FileRequest, "route") as requests:
+            assert site_temp.download(blind_includes=True, retry_bad_files=False).get(timeout=10)
+        assert [req[1] for req in requests].count("getSnapshot") == 1
+        # Only the root content.json downloaded file by file
+        files_requested = [req[3]["inner_path"] for req in requests if req[1] in ("getFile", "streamFile")]
+        assert "content.json" in files_requested
+        assert "index.html" not in files_requested
+
+        assert site_temp.storage.isFile("index.html")
+        assert site_temp.storage.isFile("data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/data.json")
+        assert not site_temp.isSnapshotWanted()
+
+        assert site_temp.storage.deleteFiles()
+        [connection.close() for connection in file_server.connections]
@@ -1,5 +1,10 @@
+import os
+
 import pytest
 
+from util import Msgpack
+from Site.SiteStorage import SiteStorage
+
 
 @pytest.mark.usefixtures("resetSettings")
 class TestSiteStorage:
@@ -23,3 +28,46 @@ class TestSiteStorage:
 
     def testDbRebuild(self, site):
         assert site.storage.rebuildDb()
+
+    def testJsonCache(self, site):
+        inner_path = "data/users/1CjfbrbwtP8Y2QjPy12vpTATkUT7oSiPQ9/content.json"
+        cache_path = site.storage.getJsonCachePath(inner_path)
+        site.storage.deleteJsonCache(inner_path)
+
+        data = site.storage.loadJson(inner_path)
+        assert cache_path.is_file()
+        assert site.storage.loadJson(inner_path) == data
+
+        # Loaded from the cache while the file is unchanged
+        with open(cache_path, "wb") as cache_file:
+            cache_file.write(Msgpack.pack({"inner_path": inner_path, "size": site.storage.getSize(inner_path), "mtime": os.stat(site.storage.getPath(inner_path)).st_mtime_ns, "data": {"cached": True}}))
+        assert site.storage.loadJson(inner_path) == {"cached": True}
+
+        # Invalidated on write
+        site.storage.writeJson(inner_path, data)
+        assert not cache_path.is_file()
+        assert site.storage.loadJson(inner_path) == data
+
+        # Corrupted cache
+        with open(cache_path, "wb") as cache_file:
+            cache_file.write(b"invalid")
+        assert site.storage.loadJson(inner_path) == data
+
+    def testDownloadDir(self, site):
+        download_file = site.storage.openDownload("data/img/new.png")
+        download_file.write(b"downloaded")
+        assert os.path.dirname(download_file.path) == str(site.storage.download_dir)
+        assert not site.storage.isFile("data/img/new.png")
+
+        site.storage.writeDownload("data/img/new.png", download_file)
+        assert site.storage.read("data/img/new.png") == b"downloaded"
+        assert not os.listdir(site.storage.download_dir)
+
+        # Left behind by a crashed download, removed on the next site load
+        left_file = site.storage.openDownload("data/img/left.png")
+        left_file.write(b"partial")
+        left_file.file.flush()
+        SiteStorage(site)
+        assert not os.path.isfile(left_file.path)
+        left_file.file.close()
+        site.storage.delete("data/img/new.png")
@@ -0,0 +1,49 @@
+import time
+
+import gevent
+
+from util.TimerHeap import TimerHeap
+
+
+class TestTimerHeap:
+    def testOrder(self):
+        timers = TimerHeap()
+        called = []
+        timers.scheduleAfter(0.2, called.append, "third")
+        timers.scheduleAfter(0.1, called.append, "second")
+        timers.scheduleAfter(0.05, called.append, "first")
+        time.sleep(0.3)
+        assert called == ["first", "second", "third"]
+        assert len(timers) == 0
+        timers.stop()
+
+    def testCancel(self):
+        timers = TimerHeap()
+        called = []
+        timer = timers.scheduleAfter(0.05, called.append, "cancelled")
+        timers.scheduleAfter(0.1, called.append, "called")
+        timers.cancel(timer)
+        time.sleep(0.15)
+        assert called == ["called"]
+        timers.stop()
+
+    def testEarlierDeadline(self):
+        timers = TimerHeap()
+        called = []
+        timers.scheduleAfter(10, called.append, "late")
+        gevent.sleep(0.01)  # Runner is waiting for the 10 sec deadline
+        s = time.time()
+        timers.scheduleAfter(0.05, called.append, "early")
+        time.sleep(0.1)
+        assert called == ["early"]
+        assert time.time() - s < 1
+        timers.stop()
+
+    def testError(self):
+        timers = TimerHeap()
+        called = []
+        timers.scheduleAfter(0.01, lambda: 1 / 0)
+        timers.scheduleAfter(0.02, called.append, "after error")
+        time.sleep(0.05)
+        assert called == ["after error"]
+        timers.stop()
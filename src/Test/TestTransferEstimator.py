@@ -0,0 +1,37 @@
+from Connection.TransferEstimator import TransferEstimator
+
+
+class TestTransferEstimator:
+    def testDefault(self):
+        transfer = TransferEstimator()
+        assert transfer.getReadBytes() == 512 * 1024
+        assert transfer.getReadBytes(file_size=10 * 1024 * 1024) == 1024 * 1024
+
+    def testGrowFast(self):
+        transfer = TransferEstimator()
+        for i in range(10):
+            transfer.onTransfer(transfer.read_bytes, 0.05, ping=0.01)  # 10MB/s+
+        assert transfer.getReadBytes() == transfer.max_read_bytes
+
+    def testShrinkSlow(self):
+        transfer = TransferEstimator()
+        for i in range(10):
+            transfer.onTransfer(64 * 1024, 4.0, ping=2.0)  # 16kB/s onion peer
+        read_bytes_slow = transfer.getReadBytes()
+        assert read_bytes_slow < 512 * 1024
+        assert read_bytes_slow >= transfer.min_read_bytes
+        assert read_bytes_slow % (16 * 1024) == 0
+
+    def testStall(self):
+        transfer = TransferEstimator()
+        transfer.onStall()
+        assert transfer.getReadBytes() == 256 * 1024
+        for i in range(10):
+            transfer.onStall()
+        assert transfer.getReadBytes() == transfer.min_read_bytes
+
+    def testSeed(self):
+        transfer = TransferEstimator()
+        assert transfer.seed(10 * 1024 * 1024, 10.0)
+        assert transfer.speed == 1024 * 1024
+        assert not transfer.seed(1, 10.0)  # Already has samples
@@ -1,5 +1,14 @@
 import sys
+import json
+import time
+
+import gevent
+import gevent.event
 import pytest
+import mock
+
+from Config import config
+from Ui import UiWebsocket
 
 @pytest.mark.usefixtures("resetSettings")
 class TestUiWebsocket:
@@ -9,3 +18,94 @@ class TestUiWebsocket:
 
         res = ui_websocket.testAction("certList")
         assert "You don't have permission" in res["error"]
+
+    def testSendQueueFull(self):
+        class SlowWs(object):
+            def __init__(self):
+                self.sent = []
+                self.closed = False
+                self.event_read = gevent.event.Event()
+
+            def send(self, data):
+                self.event_read.wait()  # Client not reading
+                self.sent.append(json.loads(data))
+
+            def close(self):
+                self.closed = True
+
+        ws = SlowWs()
+        ui_websocket = UiWebsocket(ws, mock.MagicMock(), None, None, None)
+        ui_websocket.send_queue_max = 10
+
+        sender = gevent.spawn(ui_websocket.cmd, "notification", ["info", "first"])
+        gevent.sleep(0)
+        s = time.time()
+        for i in range(10):
+            ui_websocket.cmd("setSiteInfo", {"address": "1site", "peers": i})
+        for i in range(10, 100):
+            ui_websocket.cmd("setSiteInfo", {"address": "1site", "peers": i})
+            ui_websocket.cmd("setSiteInfo", {"address": "1other", "peers": i})
+        ui_websocket.cmd("setSiteInfo", {"address": "1site", "peers": 100, "event": ["file_done", "index.html"]})
+        ui_websocket.cmd("setSiteInfo", {"address": "1site", "peers": 101})
+        for i in range(5):
+            ui_websocket.cmd("notification", ["info", i])
+        ui_websocket.response(1, "ok")
+        assert time.time() - s < 0.1  # Callers never wait for the client
+
+        # Only the state updates without event coalesced
+        assert len(ui_websocket.send_queue) == 10 + 1 + 2 + 5 + 1
+        assert ui_websocket.send_queue[9]["params"] == {"address": "1site", "peers": 99}
+        assert ui_websocket.send_queue[10]["params"] == {"address": "1other", "peers": 99}
+
+        ws.event_read.set()
+        sender.join()
+        assert len(ws.sent) == 20
+        site_infos = [message["params"] for message in ws.sent if message.get("cmd") == "setSiteInfo"]
+        assert [site_info["peers"] for site_info in site_infos if site_info["address"] == "1site"] == list(range(9)) + [99, 100, 101]
+        assert [site_info["peers"] for site_info in site_infos if site_info["address"] == "1other"] == [99]
+        assert [message["params"][1] for message in ws.sent if message.get("cmd") == "notification"] == ["first"] + list(range(5))
+        assert ws.sent[-1]["result"] == "ok"
+        assert not ui_websocket.send_queue_states
+        assert not ui_websocket.send_queue_full_since
+
+        # Client that stays over the limit gets closed
+        ws.event_read.clear()
+        sender = gevent.spawn(ui_websocket.cmd, "notification", ["info", "first"])
+        gevent.sleep(0)
+        for i in range(11):
+            ui_websocket.cmd("notification", ["info", i])
+        assert len(ui_websocket.send_queue) == 11
+        with mock.patch("time.time", return_value=time.time() + 61):
+            ui_websocket.cmd("notification", ["info", 11])
+        assert ws.closed
+        assert not ui_websocket.send_queue
+        ws.event_read.set()
+        sender.join()
+
+    def testConfigSetBandwidthLimit(self):
+        ws = mock.MagicMock()
+        ui_websocket = UiWebsocket(ws, mock.MagicMock(), None, None, None)
+        main = mock.MagicMock()
+
+        def configSet(key, value):
+            ui_websocket.actionConfigSet(1, key, value)
+            return json.loads(ws.send.call_args[0][0])["result"]
+
+        peer_upload_limit = config.peer_upload_limit
+        with mock.patch.dict(sys.modules, {"main": main}), mock.patch.object(config, "saveValue") as saveValue:
+            for value in ["abc", -1, True, [10]]:
+                assert "Invalid value" in configSet("peer_upload_limit", value)["error"]
+            assert not saveValue.called
+            assert config.peer_upload_limit == peer_upload_limit
+
+            try:
+                assert configSet("peer_upload_limit", "100") == "ok"
+                saveValue.assert_called_with("peer_upload_limit", 100)
+                assert config.peer_upload_limit == 100
+                assert main.file_server.bandwidth.updateLimits.called
+
+                assert configSet("peer_upload_limit", None) == "ok"  # Default value
+                assert config.peer_upload_limit == 0
+            finally:
+                config.peer_upload_limit = peer_upload_limit
+                config.arguments.peer_upload_limit = peer_upload_limit
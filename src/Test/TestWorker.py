@@ -0,0 +1,153 @@
+import io
+import time
+import logging
+
+import gevent
+import gevent.event
+
+from Peer import Peer
+from Worker import Worker
+from Content.ContentManager import VerifyError
+from Worker.WorkerTask import WorkerTask
+
+
+class FakeWorkerManager(object):
+    def __init__(self):
+        self.tasks = []
+        self.event_task_available = gevent.event.Event()
+        self.log = logging.getLogger("FakeWorkerManager")
+        self.tasks_scheduled = []
+
+    def getTask(self, peer):
+        return next((task for task in self.tasks if not task["done"]), None)
+
+    def findWorkers(self, task):  # Other worker of the task, receiving data all the time
+        connection = type("FakeConnection", (), {"last_recv_time": property(lambda self: time.time())})()
+        peer = type("FakePeer", (), {"connection": connection})()
+        return [type("FakeWorker", (), {"peer": peer, "key": "busy"})()]
+
+    def scheduleTaskCheck(self, task):
+        self.tasks_scheduled.append(task)
+
+    def addTask(self, task):
+        self.tasks.append(task)
+        event, self.event_task_available = self.event_task_available, gevent.event.Event()
+        event.set()
+
+    def addTaskWorker(self, task, worker):
+        task["workers_num"] += 1
+
+    def removeTaskWorker(self, task, worker):
+        task["workers_num"] -= 1
+
+    def doneTask(self, task):
+        task["done"] = True
+        self.tasks.remove(task)
+
+
+class FakeSite(object):
+    address = "1FakeSite"
+
+    def __init__(self, files):
+        self.files = files
+        self.written = {}
+        self.content_manager = self
+        self.storage = self
+
+    def verifyFile(self, inner_path, file):
+        if file.read() != self.files[inner_path]:
+            raise VerifyError("Invalid hash")
+        return True
+
+    def write(self, inner_path, file):
+        self.written[inner_path] = file.read()
+
+
+class FakeBatchPeer(Peer):
+    def getFiles(self, site, inner_paths, file_sizes=None):
+        return {inner_path: io.BytesIO(body) for inner_path, body in self.files_batch.items()}
+
+    def getFile(self, site, inner_path, file_size=None, buff=None):
+        return io.BytesIO(self.files[inner_path])
+
+
+class TestWorker:
+    def testWaitForTask(self):
+        worker = Worker(FakeWorkerManager(), None)
+        task = WorkerTask(1, gevent.event.AsyncResult(), None, "data.json")
+        task["workers_num"] = 1
+
+        def done():
+            task["done"] = True
+            task.onChanged()
+
+        # Woken up by the other worker finishing the task
+        gevent.spawn_later(0.05, done)
+        s = time.time()
+        assert worker.waitForTask(task, 3)
+        assert time.time() - s < 0.5
+        assert task["done"]
+
+        # Woken up by the other worker leaving the task
+        task = WorkerTask(2, gevent.event.AsyncResult(), None, "data.json")
+        task["workers_num"] = 1
+        gevent.spawn_later(0.05, lambda: (task.__setitem__("workers_num", 0), task.onChanged()))
+        s = time.time()
+        assert worker.waitForTask(task, 3)
+        assert time.time() - s < 0.5
+        assert not task["done"]
+
+    def testPickTask(self):
+        manager = FakeWorkerManager()
+        worker = Worker(manager, None)
+        assert worker.pickTask() is False  # No task
+
+        # Idle worker gets the task added while waiting
+        task = WorkerTask(1, gevent.event.AsyncResult(), None, "data.json")
+        gevent.spawn_later(0.01, manager.addTask, task)
+        assert worker.pickTask() is task
+        assert task["time_started"]
+        assert manager.tasks_scheduled == [task]  # Deadline scheduled on start
+
+    def testIsTaskBehind(self):
+        manager = FakeWorkerManager()
+        worker_slow = Worker(manager, Peer("127.0.0.1", 1001))
+        worker_fast = Worker(manager, Peer("127.0.0.1", 1002))
+        manager.findWorkers = lambda task: [worker_slow]
+        task = WorkerTask(1, gevent.event.AsyncResult(), None, "data.json", size=10 * 1024 * 1024)
+        task["time_started"] = time.time()
+
+        assert not worker_fast.isTaskBehind(task)  # No measurements yet
+
+        worker_slow.peer.performance.onDownload(1024 * 1024, 1.0, ping=0.1)
+        worker_fast.peer.performance.onDownload(1024 * 1024, 0.1, ping=0.1)
+        assert worker_fast.isTaskBehind(task)  # Slow worker needs 10 sec, we need 1 sec
+        assert not worker_slow.isTaskBehind(task)
+
+        # Slow worker almost done with it
+        task["time_started"] = time.time() - 9.5
+        assert not worker_fast.isTaskBehind(task)
+
+        # Over its expected time
+        task["time_started"] = time.time() - 20
+        assert worker_fast.isTaskBehind(task)
+
+    def testHandleTaskBatch(self):
+        manager = FakeWorkerManager()
+        manager.started_task_num = 0
+        site = FakeSite({"data/users/1/data.json": b"1", "data/users/2/data.json": b"2", "data/users/3/data.json": b"3"})
+        peer = FakeBatchPeer("127.0.0.1", 1001)
+        worker = Worker(manager, peer)
+        tasks = [WorkerTask(i, gevent.event.AsyncResult(), site, inner_path) for i, inner_path in enumerate(sorted(site.files))]
+        for task in tasks:
+            manager.addTask(task)
+
+        peer.files_batch = {"data/users/1/data.json": b"1", "data/users/2/data.json": b"invalid"}
+        peer.files = site.files
+        worker.running = True
+        worker.handleTaskBatch(tasks)
+
+        assert site.written == {"data/users/1/data.json": b"1", "data/users/3/data.json": b"3"}  # Missing one downloaded separately
+        assert [task["done"] for task in tasks] == [True, False, True]
+        assert tasks[1]["failed"] == {peer}  # Failed verification only for the bad file
+        assert [task["workers_num"] for task in tasks] == [0, 0, 0]
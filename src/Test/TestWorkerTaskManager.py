@@ -1,6 +1,7 @@
 import pytest
 
 from Worker import WorkerTaskManager
+from Worker.WorkerTask import WorkerTask
 from . import Spy
 
 
@@ -126,3 +127,85 @@ class TestUiWebsocket:
         assert not tasks.findTask("file-unknown.json")
         tasks.remove(tasks.findTask("file999.json"))
         assert not tasks.findTask("file999.json")
+
+    def testGetTask(self):
+        tasks = WorkerTaskManager.WorkerTaskManager()
+        task_open = WorkerTask(1, None, None, "open.json", priority=1)
+        task_locked = WorkerTask(2, None, None, "locked.json", peers=["peer1"], priority=5)
+        task_optional = WorkerTask(3, None, None, "optional.jpg", optional_hash_id=1234, priority=10)
+        for task in (task_open, task_locked, task_optional):
+            tasks.append(task)
+
+        assert tasks.getTask("peer1") == task_locked
+        assert tasks.getTask("peer2") == task_open  # Not allowed to pick the locked task
+
+        # Optional task picked only after peers found
+        task_optional["peers"] = ["peer2"]
+        tasks.updatePeers(task_optional)
+        assert tasks.getTask("peer2") == task_optional
+        assert tasks.getTask("peer1") == task_locked
+
+        # Failed peer skips the task
+        tasks.markFailed(task_locked, "peer1")
+        assert tasks.getTask("peer1") == task_open
+
+        # Priority updates reorder the queues
+        tasks.updateItem(task_open, "workers_num", 1)
+        tasks.updateItem(task_optional, "priority", 0)
+        assert tasks.getTask("peer2") == task_optional
+
+        tasks.remove(task_optional)
+        tasks.remove(task_open)
+        assert tasks.getTask("peer2") is None
+        assert len(tasks.queued) == 1
+
+    def testIterTasks(self):
+        tasks = WorkerTaskManager.WorkerTaskManager()
+        task_open = WorkerTask(1, None, None, "open.json", priority=1)
+        task_locked = WorkerTask(2, None, None, "locked.json", peers=["peer1"], priority=5)
+        task_other = WorkerTask(3, None, None, "other.json", peers=["peer2"], priority=10)
+        task_failed = WorkerTask(4, None, None, "failed.json", priority=3)
+        task_failed["failed"].add("peer1")
+        for task in (task_open, task_locked, task_other, task_failed):
+            tasks.append(task)
+
+        assert list(tasks.iterTasks("peer1")) == [task_locked, task_open]
+        assert list(tasks.iterTasks("peer2")) == [task_other, task_failed, task_open]
+
+    def testFailedPeerQueues(self):
+        tasks = WorkerTaskManager.WorkerTaskManager()
+        for i in range(100):
+            tasks.append(WorkerTask(i, None, None, "file%s.json" % i, priority=100 - i))
+        task_locked = WorkerTask(100, None, None, "locked.json", peers=["peer1"], priority=50)
+        tasks.append(task_locked)
+
+        # The failed tasks are not walked again by the peer
+        for i in range(50):
+            tasks.markFailed(tasks.findTask("file%s.json" % i), "peer1")
+        tasks.markFailed(task_locked, "peer1")
+        assert len(tasks.queue_open_peers["peer1"]) == 50
+        assert "peer1" not in tasks.queue_peers
+        assert tasks.getTask("peer1") == tasks.findTask("file50.json")
+        assert tasks.getTask("peer2") == tasks.findTask("file0.json")
+        assert tasks.findTask("file0.json")["failed"] == {"peer1"}
+
+        # Failures kept on priority change, new open tasks added to the peer's queue
+        tasks.updateItem(tasks.findTask("file0.json"), "priority", 1000)
+        assert tasks.getTask("peer1") == tasks.findTask("file50.json")
+        task_new = WorkerTask(101, None, None, "new.json", priority=1000)
+        tasks.append(task_new)
+        assert tasks.getTask("peer1") == task_new
+        tasks.remove(task_new)
+
+        # Allowed again after a new update
+        tasks.unmarkFailed(tasks.findTask("file1.json"), "peer1")
+        assert tasks.getTask("peer1") == tasks.findTask("file1.json")
+        tasks.unmarkFailed(task_locked, "peer1")
+        assert list(tasks.iterTasks("peer1"))[:3] == [tasks.findTask("file1.json"), tasks.findTask("file50.json"), task_locked]
+
+        # Removed tasks forgotten
+        for i in range(50):
+            tasks.remove(tasks.findTask("file%s.json" % i))
+        assert not tasks.excluded
+        assert not tasks.queue_open_peers
+        assert tasks.getTask("peer1") == tasks.findTask("file50.json")
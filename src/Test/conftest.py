@@ -72,6 +72,7 @@ config.debug_socket = True  # Use test data for unittests
 config.verbose = True  # Use test data for unittests
 config.tor = "disable"  # Don't start Tor client
 config.trackers = []
+config.download_snapshot = False  # Test the file by file download, snapshots tested separately
 config.data_dir = TEST_DATA_PATH  # Use test data for unittests
 if "ZERONET_LOG_DIR" in os.environ:
     config.log_dir = os.environ["ZERONET_LOG_DIR"]
@@ -7,6 +7,7 @@ import re
 import copy
 import logging
 import stat
+import collections
 from pathlib import Path
 
 import gevent
@@ -28,6 +29,10 @@ from Content.ContentManager import VerifyError, SignError
 
 @PluginManager.acceptPlugins
 class UiWebsocket(object):
+    send_queue_max = 1000  # Above this number of queued messages new states replace the queued ones of the same cmd
+    send_queue_full_timeout = 60  # Close the client if its send queue stays full for this many seconds
+    send_queue_state_cmds = ("setSiteInfo", "setServerInfo", "setAnnouncerInfo")  # Only the latest one matters without event
+
     def __init__(self, ws, site, server, user, request):
         self.ws = ws
         self.site = site
@@ -40,7 +45,9 @@ class UiWebsocket(object):
         self.waiting_cb = {}  # Waiting for callback. Key: message_id, Value: function pointer
         self.channels = []  # Channels joined to
         self.state = {"sending": False}  # Shared state of websocket connection
-        self.send_queue = []  # Messages to send to client
+        self.send_queue = collections.deque()  # Messages to send to client
+        self.send_queue_states = {}  # (Cmd, site address) -> Its last queued state message
+        self.send_queue_full_since = None
 
     # Start listener loop
     def start(self):
@@ -167,19 +174,60 @@ class UiWebsocket(object):
         self.next_message_id += 1
         if cb:  # Callback after client responded
             self.waiting_cb[message["id"]] = cb
+        if len(self.send_queue) >= self.send_queue_max and self.onSendQueueFull(message, cb):
+            return
         self.send_queue.append(message)
+        state_key = self.getStateKey(message)
+        if state_key:
+            if cb or "event" in message["params"]:
+                self.send_queue_states.pop(state_key, None)  # Keep the order of the states around the event
+            else:
+                self.send_queue_states[state_key] = message
         if self.state["sending"]:
             return  # Already sending
         try:
             while self.send_queue:
                 self.state["sending"] = True
-                message = self.send_queue.pop(0)
+                message = self.send_queue.popleft()
+                state_key = self.getStateKey(message)
+                if state_key and self.send_queue_states.get(state_key) is message:
+                    del self.send_queue_states[state_key]
                 self.ws.send(json.dumps(message))
                 self.state["sending"] = False
+                if self.send_queue_full_since and len(self.send_queue) < self.send_queue_max:
+                    self.send_queue_full_since = None
         except Exception as err:
             self.log.debug("Websocket send error: %s" % Debug.formatException(err))
             self.state["sending"] = False
 
+    # Return: Key of the message if it's a state update that a newer one of the same key makes obsolete
+    def getStateKey(self, message):
+        if message.get("cmd") not in self.send_queue_state_cmds or type(message.get("params")) is not dict:
+            return None
+        return (message["cmd"], message["params"].get("address"))
+
+    # Client reads slower than we produce: never make the sender wait, coalesce the state updates instead
+    # Return: True if the message does not need to be queued
+    def onSendQueueFull(self, message, cb):
+        if not self.send_queue_full_since:
+            self.send_queue_full_since = time.time()
+            self.log.debug("Websocket send queue full: %s messages" % len(self.send_queue))
+        elif time.time() - self.send_queue_full_since > self.send_queue_full_timeout:
+            self.log.info("Websocket send queue full for %.0fs, closing" % (time.time() - self.send_queue_full_since))
+            self.send_queue.clear()
+            self.send_queue_states.clear()
+            self.ws.close()
+            return True
+
+        state_key = self.getStateKey(message)
+        if not state_key or cb or "event" in message["params"]:
+            return False  # Queued, the client gets closed if it doesn't catch up
+        queued = self.send_queue_states.get(state_key)
+        if queued is None:
+            return False
+        queued["params"] = message["params"]
+        return True
+
     def getPermissions(self, req_id):
         permissions = self.site.settings["permissions"]
         if req_id >= 1000000:  # Its a wrapper command, allow admin commands
@@ -339,7 +387,8 @@ class UiWebsocket(object):
                 # For compat only
                 'plugins_rev' : {},
                 'user_settings' : self.user.settings,
-                'lib_verify_best' : CryptBitcoin.lib_verify_best
+                'lib_verify_best' : CryptBitcoin.lib_verify_best,
+                'bandwidth' : file_server.bandwidth.getInfo(file_server.bytes_sent, file_server.bytes_recv)
             }
         else:
             back = {
@@ -1312,6 +1361,17 @@ class UiWebsocket(object):
                 self.response(to, {"error": "Forbidden: Invalid value"})
                 return
 
+        if key in config.keys_bandwidth_limit and value is not None:
+            try:
+                if type(value) is bool:
+                    raise ValueError("Not a number")
+                value = int(value)
+                if value < 0:
+                    raise ValueError("Negative limit")
+            except (TypeError, ValueError):
+                self.response(to, {"error": "Forbidden: Invalid value"})
+                return
+
         # Remove empty lines from lists
         if type(value) is list:
             value = [line for line in value if line]
@@ -1354,6 +1414,9 @@ class UiWebsocket(object):
         if key == "ip_external":
             gevent.spawn(main.file_server.portCheck)
 
+        if key in config.keys_bandwidth_limit:
+            main.file_server.bandwidth.updateLimits()
+
         if key == "offline":
             if value:
                 main.file_server.closeConnections()
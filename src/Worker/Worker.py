@@ -7,6 +7,7 @@ import gevent.lock
 from Debug import Debug
 from Config import config
 from Content.ContentManager import VerifyError
+from util.DownloadFile import DownloadFile
 
 import traceback
 
@@ -34,6 +35,7 @@ class Worker(object):
         self.thread = None
         self.num_downloaded = 0
         self.num_failed = 0
+        self.preempted = None  # Reason to stop after the current task
 
     def __str__(self):
         return "Worker %s %s" % (self.manager.site.address_short, self.key)
@@ -42,32 +44,56 @@ class Worker(object):
         return "<%s>" % self.__str__()
 
     def waitForTask(self, task, timeout):  # Wait for other workers to finish the task
-        for sleep_i in range(1, timeout * 10):
-            time.sleep(0.1)
+        time_start = time.time()
+        while True:
+            event = task["event_changed"]
             if task["done"] or task["workers_num"] == 0:
                 if config.verbose:
-                    self.manager.log.debug("%s: %s, picked task free after %ss sleep. (done: %s)" % (
-                        self.key, task["inner_path"], 0.1 * sleep_i, task["done"]
+                    self.manager.log.debug("%s: %s, picked task free after %.3fs wait. (done: %s)" % (
+                        self.key, task["inner_path"], time.time() - time_start, task["done"]
                     ))
                 break
 
-            if sleep_i % 10 == 0:
-                workers = self.manager.findWorkers(task)
-                if not workers or not workers[0].peer.connection:
-                    break
-                worker_idle = time.time() - workers[0].peer.connection.last_recv_time
-                if worker_idle > 1:
-                    if config.verbose:
-                        self.manager.log.debug("%s: %s, worker %s seems idle, picked up task after %ss sleep. (done: %s)" % (
-                            self.key, task["inner_path"], workers[0].key, 0.1 * sleep_i, task["done"]
-                        ))
-                    break
+            time_left = time_start + timeout - time.time()
+            if time_left <= 0:
+                break
+            if event.wait(min(time_left, 1)):  # Task done, failed or a worker left it
+                continue
+
+            workers = self.manager.findWorkers(task)
+            if not workers or not workers[0].peer.connection:
+                break
+            worker_idle = time.time() - workers[0].peer.connection.last_recv_time
+            if worker_idle > 1:
+                if config.verbose:
+                    self.manager.log.debug("%s: %s, worker %s seems idle, picked up task after %.3fs wait. (done: %s)" % (
+                        self.key, task["inner_path"], workers[0].key, time.time() - time_start, task["done"]
+                    ))
+                break
+        return True
+
+    # Return: True if the other workers of the task are expected to finish it a lot later than us
+    def isTaskBehind(self, task):
+        performance = self.peer.performance
+        if not performance.num_samples or not task["time_started"]:
+            return False
+        workers = [worker for worker in self.manager.findWorkers(task) if worker is not self]
+        if not workers:
+            return False
+        time_left_me = performance.getTime(task["size"], ping=self.peer.getPing())
+        for worker in workers:
+            if not worker.peer.performance.num_samples:
+                return False
+            time_done = task["time_started"] + worker.peer.performance.getTime(task["size"], ping=worker.peer.getPing())
+            if time_done > time.time() and time_done - time.time() < time_left_me * 2:
+                return False  # Expected to finish soon enough
         return True
 
     def pickTask(self):  # Find and select a new task for the worker
+        event = self.manager.event_task_available
         task = self.manager.getTask(self.peer)
         if not task:  # No more task
-            time.sleep(0.1)  # Wait a bit for new tasks
+            event.wait(0.1)  # Wait a bit for new tasks
             task = self.manager.getTask(self.peer)
             if not task:  # Still no task, stop it
                 stats = "downloaded files: %s, failed: %s" % (self.num_downloaded, self.num_failed)
@@ -76,8 +102,12 @@ class Worker(object):
 
         if not task["time_started"]:
             task["time_started"] = time.time()  # Task started now
+            self.manager.scheduleTaskCheck(task)
 
-        if task["workers_num"] > 0:  # Wait a bit if someone already working on it
+        if task["workers_num"] > 0 and self.isTaskBehind(task):  # Endgame: Download it in parallel with the slow worker
+            if config.verbose:
+                self.manager.log.debug("%s: Workers of %s behind, downloading it in parallel" % (self.key, task["inner_path"]))
+        elif task["workers_num"] > 0:  # Wait a bit if someone already working on it
             if task["peers"]:  # It's an update
                 timeout = 3
             else:
@@ -94,17 +124,33 @@ class Worker(object):
             self.waitForTask(task, timeout)
         return task
 
+    # Large files are downloaded to a temporary file in the site dir and hashed while received
+    def isDownloadToDisk(self, task):
+        inner_path = task["inner_path"]
+        if inner_path.endswith("content.json") or "|" in inner_path:
+            return False  # Verified by signature or piece hash
+        return config.stream_downloads or task["size"] >= 1024 * 1024
+
     def downloadTask(self, task):
+        if self.isDownloadToDisk(task):
+            buff = task["site"].storage.openDownload(task["inner_path"])
+        else:
+            buff = None
         try:
-            buff = self.peer.getFile(task["site"].address, task["inner_path"], task["size"])
+            res = self.peer.getFile(task["site"].address, task["inner_path"], task["size"], buff=buff)
         except Exception as err:
             self.manager.log.debug("%s: getFile error: %s" % (self.key, err))
-            raise WorkerDownloadError(str(err))
+            res = None
+            download_err = WorkerDownloadError(str(err))
+        else:
+            download_err = WorkerDownloadError("No response")
 
-        if not buff:
-            raise WorkerDownloadError("No response")
+        if not res:
+            if isinstance(buff, DownloadFile):
+                buff.delete()
+            raise download_err
 
-        return buff
+        return res
 
     def getTaskLock(self, task):
         if task["lock"] is None:
@@ -114,7 +160,10 @@ class Worker(object):
     def writeTask(self, task, buff):
         buff.seek(0)
         try:
-            task["site"].storage.write(task["inner_path"], buff)
+            if isinstance(buff, DownloadFile):
+                task["site"].storage.writeDownload(task["inner_path"], buff)
+            else:
+                task["site"].storage.write(task["inner_path"], buff)
         except Exception as err:
             if type(err) == Debug.Notify:
                 self.manager.log.debug("%s: Write aborted: %s (%s: %s)" % (self.key, task["inner_path"], type(err), err))
@@ -134,8 +183,10 @@ class Worker(object):
             else:
                 tbk = traceback.format_exception(error)
             self.manager.log.debug(''.join(tbk))
-        task["failed"].append(self.peer)
+        self.manager.tasks.markFailed(task, self.peer)
         self.peer.hash_failed += 1
+        if isinstance(error, VerifyError):
+            self.peer.performance.onVerify(False)
         if self.peer.hash_failed >= max(len(self.manager.tasks), 3) or self.peer.connection_error > 10:
             # Broken peer: More fails than tasks number but atleast 3
             raise WorkerStop(
@@ -143,58 +194,95 @@ class Worker(object):
                 (self.peer.hash_failed, self.peer.connection_error)
             )
 
-    def handleTask(self, task):
+    def handleTask(self, task, buff=None):
         download_err = write_err = False
 
         write_lock = None
         try:
-            buff = self.downloadTask(task)
-
-            if task["done"] is True:  # Task done, try to find new one
-                return None
+            try:
+                if buff is None:  # Not received in a batch
+                    buff = self.downloadTask(task)
+
+                if task["done"] is True:  # Task done, try to find new one
+                    return None
+
+                if self.running is False:  # Worker no longer needed or got killed
+                    self.manager.log.debug("%s: No longer needed, returning: %s" % (self.key, task["inner_path"]))
+                    raise WorkerStop("Running got disabled")
+
+                write_lock = self.getTaskLock(task)
+                write_lock.acquire()
+                if task["site"].content_manager.verifyFile(task["inner_path"], buff) is None:
+                    is_same = True
+                else:
+                    is_same = False
+                is_valid = True
+                self.peer.performance.onVerify(True)
+            except (WorkerDownloadError, VerifyError) as err:
+                download_err = err
+                is_valid = False
+                is_same = False
 
-            if self.running is False:  # Worker no longer needed or got killed
-                self.manager.log.debug("%s: No longer needed, returning: %s" % (self.key, task["inner_path"]))
-                raise WorkerStop("Running got disabled")
+            if is_valid and not is_same:
+                if self.manager.started_task_num < 50 or task["priority"] > 10 or config.verbose:
+                    self.manager.log.debug("%s: Verify correct: %s" % (self.key, task["inner_path"]))
+                try:
+                    self.writeTask(task, buff)
+                except WorkerIOError as err:
+                    write_err = err
+
+            if not task["done"]:
+                if write_err:
+                    self.manager.failTask(task, reason="Write error")
+                    self.num_failed += 1
+                    self.manager.log.error("%s: Error writing %s: %s" % (self.key, task["inner_path"], write_err))
+                elif is_valid:
+                    self.manager.doneTask(task)
+                    self.num_downloaded += 1
+
+            if write_lock is not None and write_lock.locked():
+                write_lock.release()
+
+            if not is_valid:
+                self.onTaskVerifyFail(task, download_err)
+                time.sleep(1)
+                return False
 
-            write_lock = self.getTaskLock(task)
-            write_lock.acquire()
-            if task["site"].content_manager.verifyFile(task["inner_path"], buff) is None:
-                is_same = True
-            else:
-                is_same = False
-            is_valid = True
-        except (WorkerDownloadError, VerifyError) as err:
-            download_err = err
-            is_valid = False
-            is_same = False
-
-        if is_valid and not is_same:
-            if self.manager.started_task_num < 50 or task["priority"] > 10 or config.verbose:
-                self.manager.log.debug("%s: Verify correct: %s" % (self.key, task["inner_path"]))
-            try:
-                self.writeTask(task, buff)
-            except WorkerIOError as err:
-                write_err = err
-
-        if not task["done"]:
-            if write_err:
-                self.manager.failTask(task, reason="Write error")
-                self.num_failed += 1
-                self.manager.log.error("%s: Error writing %s: %s" % (self.key, task["inner_path"], write_err))
-            elif is_valid:
-                self.manager.doneTask(task)
-                self.num_downloaded += 1
-
-        if write_lock is not None and write_lock.locked():
-            write_lock.release()
-
-        if not is_valid:
-            self.onTaskVerifyFail(task, download_err)
-            time.sleep(1)
-            return False
+            return True
+        finally:
+            if isinstance(buff, DownloadFile):
+                buff.delete()  # Not moved in place: failed, aborted or done by an other worker
+
+    # Download the small tasks in one request, the files not received in it one by one
+    def handleTaskBatch(self, tasks):
+        for task in tasks:
+            if not task["time_started"]:
+                task["time_started"] = time.time()
+                self.manager.scheduleTaskCheck(task)
+            self.manager.addTaskWorker(task, self)
 
-        return True
+        inner_paths = [task["inner_path"] for task in tasks]
+        try:
+            buffs = self.peer.getFiles(tasks[0]["site"].address, inner_paths, [task["size"] for task in tasks])
+        except Exception as err:
+            self.manager.log.debug("%s: getFiles error: %s" % (self.key, err))
+            buffs = None
+        if buffs is None:
+            buffs = {}
+        if config.verbose:
+            self.manager.log.debug("%s: Received %s/%s files in batch" % (self.key, len(buffs), len(tasks)))
+
+        num_handled = 0
+        try:
+            for task in tasks:
+                self.task = task
+                if not task["done"]:
+                    self.handleTask(task, buff=buffs.pop(task["inner_path"], None))
+                self.manager.removeTaskWorker(task, self)
+                num_handled += 1
+        finally:
+            for task in tasks[num_handled:]:
+                self.manager.removeTaskWorker(task, self)
 
     def downloader(self):
         self.peer.hash_failed = 0  # Reset hash error counter
@@ -210,6 +298,18 @@ class Worker(object):
 
             self.task = task
 
+            batch = self.manager.getTaskBatch(self.peer, task)
+            if batch:
+                try:
+                    self.handleTaskBatch([task] + batch)
+                except WorkerStop as err:
+                    self.manager.log.debug("%s: Worker stopped: %s" % (self.key, err))
+                    break
+                if self.preempted:
+                    self.manager.log.debug("%s: Preempted: %s" % (self.key, self.preempted))
+                    break
+                continue
+
             self.manager.addTaskWorker(task, self)
 
             try:
@@ -220,6 +320,9 @@ class Worker(object):
                 break
 
             self.manager.removeTaskWorker(task, self)
+            if self.preempted:
+                self.manager.log.debug("%s: Preempted: %s" % (self.key, self.preempted))
+                break
 
         self.peer.onWorkerDone()
         self.running = False
@@ -230,6 +333,11 @@ class Worker(object):
         self.running = True
         self.thread = gevent.spawn(self.downloader)
 
+    # Stop after the current task
+    def preempt(self, reason="Unknown"):
+        self.manager.log.debug("%s: Preempting (reason: %s)" % (self.key, reason))
+        self.preempted = reason
+
     # Skip current task
     def skip(self, reason="Unknown"):
         self.manager.log.debug("%s: Force skipping (reason: %s)" % (self.key, reason))
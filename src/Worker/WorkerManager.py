@@ -6,15 +6,22 @@ import gevent
 
 from .Worker import Worker
 from .WorkerTaskManager import WorkerTaskManager
+from .WorkerTask import WorkerTask
 from Config import config
 from util import helper
+from util.TimerHeap import TimerHeap
 from Plugin import PluginManager
 from Debug.DebugLock import DebugLock
 import util
 
+timers = TimerHeap("WorkerManager timers")  # Task deadlines of every site
+
 
 @PluginManager.acceptPlugins
 class WorkerManager(object):
+    batch_max_files = 50  # Max number of files requested in one getFiles request
+    batch_max_file_size = 32 * 1024  # Larger files downloaded one by one, 0: unknown size
+    batch_max_size = 256 * 1024  # Max total known size of the files in one batch
 
     def __init__(self, site):
         self.site = site
@@ -22,14 +29,14 @@ class WorkerManager(object):
         self.tasks = WorkerTaskManager()
         self.next_task_id = 1
         self.lock_add_task = DebugLock(name="Lock AddTask:%s" % self.site.address_short)
-        # {"id": 1, "evt": evt, "workers_num": 0, "site": self.site, "inner_path": inner_path, "done": False, "optional_hash_id": None,
-        # "time_started": None, "time_added": time.time(), "peers": peers, "priority": 0, "failed": peer_ids, "lock": None or gevent.lock.RLock}
         self.started_task_num = 0  # Last added task num
         self.asked_peers = []
         self.running = True
         self.time_task_added = 0
+        self.time_announced = 0
+        self.event_task_available = gevent.event.Event()  # Set and replaced when workers may find a new task
+        self.timer_stalled = None  # Deadline of the tasks left without workers
         self.log = logging.getLogger("WorkerManager:%s" % self.site.address_short)
-        self.site.greenlet_manager.spawn(self.checkTasks)
 
     def __str__(self):
         return "WorkerManager %s" % self.site.address_short
@@ -37,96 +44,135 @@ class WorkerManager(object):
     def __repr__(self):
         return "<%s>" % self.__str__()
 
-    # Check expired tasks
+    # Wake up the idle workers waiting for a new task
+    def onTaskAvailable(self):
+        event, self.event_task_available = self.event_task_available, gevent.event.Event()
+        event.set()
+
+    # Schedule the next deadline of a started task: find more workers every 15 sec, skip workers after 60 sec
+    def scheduleTaskCheck(self, task):
+        timers.cancel(task["timer"])
+        if task["done"] or not self.running:
+            task["timer"] = None
+            return False
+        time_started = task["time_started"]
+        deadline = time_started + 15 * (int((time.time() - time_started) / 15) + 1)
+        task["timer"] = timers.schedule(deadline, self.site.greenlet_manager.spawn, self.checkTask, task)
+        return True
+
+    # Deadline of a started task expired
+    def checkTask(self, task):
+        if task["done"] or not self.running:
+            return
+        if time.time() >= task["time_started"] + 60:
+            self.log.debug("Timeout, Skipping: %s" % task)  # Task taking too long time, skip it
+            # Skip to next file workers
+            workers = self.findWorkers(task)
+            if workers:
+                for worker in workers:
+                    worker.skip(reason="Task timeout")
+            else:
+                self.failTask(task, reason="No workers")
+        else:
+            self.findMoreWorkers(task)
+
+        if len(self.tasks) > len(self.workers) * 2 and len(self.workers) < self.getMaxWorkers():
+            self.startWorkers(reason="Task checker (need more workers)")
+        elif len(self.workers) >= self.getMaxWorkers():
+            self.startWorkers(self.site.getConnectedPeers(), reason="Task checker (faster peers)")
+        self.scheduleTaskCheck(task)
+
+    # Schedule the check of the tasks left without workers
+    def scheduleStalledCheck(self):
+        if self.timer_stalled or not self.tasks or self.workers or not self.running:
+            return False
+        self.timer_stalled = timers.scheduleAfter(15, self.site.greenlet_manager.spawn, self.checkTasks)
+        return True
+
+    # No workers for 15 sec: fail the tasks waiting more than 60 sec, find workers for the others
     def checkTasks(self):
-        while self.running:
-            tasks = task = worker = workers = None  # Cleanup local variables
-            announced = False
-            time.sleep(15)  # Check every 15 sec
+        self.timer_stalled = None
+        if not self.running or not self.tasks or self.workers:
+            return
 
-            # Clean up workers
-            for worker in list(self.workers.values()):
-                if worker.task and worker.task["done"]:
-                    worker.skip(reason="Task done")  # Stop workers with task done
+        tasks = self.tasks[:]  # Copy it so removing elements wont cause any problem
+        self.log.debug(
+            "No workers, tasks: %s, bad files: %s, total started: %s" %
+            (len(tasks), len(self.site.bad_files), self.started_task_num)
+        )
 
-            if not self.tasks:
-                continue
+        for task in tasks:
+            if task["time_started"] and time.time() >= task["time_started"] + 60:
+                self.failTask(task, reason="No workers")
+            elif time.time() >= task["time_added"] + 60:  # No workers left
+                self.failTask(task, reason="Timeout")
+            else:
+                self.findMoreWorkers(task)
 
-            tasks = self.tasks[:]  # Copy it so removing elements wont cause any problem
-            num_tasks_started = len([task for task in tasks if task["time_started"]])
+        self.scheduleStalledCheck()
 
-            self.log.debug(
-                "Tasks: %s, started: %s, bad files: %s, total started: %s" %
-                (len(tasks), num_tasks_started, len(self.site.bad_files), self.started_task_num)
+    # Task started more than 15 sec ago or no workers
+    def findMoreWorkers(self, task):
+        workers = self.findWorkers(task)
+        self.log.debug(
+            "Slow task: %s, (workers: %s, optional_hash_id: %s, peers: %s, failed: %s, asked: %s)" %
+            (
+                task["inner_path"], len(workers), task["optional_hash_id"],
+                len(task["peers"] or []), len(task["failed"]), len(self.asked_peers)
             )
-
-            for task in tasks:
-                if task["time_started"] and time.time() >= task["time_started"] + 60:
-                    self.log.debug("Timeout, Skipping: %s" % task)  # Task taking too long time, skip it
-                    # Skip to next file workers
-                    workers = self.findWorkers(task)
-                    if workers:
-                        for worker in workers:
-                            worker.skip(reason="Task timeout")
-                    else:
-                        self.failTask(task, reason="No workers")
-
-                elif time.time() >= task["time_added"] + 60 and not self.workers:  # No workers left
-                    self.failTask(task, reason="Timeout")
-
-                elif (task["time_started"] and time.time() >= task["time_started"] + 15) or not self.workers:
-                    # Find more workers: Task started more than 15 sec ago or no workers
-                    workers = self.findWorkers(task)
-                    self.log.debug(
-                        "Slow task: %s, (workers: %s, optional_hash_id: %s, peers: %s, failed: %s, asked: %s)" %
-                        (
-                            task["inner_path"], len(workers), task["optional_hash_id"],
-                            len(task["peers"] or []), len(task["failed"]), len(self.asked_peers)
-                        )
-                    )
-                    if not announced and task["site"].isAddedRecently():
-                        task["site"].announce(mode="more")  # Find more peers
-                        announced = True
-                    if task["optional_hash_id"]:
-                        if self.workers:
-                            if not task["time_started"]:
-                                ask_limit = 20
-                            else:
-                                ask_limit = max(10, time.time() - task["time_started"])
-                            if len(self.asked_peers) < ask_limit and len(task["peers"] or []) <= len(task["failed"]) * 2:
-                                # Re-search for high priority
-                                self.startFindOptional(find_more=True)
-                        if task["peers"]:
-                            peers_try = [peer for peer in task["peers"] if peer not in task["failed"] and peer not in workers]
-                            if peers_try:
-                                self.startWorkers(peers_try, force_num=5, reason="Task checker (optional, has peers)")
-                            else:
-                                self.startFindOptional(find_more=True)
-                        else:
-                            self.startFindOptional(find_more=True)
-                    else:
-                        if task["peers"]:  # Release the peer lock
-                            self.log.debug("Task peer lock release: %s" % task["inner_path"])
-                            task["peers"] = []
-                        self.startWorkers(reason="Task checker")
-
-            if len(self.tasks) > len(self.workers) * 2 and len(self.workers) < self.getMaxWorkers():
-                self.startWorkers(reason="Task checker (need more workers)")
-
-        self.log.debug("checkTasks stopped running")
+        )
+        if time.time() - self.time_announced > 15 and task["site"].isAddedRecently():
+            self.site.greenlet_manager.spawn(task["site"].announce, mode="more")  # Find more peers
+            self.time_announced = time.time()
+        if task["optional_hash_id"]:
+            if self.workers:
+                if not task["time_started"]:
+                    ask_limit = 20
+                else:
+                    ask_limit = max(10, time.time() - task["time_started"])
+                if len(self.asked_peers) < ask_limit and len(task["peers"] or []) <= len(task["failed"]) * 2:
+                    # Re-search for high priority
+                    self.startFindOptional(find_more=True)
+            if task["peers"]:
+                peers_try = [peer for peer in task["peers"] if peer not in task["failed"] and peer not in workers]
+                if peers_try:
+                    self.startWorkers(peers_try, force_num=5, reason="Task checker (optional, has peers)")
+                else:
+                    self.startFindOptional(find_more=True)
+            else:
+                self.startFindOptional(find_more=True)
+        else:
+            if task["peers"]:  # Release the peer lock
+                self.log.debug("Task peer lock release: %s" % task["inner_path"])
+                task["peers"] = []
+                self.tasks.updatePeers(task)
+                self.onTaskAvailable()
+            self.startWorkers(reason="Task checker")
 
     # Returns the next free or less worked task
     def getTask(self, peer):
-        for task in self.tasks:  # Find a task
-            if task["peers"] and peer not in task["peers"]:
-                continue  # This peer not allowed to pick this task
-            if peer in task["failed"]:
-                continue  # Peer already tried to solve this, but failed
-            if task["optional_hash_id"] and task["peers"] is None:
-                continue  # No peers found yet for the optional task
-            if task["done"]:
+        return self.tasks.getTask(peer)
+
+    # Small files downloaded together using the getFiles command
+    def isBatchable(self, task):
+        return "|" not in task["inner_path"] and task["size"] <= self.batch_max_file_size
+
+    # Return: Other free small tasks to download together with the task from the peer
+    def getTaskBatch(self, peer, task):
+        if task["workers_num"] or not self.isBatchable(task) or not peer.hasFeature("get_files"):
+            return []
+        batch = []
+        batch_size = task["size"]
+        for task_other in self.tasks.iterTasks(peer):
+            if task_other is task or task_other["workers_num"] or not self.isBatchable(task_other):
                 continue
-            return task
+            if batch_size + task_other["size"] > self.batch_max_size:
+                continue
+            batch.append(task_other)
+            batch_size += task_other["size"]
+            if len(batch) >= self.batch_max_files - 1:
+                break
+        return batch
 
     def removeSolvedFileTasks(self, mark_as_good=True):
         for task in self.tasks[:]:
@@ -135,6 +181,8 @@ class WorkerManager(object):
                 task["done"] = True
                 task["evt"].set(mark_as_good)
                 self.tasks.remove(task)
+                timers.cancel(task["timer"])
+                task.onChanged()
         if not self.tasks:
             self.started_task_num = 0
         self.site.updateWebsocket()
@@ -149,11 +197,38 @@ class WorkerManager(object):
         else:
             return config.workers
 
+    # Return: Expected time to download size bytes from the peer, peers without idle connection last
+    def getPeerDownloadTime(self, peer, size=0):
+        download_time = peer.performance.getTime(size, ping=peer.getPing())
+        connection = peer.connection
+        if not connection or not connection.connected or connection.waiting_requests:
+            download_time += 9999
+        return download_time
+
+    # Stop the slowest worker after its current task if the peer is expected to be a lot faster
+    def preemptWorker(self, peer):
+        if not peer.performance.num_samples:
+            return False  # Not downloaded from the peer yet
+        size = self.tasks[0]["size"] if self.tasks else 0
+        workers = [
+            worker for worker in self.workers.values()
+            if worker.running and not worker.preempted and worker.peer.performance.num_samples
+        ]
+        if not workers:
+            return False
+        peer_time = peer.performance.getTime(size, ping=peer.getPing())
+        worker_slowest = max(workers, key=lambda worker: worker.peer.performance.getTime(size, ping=worker.peer.getPing()))
+        if peer_time * 3 > worker_slowest.peer.performance.getTime(size, ping=worker_slowest.peer.getPing()):
+            return False
+        worker_slowest.preempt(reason="Faster peer: %s" % peer.key)
+        return True
+
     # Add new worker
     def addWorker(self, peer, multiplexing=False, force=False):
         key = peer.key
         if len(self.workers) > self.getMaxWorkers() and not force:
-            return False
+            if key in self.workers or not self.getTask(peer) or not self.preemptWorker(peer):
+                return False
         if multiplexing:  # Add even if we already have worker for this peer
             key = "%s/%s" % (key, len(self.workers))
         if key not in self.workers:
@@ -171,13 +246,21 @@ class WorkerManager(object):
             return False
 
     def taskAddPeer(self, task, peer):
-        if task["peers"] is None:
-            task["peers"] = []
         if peer in task["failed"]:
+            if task["peers"] is None:
+                task["peers"] = []
+                self.tasks.updatePeers(task)
+                self.onTaskAvailable()
             return False
 
-        if peer not in task["peers"]:
+        if task["peers"] is None:
+            task["peers"] = [peer]
+        elif peer not in task["peers"]:
             task["peers"].append(peer)
+        else:
+            return True
+        self.tasks.updatePeers(task)
+        self.onTaskAvailable()
         return True
 
     # Start workers to process tasks
@@ -198,8 +281,9 @@ class WorkerManager(object):
         if type(peers) is set:
             peers = list(peers)
 
-        # Sort by ping
-        peers.sort(key=lambda peer: peer.connection.last_ping_delay if peer.connection and peer.connection.last_ping_delay and len(peer.connection.waiting_requests) == 0 and peer.connection.connected else 9999)
+        # Sort by expected download time of the most important task
+        size = self.tasks[0]["size"] if self.tasks else 0
+        peers.sort(key=lambda peer: self.getPeerDownloadTime(peer, size))
 
         for peer in peers:  # One worker for every peer
             if peers and peer not in peers:
@@ -218,38 +302,22 @@ class WorkerManager(object):
     def findOptionalTasks(self, optional_tasks, reset_task=False):
         found = collections.defaultdict(list)  # { found_hash: [peer1, peer2...], ...}
 
-        for peer in list(self.site.peers.values()):
-            if not peer.has_hashfield:
-                continue
-
-            hashfield_set = set(peer.hashfield)  # Finding in set is much faster
-            for task in optional_tasks:
-                optional_hash_id = task["optional_hash_id"]
-                if optional_hash_id in hashfield_set:
-                    if reset_task and len(task["failed"]) > 0:
-                        task["failed"] = []
-                    if peer in task["failed"]:
-                        continue
-                    if self.taskAddPeer(task, peer):
-                        found[optional_hash_id].append(peer)
+        for task in optional_tasks:
+            optional_hash_id = task["optional_hash_id"]
+            for peer in self.site.hashfield_index.getPeers(optional_hash_id):
+                if reset_task and len(task["failed"]) > 0:
+                    self.tasks.clearFailed(task)
+                if peer in task["failed"]:
+                    continue
+                if self.taskAddPeer(task, peer):
+                    found[optional_hash_id].append(peer)
 
         return found
 
     # Find peers for optional hash ids in local hash tables
     def findOptionalHashIds(self, optional_hash_ids, limit=0):
         found = collections.defaultdict(list)  # { found_hash_id: [peer1, peer2...], ...}
-
-        for peer in list(self.site.peers.values()):
-            if not peer.has_hashfield:
-                continue
-
-            hashfield_set = set(peer.hashfield)  # Finding in set is much faster
-            for optional_hash_id in optional_hash_ids:
-                if optional_hash_id in hashfield_set:
-                    found[optional_hash_id].append(peer)
-                    if limit and len(found[optional_hash_id]) >= limit:
-                        optional_hash_ids.remove(optional_hash_id)
-
+        found.update(self.site.hashfield_index.findPeers(optional_hash_ids, limit=limit))
         return found
 
     # Add peers to tasks from found result
@@ -436,6 +504,7 @@ class WorkerManager(object):
             elif self.tasks and not self.workers and worker.task and len(worker.task["failed"]) < 20:
                 self.log.debug("Starting new workers... (tasks: %s)" % len(self.tasks))
                 self.startWorkers(reason="Removed worker")
+        self.scheduleStalledCheck()
 
     # Tasks sorted by this
     def getPriorityBoost(self, inner_path):
@@ -464,11 +533,16 @@ class WorkerManager(object):
         if priority > task["priority"]:
             self.tasks.updateItem(task, "priority", priority)
         if peer and task["peers"]:  # This peer also has new version, add it to task possible peers
+            if peer in task["failed"]:
+                self.tasks.unmarkFailed(task, peer)  # New update arrived, the peer may have the right file now
             task["peers"].append(peer)
+            self.tasks.updatePeers(task)
+            self.onTaskAvailable()
             self.log.debug("Added peer %s to %s" % (peer.key, task["inner_path"]))
             self.startWorkers([peer], reason="Added new task (update received by peer)")
         elif peer and peer in task["failed"]:
-            task["failed"].remove(peer)  # New update arrived, remove the peer from failed peers
+            self.tasks.unmarkFailed(task, peer)  # New update arrived, remove the peer from failed peers
+            self.onTaskAvailable()
             self.log.debug("Removed peer %s from failed %s" % (peer.key, task["inner_path"]))
             self.startWorkers([peer], reason="Added new task (peer failed before)")
 
@@ -502,14 +576,14 @@ class WorkerManager(object):
         if self.started_task_num == 0:  # Boost priority for first requested file
             priority += 1
 
-        task = {
-            "id": self.next_task_id, "evt": evt, "workers_num": 0, "site": self.site, "inner_path": inner_path, "done": False,
-            "optional_hash_id": optional_hash_id, "time_added": time.time(), "time_started": None, "lock": None,
-            "time_action": None, "peers": peers, "priority": priority, "failed": [], "size": size
-        }
+        task = WorkerTask(
+            self.next_task_id, evt, self.site, inner_path,
+            optional_hash_id=optional_hash_id, peers=peers, priority=priority, size=size
+        )
 
         self.tasks.append(task)
         self.lock_add_task.release()
+        self.onTaskAvailable()
 
         self.next_task_id += 1
         self.started_task_num += 1
@@ -531,6 +605,7 @@ class WorkerManager(object):
 
         else:
             self.startWorkers(peers, reason="Added new task")
+        self.scheduleStalledCheck()
         return task
 
     # Create new task and return asyncresult
@@ -554,6 +629,7 @@ class WorkerManager(object):
             self.tasks.updateItem(task, "workers_num", task["workers_num"] - 1)
         except ValueError:
             task["workers_num"] -= 1
+        task.onChanged()
         if len(task["failed"]) >= len(self.workers):
             fail_reason = "Too many fails: %s (workers: %s)" % (len(task["failed"]), len(self.workers))
             self.failTask(task, reason=fail_reason)
@@ -574,6 +650,11 @@ class WorkerManager(object):
     def doneTask(self, task):
         task["done"] = True
         self.tasks.remove(task)  # Remove from queue
+        timers.cancel(task["timer"])
+        task.onChanged()
+        for worker in self.findWorkers(task):
+            if worker.thread is not gevent.getcurrent():
+                worker.skip(reason="Task done")  # Stop other workers of the task
         if task["optional_hash_id"]:
             self.log.debug(
                 "Downloaded optional file in %.3fs, adding to hashfield: %s" %
@@ -594,6 +675,8 @@ class WorkerManager(object):
 
         self.log.debug("Task %s failed (Reason: %s)" % (task["inner_path"], reason))
         task["done"] = True
+        timers.cancel(task["timer"])
+        task.onChanged()
         self.site.onFileFail(task["inner_path"])
         task["evt"].set(False)
         if not self.tasks:
@@ -0,0 +1,54 @@
+import time
+
+import gevent.event
+
+
+# File download task of the WorkerManager
+# Item access (task["inner_path"]) is kept for plugins and older code, plugins can also add their own keys
+class WorkerTask(object):
+    __slots__ = (
+        "id", "evt", "workers_num", "site", "inner_path", "done", "optional_hash_id", "time_added", "time_started",
+        "lock", "time_action", "peers", "priority", "failed", "size", "timer", "event_changed", "__dict__"
+    )
+
+    def __init__(self, id, evt, site, inner_path, optional_hash_id=None, peers=None, priority=0, size=0):
+        self.id = id
+        self.evt = evt  # AsyncResult set to True on done, False on fail
+        self.workers_num = 0  # Number of workers currently downloading the file
+        self.site = site
+        self.inner_path = inner_path
+        self.done = False
+        self.optional_hash_id = optional_hash_id
+        self.time_added = time.time()
+        self.time_started = None
+        self.lock = None  # Write lock created by the first worker
+        self.time_action = None
+        self.peers = peers  # Only these peers allowed to download the file, None: Optional file peers not found yet
+        self.priority = priority
+        self.failed = set()  # Peers failed to download the file
+        self.size = size
+        self.timer = None  # Next deadline in the worker timers
+        self.event_changed = gevent.event.Event()  # Set and replaced on done, fail or worker leaving the task
+
+    def __repr__(self):
+        return "<WorkerTask #%s %s (pri: %s, workers: %s)>" % (self.id, self.inner_path, self.priority, self.workers_num)
+
+    # Wake up the workers waiting for the task
+    def onChanged(self):
+        event, self.event_changed = self.event_changed, gevent.event.Event()
+        event.set()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
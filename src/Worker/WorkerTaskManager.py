@@ -1,4 +1,5 @@
 import bisect
+import heapq
 from collections.abc import MutableSequence
 
 
@@ -84,10 +85,17 @@ class CustomSortedList(MutableSequence):
             return False
 
 
+# Tasks sorted by priority with queues per peer lock to quickly find the next task a peer can work on
+# Tasks a peer failed are left out of its queues, so picking a task never walks the ones it can't work on
 class WorkerTaskManager(CustomSortedList):
     def __init__(self):
         super().__init__()
         self.inner_paths = {}
+        self.queue_open = []  # Sorted items of the tasks any peer can pick
+        self.queue_open_peers = {}  # Peer -> Sorted items of the open tasks without the ones the peer failed
+        self.queue_peers = {}  # Peer -> Sorted items of the tasks locked to the peer, without the failed ones
+        self.queued = {}  # Task id -> (Item, Peers, Is open) the task queued with
+        self.excluded = {}  # Peer -> Ids of the queued tasks the peer failed
 
     def getPriority(self, value):
         return 0 - (value["priority"] - value["workers_num"] * 10)
@@ -100,7 +108,9 @@ class WorkerTaskManager(CustomSortedList):
 
     def __delitem__(self, index):
         # Remove from inner path cache
-        del self.inner_paths[self.items[index][2]["inner_path"]]
+        task = self.items[index][2]
+        del self.inner_paths[task["inner_path"]]
+        self.dequeue(task)
         super().__delitem__(index)
 
     # Fast task search by inner_path
@@ -111,12 +121,157 @@ class WorkerTaskManager(CustomSortedList):
         super().append(task)
         # Create inner path cache for faster lookup by filename
         self.inner_paths[task["inner_path"]] = task
+        for peer in task.get("failed", ()):
+            self.excluded.setdefault(peer, set()).add(task["id"])
+        self.enqueue(task)
 
     def remove(self, task):
         if task not in self:
             raise ValueError("%r not in list" % task)
         else:
             super().remove(task)
+            for peer in task.get("failed", ()):
+                self.removeExcluded(task, peer)
+
+    # Re-sort the task, keeps its failed peers
+    def updateItem(self, task, update_key=None, update_value=None):
+        super().remove(task)
+        if update_key is not None:
+            task[update_key] = update_value
+        self.append(task)
 
     def findTask(self, inner_path):
         return self.inner_paths.get(inner_path, None)
+
+    def isExcluded(self, task, peer):
+        excluded = self.excluded.get(peer)
+        return excluded is not None and task["id"] in excluded
+
+    def enqueue(self, task):
+        item = self.valueToItem(task)
+        peers = task.get("peers")
+        is_open = False
+        if peers:  # Locked to peers
+            peers = tuple(dict.fromkeys(peers))
+            for peer in peers:
+                if not self.isExcluded(task, peer):
+                    bisect.insort(self.queue_peers.setdefault(peer, []), item)
+        elif peers is None and task.get("optional_hash_id"):  # Optional file, no peers found yet
+            pass
+        else:
+            is_open = True
+            bisect.insort(self.queue_open, item)
+            for peer, queue in self.queue_open_peers.items():
+                if not self.isExcluded(task, peer):
+                    bisect.insort(queue, item)
+            for peer in task.get("failed", ()):
+                if self.isExcluded(task, peer) and peer not in self.queue_open_peers:
+                    self.queue_open_peers[peer] = self.getOpenQueue(peer)
+        self.queued[task["id"]] = (item, peers, is_open)
+
+    def dequeue(self, task):
+        item, peers, is_open = self.queued.pop(task["id"], (None, None, False))
+        if not item:
+            return False
+        if peers:
+            for peer in peers:
+                queue = self.queue_peers.get(peer)
+                if queue:
+                    self.removeSortedItem(queue, item)
+                    if not queue:
+                        del self.queue_peers[peer]
+        elif is_open:
+            self.removeSortedItem(self.queue_open, item)
+            for queue in self.queue_open_peers.values():
+                self.removeSortedItem(queue, item)
+        return True
+
+    def removeSortedItem(self, queue, item):
+        pos = bisect.bisect_left(queue, item)
+        if pos < len(queue) and queue[pos] is item:
+            del queue[pos]
+
+    # Requeue the task after the change of its peer lock
+    def updatePeers(self, task):
+        if self.dequeue(task):
+            self.enqueue(task)
+
+    # The peer failed to download the task, leave it out of the peer's queues
+    def markFailed(self, task, peer):
+        task["failed"].add(peer)
+        if task["id"] not in self.queued or self.isExcluded(task, peer):
+            return False
+        self.excluded.setdefault(peer, set()).add(task["id"])
+
+        item, peers, is_open = self.queued[task["id"]]
+        if peers and peer in peers:
+            queue = self.queue_peers.get(peer)
+            if queue:
+                self.removeSortedItem(queue, item)
+                if not queue:
+                    del self.queue_peers[peer]
+        elif is_open:
+            queue = self.queue_open_peers.get(peer)
+            if queue is None:  # First failed open task of the peer
+                self.queue_open_peers[peer] = self.getOpenQueue(peer)
+            else:
+                self.removeSortedItem(queue, item)
+        return True
+
+    # Return: Sorted items of the open tasks the peer didn't fail
+    def getOpenQueue(self, peer):
+        excluded = self.excluded.get(peer, ())
+        return [item for item in self.queue_open if item[2]["id"] not in excluded]
+
+    # The peer is allowed to try the task again
+    def unmarkFailed(self, task, peer):
+        task["failed"].discard(peer)
+        if not self.removeExcluded(task, peer) or task["id"] not in self.queued:
+            return False
+
+        item, peers, is_open = self.queued[task["id"]]
+        if peers and peer in peers:
+            bisect.insort(self.queue_peers.setdefault(peer, []), item)
+        elif is_open and peer in self.queue_open_peers:
+            bisect.insort(self.queue_open_peers[peer], item)
+        return True
+
+    def clearFailed(self, task):
+        for peer in list(task["failed"]):
+            self.unmarkFailed(task, peer)
+
+    def removeExcluded(self, task, peer):
+        excluded = self.excluded.get(peer)
+        if not excluded or task["id"] not in excluded:
+            return False
+        excluded.remove(task["id"])
+        if not excluded:  # Back to the shared queue of open tasks
+            del self.excluded[peer]
+            self.queue_open_peers.pop(peer, None)
+        return True
+
+    # Yield: Tasks the peer is allowed to work on, highest priority first
+    def iterTasks(self, peer):
+        queues = [queue for queue in (self.queue_open_peers.get(peer, self.queue_open), self.queue_peers.get(peer)) if queue]
+        for item in heapq.merge(*queues):
+            task = item[2]
+            if task["done"]:
+                continue
+            yield task
+
+    # Return: Highest priority task the peer is allowed to work on
+    def getTask(self, peer):
+        best = None
+        for queue in (self.queue_open_peers.get(peer, self.queue_open), self.queue_peers.get(peer)):
+            if not queue:
+                continue
+            for item in queue:
+                if item[2]["done"]:
+                    continue
+                if best is None or item < best:
+                    best = item
+                break
+        if best:
+            return best[2]
+        else:
+            return None
@@ -0,0 +1,82 @@
+import os
+import hashlib
+
+
+# Download sink: temporary file next to the final one, sha512 hashed while the data arrives
+# Data written in order is hashed without reading it back, parts written out of order (pipelined
+# downloads) are read back from the file only once on getSha512()
+class DownloadFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb+")
+        self.hash = hashlib.sha512()
+        self.hash_pos = 0  # Bytes hashed from the start of the file
+        self.closed = False
+
+    def __repr__(self):
+        return "<DownloadFile %s (hashed: %s)>" % (self.path, self.hash_pos)
+
+    def write(self, data):
+        pos = self.file.tell()
+        self.file.write(data)
+        if pos == self.hash_pos:
+            self.hash.update(data)
+            self.hash_pos += len(data)
+        elif pos < self.hash_pos:  # Hashed data overwritten, re-hash on completion
+            self.hash = hashlib.sha512()
+            self.hash_pos = 0
+        return len(data)
+
+    def seek(self, pos, whence=0):
+        return self.file.seek(pos, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def flush(self):
+        self.file.flush()
+
+    # Return: sha512 of the file truncated to 256bits, position left at the end of the file
+    def getSha512(self, blocksize=65536):
+        self.file.seek(self.hash_pos)
+        for block in iter(lambda: self.file.read(blocksize), b""):
+            self.hash.update(block)
+            self.hash_pos += len(block)
+        return self.hash.hexdigest()[0:64]
+
+    # Move the file to its final place
+    def commit(self, dest):
+        self.file.flush()
+        self.file.close()
+        self.closed = True
+        os.replace(self.path, dest)
+
+    def delete(self):
+        if self.closed:
+            return False
+        self.file.close()
+        self.closed = True
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        return True
+
+
+# File already hashed by someone else (eg. in a thread pool), only its hash and size kept
+class HashedFile(object):
+    def __init__(self, sha512, size):
+        self.sha512 = sha512
+        self.size = size
+
+    def __repr__(self):
+        return "<HashedFile %s (size: %s)>" % (self.sha512, self.size)
+
+    def tell(self):
+        return self.size
+
+    def getSha512(self):
+        return self.sha512
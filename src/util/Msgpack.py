@@ -17,7 +17,7 @@ def msgpackHeader(size):
         raise Exception("huge binary string")
 
 
-def stream(data, writer):
+def stream(data, writer, file_writer=None):
     packer = msgpack.Packer(use_bin_type=True)
     writer(packer.pack_map_header(len(data)))
     for key, val in data.items():
@@ -25,14 +25,17 @@ def stream(data, writer):
         if isinstance(val, io.IOBase):  # File obj
             max_size = os.fstat(val.fileno()).st_size - val.tell()
             size = min(max_size, val.read_bytes)
-            bytes_left = size
             writer(msgpackHeader(size))
-            buff = 1024 * 64
-            while 1:
-                writer(val.read(min(bytes_left, buff)))
-                bytes_left = bytes_left - buff
-                if bytes_left <= 0:
-                    break
+            if file_writer:  # Let the caller transmit the file content (eg. using sendfile)
+                file_writer(val, size)
+            else:
+                bytes_left = size
+                buff = 1024 * 64
+                while 1:
+                    writer(val.read(min(bytes_left, buff)))
+                    bytes_left = bytes_left - buff
+                    if bytes_left <= 0:
+                        break
         else:  # Simple
             writer(packer.pack(val))
     return size
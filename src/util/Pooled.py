@@ -1,14 +1,37 @@
+import time
+
 import gevent.pool
+import gevent.queue
+import gevent.event
 
 
+# Run the decorated function in a pool of max size greenlets, the calls over it wait in a queue
+# Callers block when more than max_queue calls are waiting (None: unlimited)
 class Pooled(object):
-    def __init__(self, size=100):
+    def __init__(self, size=100, max_queue=10000):
         self.pool = gevent.pool.Pool(size)
         self.pooler_running = False
-        self.queue = []
+        self.queue = gevent.queue.Queue(max_queue)
         self.func = None
+        self.num_started = 0
+        self.time_waited_total = 0.0  # Sum of the time calls spent in the queue
+        self.time_waited_max = 0.0
+
+    def getStats(self):
+        return {
+            "in_flight": len(self.pool),
+            "queued": self.queue.qsize(),
+            "started": self.num_started,
+            "wait_avg": self.time_waited_total / self.num_started if self.num_started else 0.0,
+            "wait_max": self.time_waited_max
+        }
+
+    def waiter(self, evt, time_queued, args, kwargs):
+        time_waited = time.time() - time_queued
+        self.num_started += 1
+        self.time_waited_total += time_waited
+        self.time_waited_max = max(self.time_waited_max, time_waited)
 
-    def waiter(self, evt, args, kwargs):
         res = self.func(*args, **kwargs)
         if type(res) == gevent.event.AsyncResult:
             evt.set(res.get())
@@ -16,20 +39,21 @@ class Pooled(object):
             evt.set(res)
 
     def pooler(self):
-        while self.queue:
-            evt, args, kwargs = self.queue.pop(0)
-            self.pool.spawn(self.waiter, evt, args, kwargs)
+        while not self.queue.empty():
+            evt, time_queued, args, kwargs = self.queue.get_nowait()
+            self.pool.spawn(self.waiter, evt, time_queued, args, kwargs)  # Blocks until there is a free slot
         self.pooler_running = False
 
     def __call__(self, func):
         def wrapper(*args, **kwargs):
             evt = gevent.event.AsyncResult()
-            self.queue.append((evt, args, kwargs))
+            self.queue.put((evt, time.time(), args, kwargs))  # Blocks if the queue is full
             if not self.pooler_running:
                 self.pooler_running = True
                 gevent.spawn(self.pooler)
             return evt
         wrapper.__name__ = func.__name__
+        wrapper.pooled = self
         self.func = func
 
         return wrapper
@@ -0,0 +1,73 @@
+import heapq
+import itertools
+import logging
+import time
+
+import gevent
+import gevent.event
+
+from Debug import Debug
+
+
+class TimerHeap(object):
+    """Run callbacks at their deadline from a single greenlet
+
+    Timers are kept in a heap, so waking up costs O(log n) per expired timer
+    instead of scanning every scheduled object periodically.
+    """
+
+    def __init__(self, name="TimerHeap"):
+        self.heap = []
+        self.counter = itertools.count()  # Keeps insertion order for timers with the same deadline
+        self.event_changed = gevent.event.Event()
+        self.thread = None
+        self.log = logging.getLogger(name)
+
+    def __len__(self):
+        return len(self.heap)
+
+    # Return: Timer handle that can be passed to cancel()
+    def schedule(self, deadline, callback, *args):
+        timer = [deadline, next(self.counter), callback, args]
+        heapq.heappush(self.heap, timer)
+        if self.heap[0] is timer:  # New earliest deadline, wake up the runner
+            self.event_changed.set()
+        if not self.thread:
+            self.thread = gevent.spawn(self.run)
+        return timer
+
+    def scheduleAfter(self, delay, callback, *args):
+        return self.schedule(time.time() + delay, callback, *args)
+
+    def cancel(self, timer):
+        if timer:
+            timer[2] = None  # Removed lazily when it reaches the top of the heap
+
+    def clear(self):
+        self.heap = []
+        self.event_changed.set()
+
+    def stop(self):
+        self.heap = []
+        if self.thread:
+            self.thread.kill()
+            self.thread = None
+
+    def run(self):
+        while True:
+            self.event_changed.clear()
+            if self.heap:
+                timeout = self.heap[0][0] - time.time()
+            else:
+                timeout = None
+            if timeout is None or timeout > 0:
+                self.event_changed.wait(timeout)
+                continue
+
+            deadline, _, callback, args = heapq.heappop(self.heap)
+            if not callback:  # Cancelled
+                continue
+            try:
+                callback(*args)
+            except Exception as err:
+                self.log.error("Timer callback %s error: %s" % (callback, Debug.formatException(err)))